@@ -0,0 +1,180 @@
+"""
+Counts and times every AWS call, through botocore's event hooks, so a command can report where its time went.
+aws_clients attaches an ApiMetrics to every client it creates once instrument() has been called,
+which is what the --profile option of each command does.
+"""
+import json
+import sys
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+THROTTLING_ERROR_CODES = {"Throttling", "ThrottlingException", "ThrottledException", "RequestLimitExceeded",
+                          "RequestThrottled", "RequestThrottledException", "TooManyRequestsException",
+                          "PriorRequestNotComplete", "SlowDown"}
+
+
+@dataclass
+class OperationStats:
+    region_name: str
+    service_name: str
+    operation_name: str
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    throttles: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    latency_histogram: list = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+
+    def record_latency(self, seconds):
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        milliseconds = seconds * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if milliseconds <= bound), len(LATENCY_BUCKETS_MS))
+        self.latency_histogram[bucket] += 1
+
+    @property
+    def mean_seconds(self):
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+    def percentile_ms(self, fraction):
+        """ The upper bound of the histogram bucket that holds this fraction of the calls """
+        wanted = fraction * sum(self.latency_histogram)
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS + [self.max_seconds * 1000], self.latency_histogram):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.max_seconds * 1000
+
+    def as_json(self):
+        data = asdict(self)
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        data["latency_histogram"] = dict(zip(labels, self.latency_histogram))
+        data["mean_seconds"] = self.mean_seconds
+        return data
+
+
+class ApiMetrics:
+    def __init__(self):
+        """ Per region, service and operation statistics of the AWS calls made by the clients it is attached to """
+        self._lock = threading.Lock()
+        self.operations = {}
+        self.started = time.monotonic()
+
+    def _handlers(self):
+        return [("before-parameter-build", self._call_started), ("request-created", self._request_created),
+                ("response-received", self._response_received), ("after-call", self._call_finished),
+                ("after-call-error", self._call_failed)]
+
+    def attach(self, client):
+        for event_name, handler in self._handlers():
+            client.meta.events.register(event_name, handler)
+
+    def detach(self, client):
+        for event_name, handler in self._handlers():
+            client.meta.events.unregister(event_name, handler)
+
+    def _stats(self, context):
+        key = context["api_metrics_key"]
+        if key not in self.operations:
+            self.operations[key] = OperationStats(*key)
+        return self.operations[key]
+
+    def _call_started(self, model, context, **kwargs):
+        context["api_metrics_key"] = (context.get("client_region") or "global", model.service_model.service_name,
+                                      model.name)
+        context["api_metrics_started"] = time.perf_counter()
+
+    def _request_created(self, request, **kwargs):
+        context = getattr(request, "context", None) or {}
+        if "api_metrics_key" not in context:
+            return
+        body = request.body or b""
+        with self._lock:
+            self._stats(context).bytes_sent += len(body)
+
+    def _response_received(self, response_dict, parsed_response, context, **kwargs):
+        """ Called once for every attempt, including the ones that get retried """
+        if "api_metrics_key" not in context:
+            return
+        error_code = ((parsed_response or {}).get("Error") or {}).get("Code")
+        with self._lock:
+            stats = self._stats(context)
+            if response_dict:
+                stats.bytes_received += len(response_dict.get("body") or b"")
+            if error_code in THROTTLING_ERROR_CODES:
+                stats.throttles += 1
+
+    def _call_finished(self, http_response, parsed, context, **kwargs):
+        if "api_metrics_key" not in context:
+            return
+        seconds = time.perf_counter() - context["api_metrics_started"]
+        with self._lock:
+            stats = self._stats(context)
+            stats.calls += 1
+            stats.record_latency(seconds)
+            stats.retries += (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            if http_response.status_code >= 300:
+                stats.errors += 1
+
+    def _call_failed(self, context, **kwargs):
+        """ The call raised before there was a response, e.g. it couldn't connect """
+        if "api_metrics_key" not in context:
+            return
+        seconds = time.perf_counter() - context["api_metrics_started"]
+        with self._lock:
+            stats = self._stats(context)
+            stats.calls += 1
+            stats.errors += 1
+            stats.record_latency(seconds)
+
+    def by_region(self):
+        """ {region name: (calls, seconds spent in calls)} """
+        regions = {}
+        for stats in self.operations.values():
+            calls, seconds = regions.get(stats.region_name, (0, 0.0))
+            regions[stats.region_name] = (calls + stats.calls, seconds + stats.total_seconds)
+        return regions
+
+    def summary(self):
+        """ One line per operation, slowest in total first, then one per region """
+        with self._lock:
+            operations = sorted(self.operations.values(), key=lambda stats: stats.total_seconds, reverse=True)
+            regions = self.by_region()
+        lines = [f"{'region':15} {'operation':38} {'calls':>5} {'errors':>6} {'retries':>7} {'throttles':>9} "
+                 f"{'total s':>8} {'mean ms':>8} {'p90 ms':>7} {'max ms':>7} {'sent KiB':>8} {'recv KiB':>8}"]
+        for stats in operations:
+            lines.append(f"{stats.region_name:15} {stats.service_name + '.' + stats.operation_name:38} {stats.calls:5} "
+                         f"{stats.errors:6} {stats.retries:7} {stats.throttles:9} {stats.total_seconds:8.2f} "
+                         f"{stats.mean_seconds * 1000:8.0f} {stats.percentile_ms(0.9):7.0f} "
+                         f"{stats.max_seconds * 1000:7.0f} {stats.bytes_sent / 1024:8.1f} "
+                         f"{stats.bytes_received / 1024:8.1f}")
+        for region_name, (calls, seconds) in sorted(regions.items(), key=lambda item: item[1][1], reverse=True):
+            lines.append(f"{region_name:15} {'all operations':38} {calls:5} {'':6} {'':7} {'':9} {seconds:8.2f}")
+        lines.append(f"{sum(calls for calls, _ in regions.values())} AWS calls in "
+                     f"{time.monotonic() - self.started:.1f}s")
+        return lines
+
+    def as_json(self):
+        with self._lock:
+            return {
+                "wall_seconds": time.monotonic() - self.started,
+                "operations": [stats.as_json() for stats in self.operations.values()],
+                "regions": {region_name: {"calls": calls, "seconds": seconds}
+                            for region_name, (calls, seconds) in self.by_region().items()},
+            }
+
+    def report(self, output="-"):
+        """ Print the summary to stderr, or write the json to the file named by output """
+        if output == "-":
+            print("\n".join(self.summary()), file=sys.stderr)
+        else:
+            with open(output, "w") as f:
+                json.dump(self.as_json(), f, indent=2)
@@ -0,0 +1,76 @@
+"""
+One boto3 client per (profile, region, service) for the whole process.
+Creating a client is slow and each one opens its own pool of HTTP connections, so every module gets its clients from here.
+The clients are thread-safe once created, and can be shared by the worker threads of a parallel fan-out.
+All their calls go through one RequestScheduler, which keeps each service and region under the rate AWS accepts.
+"""
+import os
+import threading
+
+from request_scheduler import RequestScheduler
+
+# enough connections for every worker of a parallel fan-out to talk to the same region at once
+DEFAULT_MAX_POOL_CONNECTIONS = int(os.environ.get("ENSEMBLE_MACHINE_MAX_POOL_CONNECTIONS", 32))
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+_instruments = []
+_scheduler = RequestScheduler()
+_max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+
+
+def configure(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    """ Change the connection pool size. Clients created before this call are dropped and created again on next use. """
+    global _max_pool_connections
+    with _lock:
+        _max_pool_connections = max_pool_connections
+        _clients.clear()
+
+
+def session(profile_name=None):
+    """ boto3 sessions aren't thread-safe, so only use this one while holding the lock or from a single thread """
+    with _lock:
+        if profile_name not in _sessions:
+            import boto3
+            _sessions[profile_name] = boto3.Session(profile_name=profile_name)
+        return _sessions[profile_name]
+
+
+def client(service_name, region_name=None, profile_name=None):
+    key = (profile_name, region_name, service_name)
+    with _lock:
+        if key not in _clients:
+            from botocore.config import Config
+            config = Config(max_pool_connections=_max_pool_connections)
+            _clients[key] = session(profile_name).client(service_name, region_name=region_name, config=config)
+            _scheduler.attach(_clients[key])
+            for metrics in _instruments:
+                metrics.attach(_clients[key])
+        return _clients[key]
+
+
+def scheduler():
+    return _scheduler
+
+
+def instrument(metrics):
+    """ Attach metrics, e.g. an api_metrics.ApiMetrics, to every client - the ones already created and all later ones """
+    with _lock:
+        _instruments.append(metrics)
+        for existing in _clients.values():
+            metrics.attach(existing)
+
+
+def uninstrument(metrics):
+    with _lock:
+        if metrics in _instruments:
+            _instruments.remove(metrics)
+            for existing in _clients.values():
+                metrics.detach(existing)
+
+
+def clear():
+    with _lock:
+        _clients.clear()
+        _sessions.clear()
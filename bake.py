@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Bake one machine image per IDE config, with everything generate_script would install already in place.
+summon.py starts rooms from these images, so at boot a machine only has to set its hostname,
+its nginx server_name and get its certificate.
+
+The image ids are recorded in aws_images.json, next to aws_zones.json. An image is baked again when
+the IDE config, the provisioning script or the region's plain image changes.
+"""
+import datetime
+import json
+import logging
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+
+import aws_clients
+from cli_options import ConfigDependentOption, ide_config_names, region_names
+from configuration import configuration, BAKED_IMAGES_FILE
+from summon import generate_provisioning_script, provisioning_hash, run_instances_arguments
+
+# projector autoinstall downloads a whole IDE, so give the builder plenty of time
+BUILDER_TIMEOUT = 45 * 60
+
+_images_file_lock = threading.Lock()
+
+
+def bake_script(machine_config):
+    """ The provisioning script, ending with a shutdown so the builder stops once it has succeeded """
+    return generate_provisioning_script(**machine_config) + "\nsudo shutdown -h now\n"
+
+
+def images_to_bake(config, config_names, region_names, force=False):
+    """ (config_name, region_name, hash) for every image that is missing or out of date """
+    stale = []
+    for region_name in region_names:
+        for config_name in config_names:
+            image_hash = provisioning_hash(config.ide_config(config_name), config.region(region_name)["image_id"])
+            baked_image = config.baked_image(region_name, config_name)
+            if force or not baked_image or baked_image["hash"] != image_hash:
+                stale.append((config_name, region_name, image_hash))
+    return stale
+
+
+def bake_image(ec2, machine_config, region_config, aws_defaults, image_hash, timeout=BUILDER_TIMEOUT):
+    """ Provision a builder instance, make an image of it once it has shut itself down, and return the record for it """
+    log = logging.getLogger(__name__)
+    config_name = machine_config["config_name"]
+    image_name = f"ensemble-machine-{config_name}-{image_hash[:12]}"
+    tags = [
+        {'Key': 'Name', 'Value': f"bake-{image_name}"},
+        {'Key': aws_defaults["coach_tag"], 'Value': "bake.py"},
+    ]
+    response = ec2.run_instances(**run_instances_arguments(1, tags, bake_script(machine_config), region_config, aws_defaults))
+    builder_id = response["Instances"][0]["InstanceId"]
+    log.info(f"baking {image_name} on {builder_id}")
+    try:
+        waiter_config = {"Delay": 30, "MaxAttempts": timeout // 30}
+        ec2.get_waiter("instance_stopped").wait(InstanceIds=[builder_id], WaiterConfig=waiter_config)
+        image = ec2.create_image(
+            InstanceId=builder_id,
+            Name=image_name,
+            Description=f"{machine_config['name']} for ensemble machines",
+            TagSpecifications=[{'ResourceType': 'image', 'Tags': [
+                {'Key': 'EnsembleConfig', 'Value': config_name},
+                {'Key': 'EnsembleProvisioningHash', 'Value': image_hash},
+            ]}],
+        )
+        ec2.get_waiter("image_available").wait(ImageIds=[image["ImageId"]], WaiterConfig=waiter_config)
+    finally:
+        ec2.terminate_instances(InstanceIds=[builder_id])
+    log.info(f"baked {image_name} as {image['ImageId']}")
+    return {
+        "image_id": image["ImageId"],
+        "hash": image_hash,
+        "base_image_id": region_config["image_id"],
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def record_baked_image(path, profile_name, region_name, config_name, record):
+    """ Store the record in the images file, and return the record it replaced, if any """
+    with _images_file_lock:
+        images = json.loads(path.read_text()) if path.exists() else {}
+        region_images = images.setdefault(profile_name, {}).setdefault(region_name, {})
+        replaced = region_images.get(config_name)
+        region_images[config_name] = record
+        path.write_text(json.dumps(images, indent=4) + "\n")
+    return replaced
+
+
+@click.command()
+@click.option(
+    "--config-name",
+    cls=ConfigDependentOption,
+    multiple=True,
+    help="the configs to bake an image for, default all of them",
+    help_from=ide_config_names,
+)
+@click.option(
+    "--region-name",
+    cls=ConfigDependentOption,
+    multiple=True,
+    help="the aws regions to bake images in, default all of them",
+    help_from=region_names,
+)
+@click.option(
+    "--aws-profile",
+    default="default",
+    help="the aws profile, if you don't use the default"
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="bake new images even where the existing ones are up to date"
+)
+@click.option(
+    "--deregister-old/--keep-old",
+    default=False,
+    help="deregister the images that the new ones replace"
+)
+@click.option(
+    "--max-parallel",
+    default=4,
+    help="how many images to bake at the same time"
+)
+def bake(config_name, region_name, aws_profile, force, deregister_old, max_parallel):
+    logging.basicConfig(level=logging.INFO)
+    config = configuration(aws_profile)
+    config_names = config_name or list(config.ide_configs)
+    region_names_to_bake = region_name or config.region_names()
+    images_file = pathlib.Path(config.directory) / BAKED_IMAGES_FILE
+
+    stale = images_to_bake(config, config_names, region_names_to_bake, force)
+    if not stale:
+        print("All images are up to date")
+        return
+
+    def bake_and_record(config_name, region_name, image_hash):
+        ec2 = aws_clients.client("ec2", region_name, aws_profile)
+        record = bake_image(ec2, config.ide_config(config_name), config.region(region_name), config.aws_defaults, image_hash)
+        replaced = record_baked_image(images_file, aws_profile, region_name, config_name, record)
+        if deregister_old and replaced:
+            ec2.deregister_image(ImageId=replaced["image_id"])
+        return record
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        futures = {executor.submit(bake_and_record, *image): image for image in stale}
+        for future in as_completed(futures):
+            config_name, region_name, _ = futures[future]
+            try:
+                print(f"{config_name} in {region_name}: {future.result()['image_id']}")
+            except Exception as e:
+                print(f"ERROR: couldn't bake {config_name} in {region_name}: {e}")
+
+
+if __name__ == "__main__":
+    bake()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+How long summon, instances, update_dns and clone_kata take for classrooms of different sizes spread over
+different numbers of regions, run against the in-memory AWS in fake_aws.py instead of the real thing.
+For each scenario it reports the wall-clock time, the number of AWS calls and the peak memory,
+and compares them with the baselines stored by an earlier run with --save-baseline on the same machine.
+The baselines aren't committed, since the times depend on the machine: save them before making a change,
+then run again to see what it did.
+
+    python benchmarks/control_plane.py --rooms 1,10,50,200 --regions 1,3 --latency 0.05 --throttle-rate 0.05
+"""
+import atexit
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+
+import click
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from benchmarks.fake_aws import FakeAws
+
+BASELINES_FILE = REPO_ROOT / "benchmarks" / "baselines.json"
+PROFILE_NAME = "benchmark"
+REGION_NAMES = ["eu-north-1", "eu-central-1", "ca-central-1", "us-east-1", "ap-southeast-2"]
+URL_STEM = "codekata.proagile.link"
+SCENARIOS = ["summon", "instances", "update_dns", "clone_kata"]
+
+IDE_CONFIG = {"idea": {"name": "IntelliJ IDEA Community Edition 2021.2.3", "extra_packages": [],
+                       "snap_packages": [], "environment": {}}}
+
+
+@dataclass
+class Measurement:
+    scenario: str
+    rooms: int
+    regions: int
+    latency: float
+    throttle_rate: float
+    seconds: float
+    api_calls: int
+    throttled: int
+    peak_memory_kb: float
+
+    @property
+    def key(self):
+        return (f"{self.scenario}/{self.rooms} rooms/{self.regions} regions/"
+                f"{self.latency}s latency/{self.throttle_rate} throttled")
+
+
+class FakeSsh:
+    """ A transport for RemoteExecutor that takes latency seconds per machine and always succeeds """
+    def __init__(self, latency):
+        self.latency = latency
+
+    def run(self, machine, commandline, timeout):
+        time.sleep(self.latency)
+        return 0, "", ""
+
+
+class FakeAwsDispatcher:
+    """ Installed once in the benchmark's boto3 session, so that its clients are only created once per process,
+    and passes every call on to the FakeAws of the scenario being run """
+    def __init__(self):
+        self.fake_aws = None
+        self.session = None
+
+    def install(self, session):
+        self.session = session
+        session.events.register("before-parameter-build", self.remember_params)
+        session.events.register("before-call", self.respond)
+
+    def remember_params(self, **kwargs):
+        return self.fake_aws.remember_params(**kwargs)
+
+    def respond(self, **kwargs):
+        return self.fake_aws.respond(**kwargs)
+
+
+_directory = None
+_dispatcher = None
+
+
+def benchmark_directory():
+    """ One directory for the config files of every scenario in this process, since configuration()
+    remembers where it found them """
+    global _directory
+    if _directory is None:
+        _directory = pathlib.Path(tempfile.mkdtemp(prefix="ensemble-machine-benchmark-"))
+        atexit.register(shutil.rmtree, _directory, ignore_errors=True)
+    return _directory
+
+
+@contextlib.contextmanager
+def benchmark_environment(fake_aws):
+    """ Config files, an aws profile and a cache directory in the benchmark directory,
+    and boto3 clients that talk to fake_aws """
+    global _dispatcher
+    import aws_clients
+    directory = benchmark_directory()
+    (directory / "aws").write_text(f"[profile {PROFILE_NAME}]\nregion = {REGION_NAMES[0]}\n"
+                                   "aws_access_key_id = fake\naws_secret_access_key = fake\n")
+    saved_environment = {name: os.environ.get(name)
+                         for name in ["AWS_CONFIG_FILE", "AWS_SHARED_CREDENTIALS_FILE", "XDG_CACHE_HOME"]}
+    saved_directory = os.getcwd()
+    os.environ.update(AWS_CONFIG_FILE=str(directory / "aws"), AWS_SHARED_CREDENTIALS_FILE=str(directory / "none"),
+                      XDG_CACHE_HOME=str(directory / "cache"))
+    os.chdir(directory)
+    try:
+        if _dispatcher is None:
+            _dispatcher = FakeAwsDispatcher()
+        # aws_clients.clear() drops the session, e.g. between tests
+        if _dispatcher.session is not aws_clients.session(PROFILE_NAME):
+            _dispatcher.install(aws_clients.session(PROFILE_NAME))
+            # creating clients takes longer than most scenarios, and every real command pays for it the same way
+            for region_name in REGION_NAMES:
+                for service_name in ["ec2", "service-quotas", "route53"]:
+                    aws_clients.client(service_name, region_name, PROFILE_NAME)
+        _dispatcher.fake_aws = fake_aws
+        # every command starts with full token buckets
+        aws_clients.scheduler().reset()
+        yield
+    finally:
+        os.chdir(saved_directory)
+        for name, value in saved_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def write_config(directory, region_count):
+    """ Configuration for region_count regions. Each write gets a later mtime, so configuration() notices it. """
+    directory = pathlib.Path(directory)
+    regions = {region_name: {"image_id": "ami-0benchmark", "security_group_ids": ["sg-0benchmark"],
+                             "key_name": f"pem-{region_name}"}
+               for region_name in REGION_NAMES[:region_count]}
+    machine_spec = {"region": REGION_NAMES[0], "instance_type": "t3.large", "volume_type": "gp2", "volume_size": 16,
+                    "coach_tag": "SammanCoach", "url_stem": URL_STEM, "hosted_dns_zone_id": "/hostedzone/ZFAKEAWS",
+                    "hosted_dns_zone_name": "proagile.link."}
+    files = {"ide_config.json": IDE_CONFIG, "aws_zones.json": {PROFILE_NAME: regions},
+             "aws_machine_spec.json": {PROFILE_NAME: machine_spec}}
+    mtime = time.time_ns()
+    for filename, contents in files.items():
+        path = directory / filename
+        path.write_text(json.dumps(contents))
+        os.utime(path, ns=(mtime, mtime))
+    return list(regions)
+
+
+def existing_classroom(fake_aws, rooms, region_names):
+    """ rooms running machines spread over the regions, and DNS records that are out of date for half of them """
+    for room in range(1, rooms + 1):
+        name = f"idea-c7f3aa50-{room}.{URL_STEM}"
+        instance_id = fake_aws.add_instance(region_names[room % len(region_names)], name, "benchmark")
+        ip_address = fake_aws.instances[instance_id]["PublicIpAddress"]
+        fake_aws.records[name] = ip_address if room % 2 else "10.255.255.255"
+
+
+def run_summon(rooms, region_names):
+    import aws_clients
+    from configuration import configuration
+    from summon import ProjectorInstance, launch_classroom
+    from update_dns import DnsUpdater
+    from wrap_ec2_client import AddressWaiter
+
+    config = configuration(PROFILE_NAME)
+    instances = [ProjectorInstance("idea", f"idea-b3nch000-{room}.{URL_STEM}", "benchmark",
+                                   region_names[room % len(region_names)], room) for room in range(1, rooms + 1)]
+    launch_classroom(instances, config)
+    instance_ids_by_client = [(aws_clients.client("ec2", region_name, PROFILE_NAME),
+                               [i.instance_id for i in instances if i.region_name == region_name])
+                              for region_name in region_names]
+    waiter = AddressWaiter(instance_ids_by_client, first_delay=0.05)
+    DnsUpdater(config.aws_defaults, region_names, PROFILE_NAME).update_dns_records_when_addressed(waiter)
+
+
+def run_instances(rooms, region_names):
+    from instances import all_instances
+    assert len(all_instances("all", PROFILE_NAME)) == rooms
+
+
+def run_update_dns(rooms, region_names):
+    from configuration import configuration
+    from update_dns import DnsUpdater
+    config = configuration(PROFILE_NAME)
+    DnsUpdater(config.aws_defaults, region_names, PROFILE_NAME).update_ensemble_machine_dns_records()
+
+
+def run_clone_kata(rooms, region_names, ssh_latency=0.05):
+    from clone_kata import machines_in_regions, clone_kata_commandline
+    from remote import RemoteExecutor
+    machines = machines_in_regions(PROFILE_NAME, None, None, None, "all", fresh=True)
+    results = RemoteExecutor(FakeSsh(ssh_latency)).run(clone_kata_commandline("https://github.com/emilybache/starter.git"),
+                                                       machines)
+    assert len(results) == rooms
+
+
+SCENARIO_RUNNERS = {
+    "summon": run_summon,
+    "instances": run_instances,
+    "update_dns": run_update_dns,
+    "clone_kata": run_clone_kata,
+}
+
+
+def measure(scenario, rooms, region_count, latency=0.0, throttle_rate=0.0, seed=0):
+    """ Run one scenario against a fresh FakeAws: once for the time and call counts, once more for the peak memory """
+    def run(fake_aws):
+        with benchmark_environment(fake_aws):
+            region_names = write_config(benchmark_directory(), region_count)
+            if scenario != "summon":
+                existing_classroom(fake_aws, rooms, region_names)
+            fake_aws.reset_counts()
+            start = time.perf_counter()
+            SCENARIO_RUNNERS[scenario](rooms, region_names)
+            return time.perf_counter() - start
+
+    fake_aws = FakeAws(latency=latency, throttle_rate=throttle_rate, seed=seed)
+    seconds = run(fake_aws)
+    tracemalloc.start()
+    try:
+        run(FakeAws(latency=latency, throttle_rate=throttle_rate, seed=seed))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Measurement(scenario, rooms, region_count, latency, throttle_rate, seconds, sum(fake_aws.calls.values()),
+                       sum(fake_aws.throttled.values()), peak / 1024)
+
+
+def regressions(measurements, baselines, tolerance):
+    """ Descriptions of the measurements that are slower than their baseline by more than tolerance,
+    or make more AWS calls than it did - not counting throttled attempts, which depend on how the threads ran """
+    found = []
+    for measurement in measurements:
+        baseline = baselines.get(measurement.key)
+        if not baseline:
+            continue
+        if measurement.seconds > baseline["seconds"] * (1 + tolerance):
+            found.append(f"{measurement.key}: {measurement.seconds:.3f}s, baseline {baseline['seconds']:.3f}s")
+        calls = measurement.api_calls - measurement.throttled
+        baseline_calls = baseline["api_calls"] - baseline["throttled"]
+        if calls > baseline_calls:
+            found.append(f"{measurement.key}: {calls} AWS calls, baseline {baseline_calls}")
+    return found
+
+
+def integers(text):
+    return [int(value) for value in text.split(",")]
+
+
+@click.command()
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS),
+              help="the scenarios to run, default all of them")
+@click.option("--rooms", default="1,10,50,200", help="comma separated classroom sizes")
+@click.option("--regions", default="1,3", help="comma separated numbers of regions to spread each classroom over")
+@click.option("--latency", default=0.05, help="seconds each AWS call takes")
+@click.option("--throttle-rate", default=0.0, help="the chance that an AWS call is throttled and has to be retried")
+@click.option("--seed", default=0, help="seed for the throttling, so runs are repeatable")
+@click.option("--save-baseline", is_flag=True, help="store these measurements as the baselines to compare with")
+@click.option("--tolerance", default=0.25, help="how much slower than its baseline a scenario may be")
+def main(scenarios, rooms, regions, latency, throttle_rate, seed, save_baseline, tolerance):
+    logging.disable(logging.ERROR)
+    baselines = json.loads(BASELINES_FILE.read_text()) if BASELINES_FILE.exists() else {}
+    if not baselines and not save_baseline:
+        print(f"no baselines in {BASELINES_FILE} to compare with, run with --save-baseline first")
+    measurements = []
+    print(f"{'scenario':12} {'rooms':>5} {'regions':>7} {'seconds':>8} {'calls':>6} {'throttled':>9} {'peak KiB':>9} "
+          f"{'vs baseline':>11}")
+    for scenario in scenarios or SCENARIOS:
+        for region_count in integers(regions):
+            for room_count in integers(rooms):
+                m = measure(scenario, room_count, region_count, latency, throttle_rate, seed)
+                measurements.append(m)
+                baseline = baselines.get(m.key)
+                versus = f"{m.seconds / baseline['seconds']:10.2f}x" if baseline and baseline["seconds"] else "-"
+                print(f"{m.scenario:12} {m.rooms:5} {m.regions:7} {m.seconds:8.3f} {m.api_calls:6} {m.throttled:9} "
+                      f"{m.peak_memory_kb:9.0f} {versus:>11}")
+
+    if save_baseline:
+        baselines.update({m.key: asdict(m) for m in measurements})
+        BASELINES_FILE.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"saved baselines to {BASELINES_FILE}")
+        return
+    found = regressions(measurements, baselines, tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""
+An in-memory stand-in for the parts of EC2, Service Quotas and Route53 these scripts use.
+It hooks into a boto3 session's events, so the real boto3 clients, paginators and waiters all run -
+only the HTTP request is replaced by a call to a method named after the operation.
+
+Every attempt at a call sleeps for the injected latency. A throttled attempt is retried after a backoff,
+the way botocore's retry handler would, until max_attempts is used up and the call fails with Throttling.
+The client's response-received handlers see every attempt, as they would with botocore.
+"""
+import copy
+import datetime
+import fnmatch
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+RECORD_SETS_PAGE_SIZE = 300
+# MiB of memory and vCPUs - every other instance type is the size of a t3.large
+INSTANCE_TYPE_SIZES = {"t3.xlarge": (16384, 4), "m5.xlarge": (16384, 4), "t3.2xlarge": (32768, 8),
+                       "m5.2xlarge": (32768, 8)}
+
+
+class FakeHttpResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+
+class FakeAwsError(Exception):
+    def __init__(self, code, message, status_code=400):
+        super().__init__(message)
+        self.code = code
+        self.status_code = status_code
+
+
+class FakeAws:
+    def __init__(self, latency=0.0, throttle_rate=0.0, max_attempts=3, backoff=0.05, boot_seconds=0.0, seed=0,
+                 rate_limits=None, vcpu_quotas=None, no_capacity=(), hosted_zone_id="/hostedzone/ZFAKEAWS",
+                 subnet_zones=None):
+        """ Arguments:
+        - latency - seconds every attempt at a call takes
+        - throttle_rate - the chance that an attempt is throttled
+        - rate_limits - {service name: (calls per second, burst)}. Like AWS, an attempt is throttled when
+          the service's bucket in that region is empty. Route53's bucket is shared by all regions.
+        - vcpu_quotas - {region name: the vCPU quota there}, for regions that shouldn't have plenty
+        - no_capacity - (region name, instance type, subnet id or None) that run_instances has no capacity for
+        - hosted_zone_id - the id of the one hosted zone, which changes when the zone is created again
+        - subnet_zones - {subnet id: the availability zone it is in}. Without a subnet, instances go to zone a.
+        - max_attempts, backoff - a throttled attempt waits a random time up to backoff * 2 ** attempt before the next
+        - boot_seconds - how long a launched or started instance is pending before it is running with an ip address
+        """
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.boot_seconds = boot_seconds
+        self.random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self.instances = {}
+        self.records = {}
+        self.rate_limits = rate_limits or {}
+        self.vcpu_quotas = vcpu_quotas or {}
+        self.no_capacity = set(no_capacity)
+        self.hosted_zone_id = hosted_zone_id
+        self.subnet_zones = subnet_zones or {}
+        self._buckets = {}
+        self.calls = Counter()
+        self.throttled = Counter()
+
+    def install(self, session):
+        """ Answer every call made by clients created from this boto3 session from now on """
+        session.events.register("before-parameter-build", self.remember_params)
+        session.events.register("before-call", self.respond)
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    def add_instance(self, region_name, name, coach, coach_tag="SammanCoach", state="running",
+                     instance_type="t3.large"):
+        """ An ensemble machine that already exists, as summon would have left it """
+        with self._lock:
+            tags = [{"Key": "Name", "Value": name}, {"Key": coach_tag, "Value": coach}]
+            instance = self._new_instance(region_name, tags, instance_type)
+            instance["State"]["Name"] = state
+            if state == "running":
+                instance["PublicIpAddress"] = self._ip_address(instance)
+            return instance["InstanceId"]
+
+    def remember_params(self, params, context, **kwargs):
+        context["fake_aws_params"] = params
+
+    def respond(self, model, context, request_signer=None, **kwargs):
+        service_name = model.service_model.service_name
+        key = f"{service_name}.{model.name}"
+        operation = getattr(self, f"{service_name.replace('-', '_')}_{model.name}", None)
+        if operation is None:
+            raise NotImplementedError(f"FakeAws doesn't implement {key}")
+        for attempt in range(1, self.max_attempts + 1):
+            time.sleep(self.latency)
+            with self._lock:
+                self.calls[key] += 1
+                throttled = self.random.random() < self.throttle_rate or self._over_rate_limit(service_name,
+                                                                                               context["client_region"])
+                if throttled:
+                    self.throttled[key] += 1
+                delay = self.random.random() * self.backoff * 2 ** attempt
+            if not throttled:
+                try:
+                    with self._lock:
+                        parsed = operation(context["client_region"], **context["fake_aws_params"])
+                    parsed["ResponseMetadata"] = {"HTTPStatusCode": 200, "RetryAttempts": attempt - 1}
+                    return self._received(request_signer, model, context, FakeHttpResponse(200), parsed)
+                except FakeAwsError as e:
+                    return self._received(request_signer, model, context, FakeHttpResponse(e.status_code),
+                                          {"Error": {"Code": e.code, "Message": str(e)}})
+            throttling = {"Error": {"Code": "Throttling", "Message": "Rate exceeded"}}
+            if attempt == self.max_attempts:
+                return self._received(request_signer, model, context, FakeHttpResponse(400), throttling)
+            self._received(request_signer, model, context, FakeHttpResponse(400), throttling)
+            time.sleep(delay)
+
+    @staticmethod
+    def _received(request_signer, model, context, http_response, parsed):
+        """ Tell the client's handlers about an attempt's response, the way botocore does for every attempt """
+        if request_signer is not None:
+            request_signer._event_emitter.emit(
+                f"response-received.{model.service_model.service_id.hyphenize()}.{model.name}",
+                response_dict=None, parsed_response=parsed, context=context, exception=None)
+        return http_response, parsed
+
+    def _over_rate_limit(self, service_name, region_name):
+        if service_name not in self.rate_limits:
+            return False
+        rate, burst = self.rate_limits[service_name]
+        key = (service_name, None if service_name == "route53" else region_name)
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return True
+        self._buckets[key] = (tokens - 1, now)
+        return False
+
+    # EC2
+
+    def ec2_RunInstances(self, region_name, MinCount, MaxCount, TagSpecifications=(), InstanceType="t3.large",
+                         SubnetId=None, **kwargs):
+        if (region_name, InstanceType, SubnetId) in self.no_capacity:
+            raise FakeAwsError("InsufficientInstanceCapacity",
+                               f"We currently do not have sufficient {InstanceType} capacity in the Availability Zone "
+                               f"you requested", status_code=500)
+        tags = [tag for spec in TagSpecifications if spec["ResourceType"] == "instance" for tag in spec["Tags"]]
+        availability_zone = self.subnet_zones.get(SubnetId, f"{region_name}a")
+        instances = [self._new_instance(region_name, tags, InstanceType, launch_index, availability_zone)
+                     for launch_index in range(MaxCount)]
+        return {"Instances": copy.deepcopy(instances)}
+
+    def ec2_DescribeInstances(self, region_name, Filters=(), InstanceIds=(), NextToken=None, MaxResults=None, **kwargs):
+        unknown = [instance_id for instance_id in InstanceIds if instance_id not in self.instances]
+        if unknown:
+            raise FakeAwsError("InvalidInstanceID.NotFound", f"The instance IDs '{', '.join(unknown)}' do not exist")
+        matching = [instance for instance in self._in_region(region_name, InstanceIds)
+                    if all(self._matches(instance, f) for f in Filters)]
+        start = int(NextToken or 0)
+        page_size = MaxResults or DESCRIBE_INSTANCES_PAGE_SIZE
+        response = {"Reservations": [{"Instances": copy.deepcopy(matching[start:start + page_size])}]}
+        if start + page_size < len(matching):
+            response["NextToken"] = str(start + page_size)
+        return response
+
+    def ec2_CreateTags(self, region_name, Resources, Tags):
+        for instance_id in Resources:
+            instance = self.instances[instance_id]
+            keys = {tag["Key"] for tag in Tags}
+            instance["Tags"] = [tag for tag in instance["Tags"] if tag["Key"] not in keys] + list(Tags)
+        return {}
+
+    def ec2_DeleteTags(self, region_name, Resources, Tags):
+        keys = {tag["Key"] for tag in Tags}
+        for instance_id in Resources:
+            instance = self.instances[instance_id]
+            instance["Tags"] = [tag for tag in instance["Tags"] if tag["Key"] not in keys]
+        return {}
+
+    def ec2_StartInstances(self, region_name, InstanceIds, **kwargs):
+        return {"StartingInstances": self._change_state(InstanceIds, "pending")}
+
+    def ec2_StopInstances(self, region_name, InstanceIds, **kwargs):
+        return {"StoppingInstances": self._change_state(InstanceIds, "stopped")}
+
+    def ec2_TerminateInstances(self, region_name, InstanceIds, **kwargs):
+        return {"TerminatingInstances": self._change_state(InstanceIds, "terminated")}
+
+    def ec2_DescribeInstanceTypes(self, region_name, InstanceTypes, **kwargs):
+        sizes = {instance_type: INSTANCE_TYPE_SIZES.get(instance_type, (8192, 2)) for instance_type in InstanceTypes}
+        return {"InstanceTypes": [{"InstanceType": instance_type,
+                                   "MemoryInfo": {"SizeInMiB": memory_mb},
+                                   "VCpuInfo": {"DefaultVCpus": vcpus}}
+                                  for instance_type, (memory_mb, vcpus) in sizes.items()]}
+
+    # Service Quotas
+
+    def service_quotas_GetServiceQuota(self, region_name, ServiceCode, QuotaCode):
+        return {"Quota": {"ServiceCode": ServiceCode, "QuotaCode": QuotaCode,
+                          "Value": float(self.vcpu_quotas.get(region_name, 100000))}}
+
+    # Route53 - a single hosted zone
+
+    def route53_ListHostedZones(self, region_name, **kwargs):
+        zone = {"Id": self.hosted_zone_id, "Name": "proagile.link.", "CallerReference": "fake-aws"}
+        return {"HostedZones": [zone], "IsTruncated": False, "Marker": "", "MaxItems": "100"}
+
+    def route53_ListResourceRecordSets(self, region_name, HostedZoneId, StartRecordName=None, **kwargs):
+        self._check_hosted_zone(HostedZoneId)
+        names = sorted(self.records)
+        start = names.index(StartRecordName) if StartRecordName in self.records else 0
+        page = names[start:start + RECORD_SETS_PAGE_SIZE]
+        response = {
+            "ResourceRecordSets": [{"Name": f"{name}.", "Type": "A", "TTL": 300,
+                                    "ResourceRecords": [{"Value": self.records[name]}]} for name in page],
+            "IsTruncated": start + RECORD_SETS_PAGE_SIZE < len(names),
+            "MaxItems": str(RECORD_SETS_PAGE_SIZE),
+        }
+        if response["IsTruncated"]:
+            response["NextRecordName"] = names[start + RECORD_SETS_PAGE_SIZE]
+            response["NextRecordType"] = "A"
+        return response
+
+    def route53_ChangeResourceRecordSets(self, region_name, HostedZoneId, ChangeBatch):
+        self._check_hosted_zone(HostedZoneId)
+        for change in ChangeBatch["Changes"]:
+            record_set = change["ResourceRecordSet"]
+            name = record_set["Name"].rstrip(".")
+            if change["Action"] == "DELETE":
+                self.records.pop(name, None)
+            else:
+                self.records[name] = record_set["ResourceRecords"][0]["Value"]
+        return {"ChangeInfo": self._change_info("PENDING")}
+
+    def route53_GetChange(self, region_name, Id):
+        return {"ChangeInfo": self._change_info("INSYNC", Id)}
+
+    def _check_hosted_zone(self, zone_id):
+        if zone_id.split("/")[-1] != self.hosted_zone_id.split("/")[-1]:
+            raise FakeAwsError("NoSuchHostedZone", f"No hosted zone found with ID: {zone_id.split('/')[-1]}",
+                               status_code=404)
+
+    def _change_info(self, status, change_id=None):
+        return {"Id": change_id or f"/change/C{next(self._ids)}", "Status": status,
+                "SubmittedAt": datetime.datetime.now(datetime.timezone.utc)}
+
+    def _new_instance(self, region_name, tags, instance_type="t3.large", launch_index=0, availability_zone=None):
+        number = next(self._ids)
+        instance = {
+            "InstanceId": f"i-{number:017x}",
+            "InstanceType": instance_type,
+            "AmiLaunchIndex": launch_index,
+            "State": {"Name": "pending"},
+            "Tags": list(tags),
+            "Placement": {"AvailabilityZone": availability_zone or f"{region_name}a"},
+            "PrivateIpAddress": f"172.31.{number // 256 % 256}.{number % 256}",
+            "CpuOptions": {"CoreCount": 1, "ThreadsPerCore": 2},
+            "BlockDeviceMappings": [{"DeviceName": "/dev/sda1", "Ebs": {
+                "AttachTime": datetime.datetime(2022, 1, 31, tzinfo=datetime.timezone.utc)}}],
+            "_region": region_name,
+            "_running_at": time.monotonic() + self.boot_seconds,
+        }
+        self.instances[instance["InstanceId"]] = instance
+        return instance
+
+    def _in_region(self, region_name, instance_ids):
+        instances = [self.instances[i] for i in instance_ids] if instance_ids else self.instances.values()
+        instances = [instance for instance in instances if instance["_region"] == region_name]
+        for instance in instances:
+            if instance["State"]["Name"] == "pending" and time.monotonic() >= instance["_running_at"]:
+                instance["State"]["Name"] = "running"
+                instance["PublicIpAddress"] = self._ip_address(instance)
+        return [{key: value for key, value in instance.items() if not key.startswith("_")} for instance in instances]
+
+    def _change_state(self, instance_ids, state):
+        changes = []
+        for instance_id in instance_ids:
+            instance = self.instances[instance_id]
+            previous = instance["State"]["Name"]
+            instance["State"] = {"Name": state}
+            instance.pop("PublicIpAddress", None)
+            instance["_running_at"] = time.monotonic() + self.boot_seconds
+            changes.append({"InstanceId": instance_id, "PreviousState": {"Name": previous},
+                            "CurrentState": {"Name": state}})
+        return changes
+
+    @staticmethod
+    def _ip_address(instance):
+        number = int(instance["InstanceId"][2:], 16)
+        return f"10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}"
+
+    @staticmethod
+    def _matches(instance, instance_filter):
+        name = instance_filter["Name"]
+        if name == "instance-state-name":
+            return instance["State"]["Name"] in instance_filter["Values"]
+        if name.startswith("tag:"):
+            key = name[len("tag:"):]
+            values = [tag["Value"] for tag in instance["Tags"] if tag["Key"] == key]
+            return any(fnmatch.fnmatchcase(value, pattern) for value in values for pattern in instance_filter["Values"])
+        raise NotImplementedError(f"FakeAws doesn't filter on {name}")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+How long each command takes to import, and which heavy libraries it pulls in while doing so.
+Every number is the best of several fresh interpreters, so it includes nothing cached in-process.
+It exits with 1 if any command takes longer than the budget to import.
+
+    python benchmarks/startup.py --runs 5
+"""
+import json
+import pathlib
+import subprocess
+import sys
+
+import click
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+ENTRY_POINTS = ["summon", "instances", "clone_kata", "em", "update_dns", "shutdown", "start_instances",
+                "classroom", "download_plugin"]
+
+# none of these should be imported until a command actually talks to AWS or to a machine
+HEAVY_MODULES = ["boto3", "botocore", "fabric", "paramiko"]
+# generous, so it is only exceeded when an import of boto3 or fabric creeps back in (that alone costs 100-300 ms)
+IMPORT_BUDGET_SECONDS = 0.5
+
+MEASURE_IMPORT = """\
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module, cwd=None):
+    """ import module in a fresh interpreter and return (seconds, heavy modules it imported) """
+    code = MEASURE_IMPORT.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], cwd=cwd or REPO_ROOT, capture_output=True, text=True,
+                            env={"PYTHONPATH": str(REPO_ROOT), "PATH": ""}, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result["seconds"], result["heavy"]
+
+
+@click.command()
+@click.option("--runs", default=5, help="how many fresh interpreters to time each entry point in")
+@click.option("--budget", default=IMPORT_BUDGET_SECONDS, help="the most seconds an entry point may take to import")
+def main(runs, budget):
+    print(f"{'entry point':16} {'import ms':>10}  heavy modules")
+    over_budget = []
+    for module in ENTRY_POINTS:
+        timings = [measure_import(module) for _ in range(runs)]
+        best = min(seconds for seconds, _ in timings)
+        print(f"{module:16} {best * 1000:10.1f}  {', '.join(timings[0][1]) or '-'}")
+        if best > budget:
+            over_budget.append(module)
+    for module in over_budget:
+        print(f"OVER BUDGET {module} takes longer than {budget * 1000:.0f} ms to import")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
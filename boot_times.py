@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Collect how long each phase of the user data script took on a session's machines, and report percentiles
+per config and region. The scripts summon.py generates record the phases on each machine, see RECORD_BOOT_PHASES.
+Only the latest boot of each machine counts, so a machine from a baked image or a warm pool reports
+the setup it did when it was claimed, not what happened when the image was made.
+"""
+import json
+import logging
+import math
+from collections import defaultdict
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
+
+import click
+
+from cli_options import ConfigDependentOption, region_names, remote_execution_options, fresh_option, profile_option
+from clone_kata import machines_in_regions
+from configuration import configuration, read_ide_config
+from remote import RemoteExecutor, FabricTransport, OpenSshTransport
+from summon import BOOT_PHASES_FILE
+
+TOTAL = "total"
+
+
+@dataclass
+class BootTimes:
+    machine: object
+    config_name: str
+    phases: dict = field(default_factory=dict)
+    unfinished: list = field(default_factory=list)
+    error: str = None
+
+
+def parse_boot_phases(text):
+    """ The seconds each phase took in the latest boot, in the order they started, and the phases that never ended.
+    The total is from the kernel starting until the last phase ended.
+    """
+    events = [line.split("\t") for line in text.splitlines() if line.count("\t") == 3]
+    if not events:
+        return {}, []
+    latest_boot = events[-1][0]
+    starts, ends = {}, {}
+    for boot_id, phase, event, timestamp in events:
+        if boot_id == latest_boot:
+            (starts if event == "start" else ends)[phase] = float(timestamp)
+    phases = {phase: ends[phase] - started for phase, started in sorted(starts.items(), key=lambda item: item[1])
+              if phase in ends}
+    if ends:
+        phases[TOTAL] = max(ends.values()) - min(starts.values())
+    return phases, [phase for phase in starts if phase not in ends]
+
+
+def config_name_of(url, config_names):
+    """ Machines are named {config_name}-{session id}[-{room}], and config names can have dashes in them too """
+    host_label = (urlparse(url).hostname or url).split(".")[0]
+    matching = [name for name in config_names if host_label.startswith(f"{name}-")]
+    return max(matching, key=len) if matching else host_label.split("-")[0]
+
+
+def percentile(values, fraction):
+    """ nearest-rank percentile """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def phase_percentiles(boot_times):
+    """ {(config name, region name): {phase: {count, p50, p90, max}}} for the machines that reported their phases """
+    durations = defaultdict(lambda: defaultdict(list))
+    for times in boot_times:
+        for phase, seconds in times.phases.items():
+            durations[(times.config_name, times.machine.region_name)][phase].append(seconds)
+    return {group: {phase: {"count": len(values), "p50": percentile(values, 0.5), "p90": percentile(values, 0.9),
+                            "max": max(values)}
+                    for phase, values in phases.items()}
+            for group, phases in sorted(durations.items())}
+
+
+def percentiles_table(percentiles):
+    lines = [f"{'config':12} {'region':15} {'phase':22} {'machines':>8} {'p50 s':>8} {'p90 s':>8} {'max s':>8}"]
+    for (config_name, region_name), phases in percentiles.items():
+        for phase, stats in phases.items():
+            lines.append(f"{config_name:12} {region_name:15} {phase:22} {stats['count']:8} {stats['p50']:8.1f} "
+                         f"{stats['p90']:8.1f} {stats['max']:8.1f}")
+    return lines
+
+
+def collect_boot_times(machines, executor, config_names, retries=0):
+    """ Read the phases file on every machine in parallel, and return a BootTimes for each """
+    collected = []
+    for result in executor.run(f"cat {BOOT_PHASES_FILE}", machines, retries=retries):
+        times = BootTimes(result.machine, config_name_of(result.machine.url, config_names))
+        if result.ok:
+            times.phases, times.unfinished = parse_boot_phases(result.stdout)
+        else:
+            times.error = result.error or result.stderr.strip() or result.status
+        collected.append(times)
+    return collected
+
+
+@click.command()
+@click.option(
+    "--region-name",
+    cls=ConfigDependentOption,
+    help="the aws region name, or 'all' for every configured region (default all)",
+    help_from=region_names,
+    default="all"
+)
+@click.option(
+    "--aws-profile",
+    default="default",
+    help="the aws profile, if you don't use the default"
+)
+@click.option(
+    "--coach",
+    help="only the running instances owned by this person",
+)
+@click.option(
+    "--classroom",
+    help="only the running instances in this classroom file",
+)
+@click.option(
+    "--json", "as_json", is_flag=True,
+    help="print the percentiles, and each machine's phases, as json"
+)
+@remote_execution_options
+@fresh_option
+@profile_option
+def main(region_name, aws_profile, coach, classroom, as_json, max_parallel, timeout, retries, persist_connections,
+         fresh):
+    logging.basicConfig(level=logging.WARNING)
+    machines = machines_in_regions(aws_profile, classroom, coach, None, region_name, fresh)
+    config = configuration(aws_profile)
+    transport = OpenSshTransport(config) if persist_connections else FabricTransport(config)
+    executor = RemoteExecutor(transport, max_workers=max_parallel, timeout=timeout)
+    boot_times = collect_boot_times(machines, executor, list(read_ide_config()), retries)
+    percentiles = phase_percentiles(boot_times)
+    if as_json:
+        print(json.dumps({
+            "percentiles": [{"config_name": config_name, "region_name": region_name, "phases": phases}
+                            for (config_name, region_name), phases in percentiles.items()],
+            "machines": [{"url": times.machine.url, "region_name": times.machine.region_name,
+                          "config_name": times.config_name, "phases": times.phases, "unfinished": times.unfinished,
+                          "error": times.error} for times in boot_times],
+        }, indent=2))
+        return
+    print("\n".join(percentiles_table(percentiles)))
+    for times in boot_times:
+        if times.error:
+            print(f"ERROR: no boot times from {times.machine.url}: {times.error}")
+        elif times.unfinished:
+            print(f"WARNING: {times.machine.url} never finished {', '.join(times.unfinished)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+A cache node is one machine per classroom and region that the rooms download through, so that thirty rooms
+booting at once fetch each apt package, the projector-installer wheel and the IDE archive from the internet once
+instead of thirty times. It runs
+- apt-cacher-ng, an apt proxy, on port 3142
+- devpi-server, a pip index that mirrors pypi, on port 3141
+- nginx caching the JetBrains downloads, on port 8081
+and downloads what the classroom's ide configs need as soon as it is up, while the rooms are still booting.
+
+summon.py --cache-node launches one and points the rooms' user data at it, see room_cache_steps.
+A room that can't reach its cache node in time downloads from the internet as usual.
+The rooms reach the cache node on its private address, so the security group has to allow
+ports 3141, 3142 and 8081 from itself.
+"""
+import logging
+from urllib.parse import urlparse
+
+import click
+
+import aws_clients
+from cli_options import ConfigDependentOption, region_names
+from configuration import configuration
+from region_executor import RegionExecutor
+from summon import Step, render_steps, script_header, run_with_fallback, apt_repository_commands, \
+    REQUIRED_PACKAGES, PROJECTOR_INSTALLER_VERSION
+
+CACHE_PORTS = {"apt": 3142, "pip": 3141, "archives": 8081}
+CACHE_NODE_NAME_PREFIX = "cache-"
+CACHE_NODE_TAG = "EnsembleCacheNode"
+CACHE_NODE_STATES = ["pending", "running", "stopping", "stopped"]
+# nginx fetches the archives from the CDN download.jetbrains.com redirects to, so the redirect isn't cached
+JETBRAINS_DOWNLOADS = "https://download-cdn.jetbrains.com/"
+# the rooms boot about as fast as the cache node, which then needs a minute or two to install the caches
+CACHE_WAIT_SECONDS = 300
+
+
+def cache_path(ide_archive_url):
+    """ Where the cache node serves an IDE archive, e.g. /jetbrains/idea/ideaIU-2021.2.tar.gz """
+    return "/jetbrains" + urlparse(ide_archive_url).path
+
+
+def room_cache_steps(cache_host, ide_archive_url=None, wait_seconds=CACHE_WAIT_SECONDS, ports=CACHE_PORTS):
+    """ The Steps that point a room's apt and pip at the cache node, and put the IDE archive where
+    projector-installer looks for it before downloading. The apt and projector steps come after these.
+    Once they are done apt and pip are pointed back at the internet, since the cache node is terminated
+    when the classroom is up, and participants install things in their rooms too.
+    Arguments:
+    - cache_host - the cache node's address
+    - ide_archive_url - the archive projector autoinstall downloads for this room's config, if it is known
+    - wait_seconds - how long to wait for the cache node to answer before downloading from the internet instead
+    - ports - the port of each cache on the cache node
+    """
+    apt_proxy = f"http://{cache_host}:{ports['apt']}"
+    pip_index = f"http://{cache_host}:{ports['pip']}"
+    steps = [Step("artifact-cache", f"""\
+CACHE_DEADLINE=$(( $(date +%s) + {wait_seconds} ))
+until curl -s -o /dev/null --max-time 5 {apt_proxy}/acng-report.html && \\
+      curl -s -o /dev/null --max-time 5 {pip_index}/+api; do
+  if [ "$(date +%s)" -ge "$CACHE_DEADLINE" ]; then
+    echo "no answer from the cache node at {cache_host}, downloading from the internet"
+    return 0
+  fi
+  sleep 5
+done
+echo 'Acquire::http::Proxy "{apt_proxy}";' | sudo tee /etc/apt/apt.conf.d/01ensemble-cache
+cat << PIP | sudo tee /etc/pip.conf
+[global]
+index-url = {pip_index}/root/pypi/+simple/
+trusted-host = {cache_host}
+PIP
+"""), Step("artifact-cache-cleanup", """\
+sudo rm -f /etc/apt/apt.conf.d/01ensemble-cache /etc/pip.conf
+""", after=("apt", "projector-installer"))]
+    if ide_archive_url:
+        archive_name = urlparse(ide_archive_url).path.split("/")[-1]
+        archive = f"/home/typist/.projector/cache/{archive_name}"
+        steps.append(Step("ide-archive", f"""\
+sudo -u typist mkdir -p /home/typist/.projector/cache
+if ! sudo -u typist curl -sfL --connect-timeout 5 -o {archive} \\
+    http://{cache_host}:{ports['archives']}{cache_path(ide_archive_url)}; then
+  echo "couldn't get {archive_name} from the cache node, projector will download it"
+  sudo rm -f {archive}
+fi
+""", after=("user", "artifact-cache")))
+    return steps
+
+
+def cache_node_steps(machine_configs, ports=CACHE_PORTS):
+    """ The Steps that install the three caches, and then fill them with what the machine configs install """
+    packages = sorted(set(REQUIRED_PACKAGES).union(*(config["extra_packages"] for config in machine_configs)))
+    apt_repositories = {repository["name"]: repository
+                        for config in machine_configs for repository in config.get("apt_repositories", ())}
+    archive_urls = sorted({config["ide_archive_url"] for config in machine_configs if config.get("ide_archive_url")})
+    steps = []
+    if apt_repositories:
+        steps.append(Step("apt-repositories", apt_repository_commands(apt_repositories.values())))
+    steps.append(Step("cache-packages", """\
+sudo apt update -y
+sudo DEBIAN_FRONTEND=noninteractive apt install -y apt-cacher-ng nginx python3-pip
+""", after=("apt-repositories",)))
+    steps.append(Step("pip-cache", f"""\
+sudo pip3 install devpi-server
+sudo devpi-init --serverdir /var/lib/devpi
+cat << SERVICE | sudo tee /lib/systemd/system/devpi.service
+[Unit]
+Description=devpi pypi mirror
+
+[Service]
+Type=simple
+ExecStart=/usr/local/bin/devpi-server --serverdir /var/lib/devpi --host 0.0.0.0 --port {ports['pip']}
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+SERVICE
+
+sudo systemctl daemon-reload
+sudo systemctl enable --now devpi
+""", after=("cache-packages",)))
+    steps.append(Step("archive-cache", f"""\
+cat << 'CONFIG' | sudo tee /etc/nginx/conf.d/ensemble-archives.conf
+proxy_cache_path /var/cache/nginx/archives levels=1:2 keys_zone=archives:10m max_size=8g inactive=30d
+                 use_temp_path=off;
+server {{
+  listen {ports['archives']};
+  location /jetbrains/ {{
+    proxy_pass {JETBRAINS_DOWNLOADS};
+    proxy_ssl_server_name on;
+    proxy_cache archives;
+    proxy_cache_valid 200 30d;
+    proxy_cache_lock on;
+    proxy_cache_lock_timeout 30m;
+    proxy_cache_lock_age 30m;
+    proxy_read_timeout 30m;
+    proxy_max_temp_file_size 4096m;
+  }}
+}}
+CONFIG
+sudo systemctl reload nginx
+""", after=("cache-packages",)))
+    # the rooms are booting too, so whatever they ask for before it is cached is downloaded once and shared
+    prewarm_archives = "".join(f"curl -s -o /dev/null http://localhost:{ports['archives']}{cache_path(url)} || true\n"
+                               for url in archive_urls)
+    steps.append(Step("prewarm", f"""\
+sudo apt-get clean
+sudo apt-get -o Acquire::http::Proxy=http://localhost:{ports['apt']} install -y --reinstall --download-only \\
+ {" ".join(packages)} || true
+pip3 download --no-deps -d "$(mktemp -d)" --index-url http://localhost:{ports['pip']}/root/pypi/+simple/ \\
+ projector-installer=={PROJECTOR_INSTALLER_VERSION} || true
+{prewarm_archives}""", after=("pip-cache", "archive-cache")))
+    return steps
+
+
+def generate_cache_node_script(machine_configs, ports=CACHE_PORTS):
+    """ The user data script for a cache node serving rooms with these machine configs """
+    return script_header() + render_steps(cache_node_steps(machine_configs, ports))
+
+
+def launch_cache_node(ec2, session_id, machine_configs, region_config, aws_defaults, region_name=None):
+    """ Start a cache node for the session, and return its private address - run_instances knows it straight away,
+    so the rooms can be launched without waiting for the cache node to come up.
+    aws_machine_spec.json can give cache nodes their own cache_instance_type and cache_volume_size. Without one,
+    the cache node falls back across the same instance types and subnets as the rooms, see launch_fallback.py.
+    """
+    tags = [
+        {'Key': 'Name', 'Value': f"{CACHE_NODE_NAME_PREFIX}{session_id}"},
+        {'Key': CACHE_NODE_TAG, 'Value': session_id},
+        {'Key': aws_defaults["coach_tag"], 'Value': "cache node"},
+    ]
+    cache_defaults = dict(aws_defaults,
+                          instance_type=aws_defaults.get("cache_instance_type", aws_defaults["instance_type"]),
+                          volume_size=aws_defaults.get("cache_volume_size", aws_defaults["volume_size"]))
+    if "cache_instance_type" in aws_defaults:
+        region_config = dict(region_config, instance_types=[aws_defaults["cache_instance_type"]])
+    user_data = generate_cache_node_script(machine_configs)
+    response = run_with_fallback(ec2, region_name, 1, tags, user_data, region_config, cache_defaults)
+    instance = response["Instances"][0]
+    logging.getLogger(__name__).info(f"launched cache node {instance['InstanceId']} at {instance['PrivateIpAddress']}")
+    return instance["PrivateIpAddress"]
+
+
+def launch_cache_nodes(projector_instances, config, session_id, region_executor=None):
+    """ Launch a cache node in each region the rooms are in, all regions at once, and return
+    {region name: cache node address}. A region whose cache node couldn't be launched is left out -
+    its rooms download from the internet instead.
+    """
+    config_names_by_region = {}
+    for instance in projector_instances:
+        config_names_by_region.setdefault(instance.region_name, set()).add(instance.config_name)
+
+    def launch(region_name):
+        ec2 = aws_clients.client("ec2", region_name, config.profile_name)
+        config_names = sorted(config_names_by_region[region_name])
+        machine_configs = [config.ide_config(config_name) for config_name in config_names]
+        return launch_cache_node(ec2, session_id, machine_configs, config.region(region_name), config.aws_defaults,
+                                 region_name)
+
+    cache_hosts, failures = (region_executor or RegionExecutor()).results(launch, config_names_by_region)
+    for region_name, error in failures.items():
+        logging.getLogger(__name__).warning(f"no cache node in {region_name}, its rooms download from the internet: "
+                                            f"{error}")
+    return cache_hosts
+
+
+def cache_nodes(ec2, session_id=None, states=CACHE_NODE_STATES):
+    """ yields the instance descriptions of the cache nodes in the ec2 client's region, or just the session's """
+    paginator = ec2.get_paginator("describe_instances")
+    filters = [
+        {'Name': f'tag:{CACHE_NODE_TAG}', 'Values': [session_id] if session_id else ['*']},
+        {'Name': 'instance-state-name', 'Values': list(states)},
+    ]
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page["Reservations"]:
+            yield from reservation["Instances"]
+
+
+@click.command()
+@click.option(
+    "--region-name",
+    cls=ConfigDependentOption,
+    help="the aws region name",
+    help_from=region_names,
+    default=None
+)
+@click.option(
+    "--aws-profile",
+    default="default",
+    help="the aws profile, if you don't use the default"
+)
+@click.option(
+    "--session-id",
+    default=None,
+    help="only the cache node of this summon session"
+)
+@click.option(
+    "--terminate", is_flag=True,
+    help="terminate the cache nodes once the classroom is up - the rooms don't need them after they have booted"
+)
+def cache_node(region_name, aws_profile, session_id, terminate):
+    logging.basicConfig(level=logging.INFO)
+    config = configuration(aws_profile)
+    region_name = region_name or config.aws_defaults["region"]
+    ec2 = aws_clients.client("ec2", region_name, aws_profile)
+    nodes = list(cache_nodes(ec2, session_id))
+    for node in nodes:
+        tags = {tag["Key"]: tag["Value"] for tag in node.get("Tags", [])}
+        print(f"{node['InstanceId']} {node['State']['Name']:10} session {tags.get(CACHE_NODE_TAG)} "
+              f"at {node.get('PrivateIpAddress')}")
+    if terminate and nodes:
+        ec2.terminate_instances(InstanceIds=[node["InstanceId"] for node in nodes])
+        print(f"terminated {len(nodes)} cache nodes")
+
+
+if __name__ == "__main__":
+    cache_node()
@@ -1,35 +1,202 @@
 #! python
+"""
+Start, stop or terminate all the machines in a classroom file written by summon.py.
+The rooms can be in several regions - each region gets its own call, and the regions are worked on at the same time.
+wait-ready waits until every room answers over https, see readiness.py.
+"""
 import csv
+import logging
+from dataclasses import dataclass
 
-import boto3
 import click
-import summon as summon_module
-from instances import get_sammancoach_machines
+
+import aws_clients
+from cli_options import profile_option
+from inventory import Inventory
+from readiness import ReadinessProber, wait_for_rooms
+from region_executor import RegionExecutor
+
+
+@dataclass
+class Room:
+    room: str
+    region_name: str
+    instance_id: str
+    url: str
+    team: str = ""
+    comments: str = ""
+    # which launch choice the machine got, see launch_fallback.py - older classroom files don't have them
+    instance_type: str = ""
+    availability_zone: str = ""
+
+
+@dataclass
+class RoomResult:
+    room: Room
+    state: str = None
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Classroom:
+    def __init__(self, rooms):
+        """ The rooms of a classroom, indexed by room number, instance id, url and region """
+        self.rooms = list(rooms)
+        self.by_room = {room.room: room for room in self.rooms}
+        self.by_id = {room.instance_id: room for room in self.rooms if room.instance_id}
+        self.by_url = {normalized_url(room.url): room for room in self.rooms}
+        self.by_region = {}
+        for room in self.rooms:
+            self.by_region.setdefault(room.region_name, []).append(room)
+
+    @classmethod
+    def read(cls, f):
+        """ A Classroom from the rows of a classroom csv file, see summon.write_classroom_file """
+        return cls(Room(room=row["room"], region_name=row["region"], instance_id=row["id"], url=row["url"],
+                        team=row.get("team", ""), comments=row.get("comments", ""),
+                        instance_type=row.get("instance_type", ""), availability_zone=row.get("availability_zone", ""))
+                   for row in csv.DictReader(f))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            return cls.read(f)
+
+    def with_url(self, url):
+        return self.by_url.get(normalized_url(url))
+
+    def ids_by_region(self):
+        return {region_name: [room.instance_id for room in rooms if room.instance_id]
+                for region_name, rooms in self.by_region.items()}
+
+
+def normalized_url(url):
+    return url.strip().rstrip("/")
+
+
+# the ec2 call, the key of the instances in its response, and the waiter for the state it leads to
+ACTIONS = {
+    "start": ("start_instances", "StartingInstances", "instance_running"),
+    "stop": ("stop_instances", "StoppingInstances", "instance_stopped"),
+    "terminate": ("terminate_instances", "TerminatingInstances", "instance_terminated"),
+}
+
+
+class ClassroomActions:
+    def __init__(self, classroom, profile_name=None, region_executor=None, wait_timeout=600, inventory=None):
+        """ Does the same thing to every machine in a classroom, with one call per region and all regions at once.
+        Arguments:
+        - wait_timeout - seconds to wait for the machines to reach their new state, when asked to wait
+        - inventory - the inventory whose regions are invalidated afterwards, see inventory.py
+        """
+        self.log = logging.getLogger(__name__)
+        self.classroom = classroom
+        self.profile_name = profile_name
+        self.wait_timeout = wait_timeout
+        self.inventory = inventory
+        self.region_executor = region_executor or RegionExecutor(timeout=wait_timeout + 60)
+
+    def start(self, wait=False):
+        return self.run("start", wait)
+
+    def stop(self, wait=False):
+        return self.run("stop", wait)
+
+    def terminate(self, wait=False):
+        return self.run("terminate", wait)
+
+    def run(self, action, wait=False):
+        """ Returns a RoomResult for every room, in the order of the classroom file.
+        With wait, the state is the one the machine reached; otherwise it's the one EC2 reported straight away.
+        """
+        operation_name, response_key, waiter_name = ACTIONS[action]
+        ids_by_region = self.classroom.ids_by_region()
+
+        def act_in_region(region_name):
+            ec2 = aws_clients.client("ec2", region_name, self.profile_name)
+            instance_ids = ids_by_region[region_name]
+            response = getattr(ec2, operation_name)(InstanceIds=instance_ids)
+            states = {instance["InstanceId"]: instance["CurrentState"]["Name"] for instance in response[response_key]}
+            if wait:
+                waiter_config = {"Delay": 5, "MaxAttempts": max(self.wait_timeout // 5, 1)}
+                ec2.get_waiter(waiter_name).wait(InstanceIds=instance_ids, WaiterConfig=waiter_config)
+                states = {instance_id: waiter_name.partition("_")[2] for instance_id in instance_ids}
+            return states
+
+        results = {}
+        regions = [region_name for region_name, instance_ids in ids_by_region.items() if instance_ids]
+        try:
+            for outcome in self.region_executor.outcomes(act_in_region, regions):
+                for room in self.classroom.by_region[outcome.region_name]:
+                    if outcome.ok:
+                        results[room.room] = RoomResult(room, state=outcome.result.get(room.instance_id))
+                    else:
+                        results[room.room] = RoomResult(room, error=f"{type(outcome.error).__name__}: {outcome.error}")
+        finally:
+            if self.inventory:
+                self.inventory.invalidate(self.profile_name or "default", regions)
+        return [results.get(room.room, RoomResult(room, error="no instance id")) for room in self.classroom.rooms]
+
+
+def room_results_table(results):
+    lines = [f"{'room':>4} {'region':14} {'id':20} {'state':14} url"]
+    for result in results:
+        room = result.room
+        lines.append(f"{room.room:>4} {room.region_name:14} {room.instance_id:20} "
+                     f"{result.state or 'failed':14} {room.url}{'  ' + result.error if result.error else ''}")
+    succeeded = sum(1 for result in results if result.ok)
+    lines.append(f"{succeeded} of {len(results)} rooms succeeded")
+    return lines
+
+
+def classroom_action_options(command):
+    command = profile_option(command)
+    command = click.option("--wait/--no-wait", default=False,
+                           help="wait until every machine has reached its new state")(command)
+    command = click.option("--aws-profile", default="default",
+                           help="the aws profile, if you don't use the default")(command)
+    return click.argument("classroom")(command)
 
 
 @click.group()
 def cli():
-    pass
+    logging.basicConfig(level=logging.INFO)
 
 
 @cli.command()
-@click.argument("classroom")
-def terminate(classroom):
+@classroom_action_options
+def terminate(classroom, aws_profile, wait):
     yes = click.prompt("are you sure? [y/N] ")
     if yes == "y":
-        boto3.client("ec2").terminate_instances(InstanceIds=(ids_in_classroom(classroom)))
+        actions = ClassroomActions(Classroom.load(classroom), aws_profile, inventory=Inventory())
+        print("\n".join(room_results_table(actions.terminate(wait))))
 
 
 @cli.command()
-@click.argument("classroom")
-def stop(classroom):
-    boto3.client("ec2").stop_instances(InstanceIds=(ids_in_classroom(classroom)))
+@classroom_action_options
+def stop(classroom, aws_profile, wait):
+    actions = ClassroomActions(Classroom.load(classroom), aws_profile, inventory=Inventory())
+    print("\n".join(room_results_table(actions.stop(wait))))
 
 
 @cli.command()
+@classroom_action_options
+def start(classroom, aws_profile, wait):
+    actions = ClassroomActions(Classroom.load(classroom), aws_profile, inventory=Inventory())
+    print("\n".join(room_results_table(actions.start(wait))))
+
+
+@cli.command("wait-ready")
 @click.argument("classroom")
-def start(classroom):
-    boto3.client("ec2").start_instances(InstanceIds=(ids_in_classroom(classroom)))
+@click.option("--deadline", default=1200,
+              help="how many seconds to wait for every room to be ready")
+def wait_ready(classroom, deadline):
+    rooms = wait_for_rooms([room.url for room in Classroom.load(classroom).rooms], ReadinessProber(deadline=deadline))
+    if not all(room.ready for room in rooms):
+        raise SystemExit(1)
 
 
 @cli.command()
@@ -39,10 +206,7 @@ def ids(classroom):
 
 
 def ids_in_classroom(classroom):
-    with open(classroom, "r", newline="") as f:
-        reader = csv.DictReader(f)
-        ids = [row["id"] for row in reader]
-    return ids
+    return list(Classroom.load(classroom).by_id)
 
 
 if __name__ == '__main__':
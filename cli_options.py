@@ -0,0 +1,89 @@
+"""
+Click options shared by several commands.
+Help or prompt text that lists what's in the configuration files is only worked out when it's actually shown,
+so that importing a command, or running it with --help, doesn't read any files - and still works when they are missing.
+"""
+import functools
+
+import click
+
+import aws_clients
+from api_metrics import ApiMetrics
+from configuration import read_ide_config, read_regions_config, ConfigurationError
+
+
+def ide_config_names():
+    return ", ".join(read_ide_config()) or "see ide_config.json"
+
+
+def region_names():
+    try:
+        return ", ".join(read_regions_config().keys())
+    except (AssertionError, KeyError, ConfigurationError):
+        return "see aws_zones.json"
+
+
+class ConfigDependentOption(click.Option):
+    def __init__(self, *args, help_from=None, prompt_from=None, **kwargs):
+        """ help_from and prompt_from are called with no arguments to get the text to put after the help or prompt """
+        super().__init__(*args, **kwargs)
+        self.help_from = help_from
+        self.prompt_from = prompt_from
+        self._plain_help = self.help
+        self._plain_prompt = self.prompt
+
+    def get_help_record(self, ctx):
+        if self.help_from:
+            self.help = f"{self._plain_help}: {self.help_from()}"
+        return super().get_help_record(ctx)
+
+    def prompt_for_value(self, ctx):
+        if self.prompt_from:
+            self.prompt = f"{self._plain_prompt} [{self.prompt_from()}]?"
+        return super().prompt_for_value(ctx)
+
+
+def remote_execution_options(command):
+    """ The options of every command that runs something on ensemble machines over ssh """
+    command = click.option("--persist-connections/--no-persist-connections", default=False,
+                           help="keep ssh connections open between runs, through the ssh client's control sockets")(command)
+    command = click.option("--retries", default=0,
+                           help="how many times to try again on machines where the command failed")(command)
+    command = click.option("--timeout", default=300,
+                           help="seconds the command may take on one machine")(command)
+    command = click.option("--max-parallel", default=10,
+                           help="how many machines to run the command on at the same time")(command)
+    return command
+
+
+def fresh_option(command):
+    """ The option of every command that looks machines up in the inventory, see inventory.py """
+    return click.option("--fresh", is_flag=True,
+                        help="ask AWS about every machine, instead of using what recent commands found")(command)
+
+
+def cached_option(command):
+    """ The option of commands that should see every machine as it is now, such as shutdown.py,
+    but can use the inventory when asked to, see inventory.py """
+    return click.option("--fresh/--cached", default=True,
+                        help="ask AWS about every machine (the default), or use what recent commands found")(command)
+
+
+def profile_option(command):
+    """ The option of every command that talks to AWS, to report how many calls it made and how long they took """
+    @functools.wraps(command)
+    def profiled_command(*args, profile_output=None, **kwargs):
+        if profile_output is not None:
+            metrics = ApiMetrics()
+            aws_clients.instrument(metrics)
+
+            def report():
+                aws_clients.uninstrument(metrics)
+                metrics.report(profile_output)
+
+            click.get_current_context().call_on_close(report)
+        return command(*args, **kwargs)
+
+    return click.option("--profile", "profile_output", is_flag=False, flag_value="-", default=None,
+                        help="print the AWS calls made per region and operation when done, "
+                             "or with a file name, write them to it as json")(profiled_command)
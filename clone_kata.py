@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
+import logging
 
 import click
-import os
-from fabric import Connection
 from dataclasses import dataclass
-import csv
 
+from classroom import Classroom, normalized_url
+from cli_options import ConfigDependentOption, region_names, remote_execution_options, fresh_option, profile_option
+from configuration import configuration
 from instances import all_instances
-from summon import read_regions_config, read_aws_defaults
+from inventory import Inventory
+from region_executor import RegionExecutor
+from remote import RemoteExecutor, FabricTransport, OpenSshTransport, summary_table
 
 
 @dataclass
@@ -18,17 +21,13 @@ class KataMachine:
 
 
 def read_classroom_file(file, running_instances):
+    """ The machines of the classroom that are among the running instances, in the order of the classroom file """
+    running = {normalized_url(machine.url): machine for machine in running_instances}
     result = []
-    reader = csv.DictReader(file)
-    for row in reader:
-        url = row["url"]
-        region_name = row["region"]
-        matching_instances = [machine for machine in running_instances if machine.url.strip() == url.strip()]
-        if matching_instances:
-            instance = matching_instances[0]
-            machine = KataMachine(url=url, region_name=region_name, host_ip=instance.ip_address)
-            result.append(machine)
-        
+    for room in Classroom.read(file).rooms:
+        instance = running.get(normalized_url(room.url))
+        if instance:
+            result.append(KataMachine(url=room.url, region_name=room.region_name, host_ip=instance.ip_address))
     return result
 
 
@@ -52,7 +51,9 @@ def clone_kata_commandline(kata):
 )
 @click.option(
     "--region-name",
-    help=f"the aws region name (default eu-north-1): {', '.join(read_regions_config().keys())}",
+    cls=ConfigDependentOption,
+    help="the aws region name (default eu-north-1)",
+    help_from=region_names,
     default="eu-north-1"
 )
 @click.option(
@@ -72,46 +73,61 @@ def clone_kata_commandline(kata):
     "--classroom",
     help="add the kata to all running instances in this classroom file",
 )
-def clone_kata(kata, region_name, aws_profile, host_ip, coach, classroom):
+@remote_execution_options
+@fresh_option
+@profile_option
+def clone_kata(kata, region_name, aws_profile, host_ip, coach, classroom, max_parallel, timeout, retries,
+               persist_connections, fresh):
     commandline = clone_kata_commandline(kata)
-    aws_defaults = read_aws_defaults(profile_name=aws_profile)
-    url_stem = aws_defaults["url_stem"]
-
-    if region_name == "all":
-        all_regions = read_regions_config(profile_name=aws_profile).keys()
-        for region_name in all_regions:
-            clone_to_machines_in_region(aws_profile, classroom, coach, host_ip, region_name, url_stem, commandline)
-    else:
-        clone_to_machines_in_region(aws_profile, classroom, coach, host_ip, region_name, url_stem, commandline)
-
-def clone_to_machines_in_region(aws_profile, classroom, coach, host_ip, region_name, url_stem, commandline):
-    machines = determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_name, url_stem)
+    machines = machines_in_regions(aws_profile, classroom, coach, host_ip, region_name, fresh)
     logging.getLogger().info(f"will clone kata to machines: {[m.url for m in machines]}")
-    run_commandline_on_machines(commandline, machines, aws_profile)
-
-def run_commandline_on_machines(commandline, machines, aws_profile):
-    for m in machines:
-        try:
-            print(f"will run remote commands on {m}")
-            c = connect_to_machine(m, aws_profile)
-            c.run(commandline)
-        except Exception as e:
-            print("unexpected problem running remote commands on machine ", m, e)
+    run_commandline_on_machines(commandline, machines, aws_profile, max_parallel, timeout, retries, persist_connections)
+
+
+def machines_in_regions(aws_profile, classroom, coach, host_ip, region_name, fresh=False):
+    """ the machines to update in one region, or in every configured region if region_name is 'all'.
+    They are looked up in the inventory unless fresh is set, see inventory.py.
+    """
+    config = configuration(aws_profile)
+    url_stem = config.aws_defaults["url_stem"]
+    inventory = Inventory()
+    if region_name != "all":
+        return determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_name, url_stem,
+                                            inventory, fresh)
+
+    def machines_in_region(region_name):
+        return determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_name, url_stem,
+                                            inventory, fresh)
+
+    machines = []
+    for outcome in RegionExecutor().outcomes(machines_in_region, config.region_names()):
+        if outcome.ok:
+            machines.extend(outcome.result)
+        else:
+            print(f"ERROR: couldn't find machines in {outcome.region_name}: {outcome.error}")
+    return machines
 
 
-def connect_to_machine(machine, aws_profile):
-    key_name = read_regions_config(profile_name=aws_profile)[machine.region_name]["key_name"]
-    key_file = os.path.expanduser(f"~/.ssh/{key_name}.pem")
-    c = Connection(host=machine.host_ip.strip(), user='ubuntu', connect_kwargs={
-        "key_filename": key_file,
-    }, )
-    return c
+def run_commandline_on_machines(commandline, machines, aws_profile, max_parallel=10, timeout=300, retries=0,
+                                persist_connections=False):
+    """ Run commandline on all the machines in parallel, print a summary table and return the HostResults.
+    With persist_connections the ssh connections outlive this process, for the next command to reuse.
+    """
+    config = configuration(aws_profile)
+    transport = OpenSshTransport(config) if persist_connections else FabricTransport(config)
+    executor = RemoteExecutor(transport, max_workers=max_parallel, timeout=timeout)
+    results = executor.run(commandline, machines, retries=retries)
+    print("\n".join(summary_table(results)))
+    return results
 
 
-def determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_name, url_stem):
+def determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_name, url_stem, inventory=None,
+                                 fresh=False):
     logging.getLogger().info(f"finding machines to clone to in region {region_name}")
-    running_instances = [machine for machine in all_instances(region_name, aws_profile) if
-                         machine.state.strip() == "running"]
+    # only a selection by coach is narrowed to the coach's machines, --host_ip and --classroom pick from them all
+    selecting_by_coach = coach and not host_ip
+    running_instances = all_instances(region_name, aws_profile, coach=coach if selecting_by_coach else None,
+                                      states=["running"], inventory=inventory, fresh=fresh)
     if not running_instances:
         logging.getLogger().error(f"No running instances found in region {region_name}")
         return []
@@ -123,9 +139,6 @@ def determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_
         else:
             machines = [KataMachine(host_ip=host_ip, region_name=region_name, url=instance[0].url)]
     elif coach:
-        running_instances = [machine
-                             for machine in running_instances
-                             if machine.coach.strip() == coach]
         machines = [KataMachine(host_ip=machine.ip_address, region_name=region_name, url=machine.url)
                     for machine in running_instances]
     elif classroom:
@@ -139,7 +152,5 @@ def determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_
 
 
 if __name__ == "__main__":
-    import logging
-
     logging.basicConfig(level=logging.INFO)
     clone_kata()
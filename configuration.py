@@ -0,0 +1,158 @@
+"""
+The three configuration files these scripts need, read from the current working directory:
+- ide_config.json - how to install software and configure projector for each kind of IDE you want to be able to summon.
+- aws_zones.json - for each aws profile, the image, key and security groups to use in each region.
+- aws_machine_spec.json - for each aws profile, the values that are the same for all regions.
+And one that bake.py writes, if you use it:
+- aws_images.json - for each aws profile and region, the image baked for each ide config.
+
+Each file is parsed and validated once, and only read again if its modification time changes.
+"""
+import copy
+import json
+import logging
+import pathlib
+import threading
+
+BAKED_IMAGES_FILE = "aws_images.json"
+
+REQUIRED_IDE_CONFIG_KEYS = ["name", "extra_packages", "snap_packages", "environment"]
+REQUIRED_REGION_KEYS = ["image_id", "security_group_ids", "key_name"]
+REQUIRED_AWS_DEFAULTS_KEYS = ["region", "instance_type", "volume_type", "volume_size", "coach_tag", "url_stem"]
+
+_lock = threading.Lock()
+_parsed_files = {}
+
+
+class ConfigurationError(Exception):
+    pass
+
+
+def load_json(path, parse=lambda contents, path: contents):
+    """ The parsed contents of a json file, only read from disk again when the file's mtime has changed """
+    path = pathlib.Path(path).resolve()
+    mtime = path.stat().st_mtime_ns
+    key = (path, parse)
+    with _lock:
+        cached = _parsed_files.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    logging.getLogger(__name__).debug(f"reading {path}")
+    with open(path) as f:
+        try:
+            contents = parse(json.load(f), path)
+        except ValueError as e:
+            raise ConfigurationError(f"{path} is not valid json: {e}")
+    with _lock:
+        _parsed_files[key] = (mtime, contents)
+    return contents
+
+
+def _check_keys(entries, required_keys, path, what):
+    for entry_name, entry in entries.items():
+        missing = [key for key in required_keys if key not in entry]
+        if missing:
+            raise ConfigurationError(f"{what} '{entry_name}' in {path} is missing {', '.join(missing)}")
+
+
+def parse_ide_configs(configs, path):
+    _check_keys(configs, REQUIRED_IDE_CONFIG_KEYS, path, "ide config")
+    for key in configs.keys():
+        configs[key]["config_name"] = key
+    return configs
+
+
+def parse_regions_configs(profiles, path):
+    for profile_name, regions in profiles.items():
+        _check_keys(regions, REQUIRED_REGION_KEYS, path, f"{profile_name} region")
+    return profiles
+
+
+def parse_aws_defaults(profiles, path):
+    _check_keys(profiles, REQUIRED_AWS_DEFAULTS_KEYS, path, "aws profile")
+    return profiles
+
+
+def read_ide_config(config=None):
+    """ ide_config.json contains details of how to install software and configure projector for each kind of IDE you want to be able to summon. """
+    config = config or pathlib.Path().resolve() / "ide_config.json"
+    if not config.exists():
+        logging.warning("missing ide_config.json file, expected to be in current working directory")
+        return {}
+    return copy.deepcopy(load_json(config, parse_ide_configs))
+
+
+def read_regions_config(config=None, profile_name="default"):
+    """ aws_zones.json contains dictionaries for each aws zone you want to be able to summon instances in. """
+    config = config or pathlib.Path().resolve() / "aws_zones.json"
+    assert config.exists(), "missing aws_zones.json file, expected to be in current working directory"
+    return copy.deepcopy(load_json(config, parse_regions_configs)[profile_name])
+
+
+def read_aws_defaults(config=None, profile_name="default"):
+    """ aws_defaults are values that are set the same for all regions """
+    config = config or pathlib.Path().resolve() / "aws_machine_spec.json"
+    assert config.exists(), "missing aws_machine_spec.json file, expected to be in current working directory"
+    return copy.deepcopy(load_json(config, parse_aws_defaults)[profile_name])
+
+
+class Configuration:
+    def __init__(self, profile_name="default", directory=None):
+        """ All the configuration for one aws profile, loaded and validated up front.
+        The records it hands out are shared, so per-room work can use them without any file I/O - don't modify them.
+        Call refresh() to pick up files that have changed on disk since.
+        """
+        self.profile_name = profile_name
+        self.directory = pathlib.Path(directory or pathlib.Path().resolve())
+        self.refresh()
+
+    def refresh(self):
+        ide_config_file = self.directory / "ide_config.json"
+        if ide_config_file.exists():
+            self.ide_configs = load_json(ide_config_file, parse_ide_configs)
+        else:
+            logging.warning(f"missing ide_config.json file, expected to be in {self.directory}")
+            self.ide_configs = {}
+        self.regions = self._profile_entry("aws_zones.json", parse_regions_configs)
+        self.aws_defaults = self._profile_entry("aws_machine_spec.json", parse_aws_defaults)
+        baked_images_file = self.directory / BAKED_IMAGES_FILE
+        self.baked_images = load_json(baked_images_file).get(self.profile_name, {}) if baked_images_file.exists() else {}
+        return self
+
+    def ide_config(self, config_name):
+        if config_name not in self.ide_configs:
+            raise ConfigurationError(f"no ide config called '{config_name}', expected one of: {', '.join(self.ide_configs)}")
+        return self.ide_configs[config_name]
+
+    def region(self, region_name):
+        if region_name not in self.regions:
+            raise ConfigurationError(f"region '{region_name}' is not in aws_zones.json for profile "
+                                     f"'{self.profile_name}', expected one of: {', '.join(self.regions)}")
+        return self.regions[region_name]
+
+    def baked_image(self, region_name, config_name):
+        """ The record bake.py made of the image for this config in this region, or None if there isn't one """
+        return self.baked_images.get(region_name, {}).get(config_name)
+
+    def region_names(self):
+        return list(self.regions.keys())
+
+    def _profile_entry(self, filename, parse):
+        path = self.directory / filename
+        if not path.exists():
+            raise ConfigurationError(f"missing {filename} file, expected to be in {self.directory}")
+        profiles = load_json(path, parse)
+        if self.profile_name not in profiles:
+            raise ConfigurationError(f"{path} has no entry for aws profile '{self.profile_name}'")
+        return profiles[self.profile_name]
+
+
+_configurations = {}
+
+
+def configuration(profile_name="default"):
+    """ The Configuration for this aws profile, brought up to date with any files that changed on disk """
+    if profile_name not in _configurations:
+        _configurations[profile_name] = Configuration(profile_name)
+        return _configurations[profile_name]
+    return _configurations[profile_name].refresh()
@@ -2,8 +2,8 @@
 
 import click
 
-from clone_kata import determine_machines_to_update, run_commandline_on_machines
-from summon import region_configs
+from cli_options import ConfigDependentOption, region_names, remote_execution_options, fresh_option
+from clone_kata import machines_in_regions, run_commandline_on_machines
 
 
 def download_plugin_commandline(plugin):
@@ -24,12 +24,14 @@ sudo -u typist -- sh -c '\
 )
 @click.option(
     "--region-name",
-    help=f"the aws region name (default eu-north-1): {', '.join(region_configs.keys())}",
+    cls=ConfigDependentOption,
+    help="the aws region name (default eu-north-1)",
+    help_from=region_names,
     default="eu-north-1"
 )
 @click.option(
     "--aws-profile",
-    default=None,
+    default="default",
     help="the aws profile, if you dont use the default"
 )
 @click.option(
@@ -44,10 +46,13 @@ sudo -u typist -- sh -c '\
     "--classroom",
     help="add the kata to all running instances in this classroom file",
 )
-def download_plugin(plugin, region_name, aws_profile, host_ip, coach, classroom):
+@remote_execution_options
+@fresh_option
+def download_plugin(plugin, region_name, aws_profile, host_ip, coach, classroom, max_parallel, timeout, retries,
+                    persist_connections, fresh):
     commandline = download_plugin_commandline(plugin)
-    machines = determine_machines_to_update(aws_profile, classroom, coach, host_ip, region_name)
-    run_commandline_on_machines(commandline, machines, aws_profile)
+    machines = machines_in_regions(aws_profile, classroom, coach, host_ip, region_name, fresh)
+    run_commandline_on_machines(commandline, machines, aws_profile, max_parallel, timeout, retries, persist_connections)
 
 
 if __name__ == "__main__":
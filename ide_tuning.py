@@ -0,0 +1,119 @@
+"""
+Size the IDE's JVM to the machine it runs on. Projector runs inside the IDE's JVM, so one vmoptions file
+sets the heap, the garbage collector and the code cache for both, along with projector's own settings.
+
+Each config in ide_config.json can have a "tuning" entry that changes some of DEFAULT_TUNING, e.g.
+
+    "tuning": {"heap_fraction": 0.35, "max_heap_mb": 6144}
+
+The user data has the vmoptions for every instance type the machine might be launched as, see launch_fallback.py,
+sized by what EC2 says about those instance types when summon.py runs, and the machine picks the one for its own
+instance type when it boots. It warns and leaves the IDE's defaults alone on an instance type it has no vmoptions for.
+"""
+import re
+from dataclasses import dataclass, field, fields
+
+from configuration import ConfigurationError
+
+GC_OPTIONS = {
+    "G1": "-XX:+UseG1GC",
+    "Parallel": "-XX:+UseParallelGC",
+}
+# the options in the IDE's own vmoptions file that the tuned ones replace, as grep -E patterns. A fixed young
+# generation size is dropped too, so the gc sizes it to the heap.
+REPLACED_OPTIONS = r"-Xm[sx]|-Xss|-XX:ReservedCodeCacheSize=|-XX:\+Use[A-Za-z0-9]*GC$|" \
+                   r"-XX:(CICompilerCount|ParallelGCThreads|ConcGCThreads|SoftRefLRUPolicyMSPerMB|NewSize|MaxNewSize)="
+TUNED_VMOPTIONS = "/home/typist/.projector/ensemble.vmoptions"
+
+
+@dataclass
+class Tuning:
+    heap_fraction: float = 0.5
+    min_heap_mb: int = 1024
+    max_heap_mb: int = 16384
+    code_cache_mb: int = 512
+    gc: str = "G1"
+    # projector's settings are system properties of the IDE's JVM
+    properties: dict = field(default_factory=lambda: {"ORG_JETBRAINS_PROJECTOR_SERVER_AUTO_KEYMAP": "false"})
+
+    @classmethod
+    def from_config(cls, tuning=None):
+        """ DEFAULT_TUNING with the changes from an ide config's "tuning" entry """
+        tuning = dict(tuning or {})
+        unknown = set(tuning) - {f.name for f in fields(cls)}
+        if unknown:
+            raise ConfigurationError(f"unknown tuning settings: {', '.join(sorted(unknown))}")
+        if tuning.get("gc", cls.gc) not in GC_OPTIONS:
+            raise ConfigurationError(f"unknown gc '{tuning['gc']}', expected one of: {', '.join(GC_OPTIONS)}")
+        properties = {**DEFAULT_TUNING.properties, **tuning.pop("properties", {})}
+        return cls(properties=properties, **tuning)
+
+
+DEFAULT_TUNING = Tuning()
+
+
+def heap_mb(tuning, memory_mb):
+    """ heap_fraction of the memory, in whole 256 MiB, kept between min_heap_mb and max_heap_mb """
+    heap = int(memory_mb * tuning.heap_fraction) // 256 * 256
+    return max(tuning.min_heap_mb, min(tuning.max_heap_mb, heap))
+
+
+def render_vmoptions(tuning, memory_mb, vcpus):
+    """ The vmoptions for a machine with this much memory and this many vCPUs """
+    heap = heap_mb(tuning, memory_mb)
+    options = [
+        f"-Xmx{heap}m",
+        f"-Xms{min(heap, max(256, heap // 4))}m",
+        "-Xss2m",
+        f"-XX:ReservedCodeCacheSize={tuning.code_cache_mb}m",
+        GC_OPTIONS[tuning.gc],
+        f"-XX:ParallelGCThreads={vcpus}",
+        f"-XX:CICompilerCount={max(2, vcpus // 2)}",
+        "-XX:SoftRefLRUPolicyMSPerMB=50",
+    ]
+    if tuning.gc == "G1":
+        options.append(f"-XX:ConcGCThreads={max(1, vcpus // 4)}")
+    options += [f"-D{key}={value}" for key, value in tuning.properties.items()]
+    return "\n".join(options) + "\n"
+
+
+def ere_escape(text):
+    """ A grep -E pattern that matches only text. re.escape escapes -, which grep warns about. """
+    return re.sub(r"([][\\.^$*+?(){}|])", r"\\\1", text)
+
+
+def instance_type_sizes(ec2, instance_types):
+    """ {instance type: (MiB of memory, vCPUs)} for each of the instance types, as EC2 describes them """
+    response = ec2.describe_instance_types(InstanceTypes=sorted(set(instance_types)))
+    return {instance_type["InstanceType"]: (instance_type["MemoryInfo"]["SizeInMiB"],
+                                            instance_type["VCpuInfo"]["DefaultVCpus"])
+            for instance_type in response["InstanceTypes"]}
+
+
+def tuning_commands(tuning, instance_sizes):
+    """ Shell that finds the machine's instance type, and puts the tuned vmoptions for it into the installed IDE's
+    vmoptions file in place of the IDE's own heap, gc and code cache settings and of any properties it sets too.
+    instance_sizes is {instance type: (MiB of memory, vCPUs)}, see instance_type_sizes.
+    """
+    tuning = tuning if isinstance(tuning, Tuning) else Tuning.from_config(tuning)
+    branches = "".join(f"""\
+  {instance_type})
+    cat << 'VMOPTIONS' | sudo -u typist tee {TUNED_VMOPTIONS}
+{render_vmoptions(tuning, memory_mb, vcpus)}VMOPTIONS
+    ;;
+""" for instance_type, (memory_mb, vcpus) in sorted(instance_sizes.items()))
+    replaced = "|".join([REPLACED_OPTIONS] + [ere_escape(f"-D{key}=") for key in tuning.properties])
+    return f"""\
+TOKEN=$(curl -sf -X PUT http://169.254.169.254/latest/api/token -H "X-aws-ec2-metadata-token-ttl-seconds: 60")
+INSTANCE_TYPE=$(curl -sf -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/instance-type)
+case "$INSTANCE_TYPE" in
+{branches}  *)
+    echo "WARNING: no tuned vmoptions for instance type '$INSTANCE_TYPE', keeping the IDE's defaults" >&2
+    return 0
+    ;;
+esac
+for vmoptions in /home/typist/.projector/apps/*/bin/*64.vmoptions; do
+  grep -v -E '^({replaced})' "$vmoptions" | cat - {TUNED_VMOPTIONS} | sudo -u typist tee "$vmoptions.ensemble"
+  sudo -u typist mv "$vmoptions.ensemble" "$vmoptions"
+done
+"""
@@ -4,10 +4,14 @@ import json
 from dataclasses import dataclass
 from pathlib import Path
 
-import boto3
 import click
 
-from summon import read_regions_config, read_aws_defaults
+import aws_clients
+
+from region_executor import RegionExecutor
+from cli_options import ConfigDependentOption, region_names, fresh_option, profile_option
+from configuration import configuration
+from wrap_ec2_client import InstanceDiscovery
 
 @dataclass
 class RunningInstance:
@@ -22,7 +26,9 @@ class RunningInstance:
 @click.command()
 @click.option(
     "--region-name",
-    help=f"the aws region name (default eu-north-1): {', '.join(read_regions_config().keys())}",
+    cls=ConfigDependentOption,
+    help="the aws region name (default eu-north-1)",
+    help_from=region_names,
     default="eu-north-1"
 )
 @click.option(
@@ -34,28 +40,45 @@ class RunningInstance:
     "--coach",
     help="only show instances owned by this person",
 )
-def main(region_name, aws_profile, coach=None):
-    instances = all_instances(region_name, aws_profile)
-    if coach:
-        instances = [instance for instance in instances if instance.coach.strip() == coach]
+@fresh_option
+@profile_option
+def main(region_name, aws_profile, coach=None, fresh=False):
+    from inventory import Inventory
+    instances = all_instances(region_name, aws_profile, coach=coach, inventory=Inventory(), fresh=fresh)
     print('\n'.join(print_instances(instances)))
 
 
-def all_instances(region_name, aws_profile):
-    url_stem = read_aws_defaults(profile_name=aws_profile)["url_stem"]
+def all_instances(region_name, aws_profile, coach=None, states=None, inventory=None, fresh=False):
+    """ The ensemble machines in a region, or in every configured region if region_name is 'all'.
+    coach and states (a list of instance state names) are filtered on by EC2, or by the inventory if there is one
+    and it is up to date - see inventory.py. fresh asks EC2 anyway.
+    """
+    config = configuration(aws_profile)
+    url_stem = config.aws_defaults["url_stem"]
     instances = []
     if region_name == "all":
-        all_regions = read_regions_config(profile_name=aws_profile).keys()
-        for region_name in all_regions:
-            response = get_sammancoach_machines(region_name, aws_profile)
-            instances.extend(instances_from_response(response, url_stem))
+        all_regions = config.region_names()
+
+        def instances_in_region(region_name):
+            return list(instances_in(region_name, aws_profile, url_stem, coach, states, inventory, fresh))
+
+        for outcome in RegionExecutor().outcomes(instances_in_region, all_regions):
+            if outcome.ok:
+                instances.extend(outcome.result)
+            else:
+                print(f"WARNING: couldn't list instances in {outcome.region_name}: {outcome.error}")
     else:
-        response = get_sammancoach_machines(region_name, aws_profile)
-        instances.extend(instances_from_response(response, url_stem))
+        instances.extend(instances_in(region_name, aws_profile, url_stem, coach, states, inventory, fresh))
 
     return instances
 
 
+def instances_in(region_name, aws_profile, url_stem, coach=None, states=None, inventory=None, fresh=False):
+    """ yields RunningInstances one page of describe_instances at a time """
+    for page in sammancoach_machine_pages(region_name, aws_profile, url_stem, coach, states, inventory, fresh):
+        yield from instances_from_response(page, url_stem)
+
+
 def print_instances(instances):
     rows = []
     for instance in instances:
@@ -63,14 +86,21 @@ def print_instances(instances):
     return rows
 
 
-def get_sammancoach_machines(region_name, aws_profile):
-    session = boto3.Session(profile_name=aws_profile, region_name=region_name)
-    client = session.client('ec2')
-    custom_filter = [{
-        'Name': 'tag:SammanCoach',
-        'Values': ['*']}]
-    response = client.describe_instances(Filters=custom_filter)
-    return response
+def get_sammancoach_machines(region_name, aws_profile, url_stem="", coach=None, states=None):
+    """ every page of describe_instances for the ensemble machines in a region, merged into one response """
+    pages = sammancoach_machine_pages(region_name, aws_profile, url_stem, coach, states)
+    return {"Reservations": [reservation for page in pages for reservation in page["Reservations"]]}
+
+
+def sammancoach_machine_pages(region_name, aws_profile, url_stem="", coach=None, states=None, inventory=None,
+                              fresh=False):
+    client = aws_clients.client('ec2', region_name, aws_profile)
+    discovery = InstanceDiscovery(client, url_stem)
+    if inventory:
+        from inventory import CachedDiscovery
+        discovery = CachedDiscovery(discovery, region_name, aws_profile or "default", inventory, fresh)
+    # only instances with a SammanCoach tag are ensemble machines
+    yield from discovery.pages(coach=coach or "*", states=states)
 
 
 def instances_from_response(obj, url_stem):
@@ -0,0 +1,212 @@
+"""
+A local SQLite inventory of ensemble machines, kept next to the other caches in local_cache.py.
+Listing machines, cloning a kata to them and listing them again during a session then takes one
+describe_instances sweep per region instead of one per command.
+
+A region is swept again when its inventory is older than the ttl. Machines that were pending or stopping
+when they were last seen are looked up again on their own, since their address or state is about to change.
+Commands that take --fresh sweep every region they look at, and store what they find for the next command.
+Commands that start, stop or terminate machines invalidate the regions they did it in, so the next command
+sweeps them again. shutdown.py, start_instances.py and update_dns.py sweep every region unless they are run
+with --cached.
+"""
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import request_scheduler
+from local_cache import cache_directory
+
+DEFAULT_TTL = float(os.environ.get("ENSEMBLE_MACHINE_INVENTORY_TTL", 120))
+TRANSITIONAL_STATES = ["pending", "stopping", "shutting-down"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    profile TEXT NOT NULL,
+    region TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    name TEXT,
+    coach TEXT,
+    session TEXT,
+    state TEXT,
+    description TEXT NOT NULL,
+    PRIMARY KEY (profile, instance_id)
+);
+CREATE INDEX IF NOT EXISTS instances_by_region ON instances (profile, region, state);
+CREATE INDEX IF NOT EXISTS instances_by_name ON instances (profile, name);
+CREATE INDEX IF NOT EXISTS instances_by_coach ON instances (profile, coach);
+CREATE INDEX IF NOT EXISTS instances_by_session ON instances (profile, session);
+CREATE TABLE IF NOT EXISTS regions (
+    profile TEXT NOT NULL,
+    region TEXT NOT NULL,
+    url_stem TEXT NOT NULL,
+    refreshed_at REAL NOT NULL,
+    PRIMARY KEY (profile, region)
+);
+"""
+
+# the session id summon puts in every name: <config>-<session>[-<room>].<url stem>
+SESSION_IN_NAME = re.compile(r"-([0-9a-f]{8})(?:-\d+)?\.")
+
+
+def session_id(name):
+    match = SESSION_IN_NAME.search(name or "")
+    return match.group(1) if match else None
+
+
+def tag_value(instance, key):
+    for tag in instance.get("Tags", []):
+        if tag["Key"] == key:
+            return tag["Value"]
+    return None
+
+
+def _json_default(value):
+    # describe_instances returns datetimes, which are stored the way instances.py prints them
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+class Inventory:
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        """ The inventory in the cache directory, or in path.
+        Arguments:
+        - ttl - seconds after which a region's inventory is out of date and swept again
+        """
+        self.path = path or cache_directory() / "inventory.sqlite3"
+        self.ttl = ttl
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one connection per call, so that the region threads never share one
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def out_of_date(self, profile_name, region_name, url_stem):
+        """ Returns (whether the whole region has to be swept, ids of the machines to look up again on their own) """
+        with self._connect() as db:
+            row = db.execute("SELECT url_stem, refreshed_at FROM regions WHERE profile = ? AND region = ?",
+                             (profile_name, region_name)).fetchone()
+            if not row or row[0] != url_stem or time.time() - row[1] > self.ttl:
+                return True, []
+            placeholders = ", ".join("?" for _ in TRANSITIONAL_STATES)
+            changing = db.execute(f"SELECT instance_id FROM instances WHERE profile = ? AND region = ? "
+                                  f"AND state IN ({placeholders})",
+                                  (profile_name, region_name, *TRANSITIONAL_STATES)).fetchall()
+        return False, [instance_id for instance_id, in changing]
+
+    def store_region(self, profile_name, region_name, url_stem, instances, coach_tag="SammanCoach"):
+        """ Replace everything known about a region with the instances from a full sweep of it """
+        with self._connect() as db:
+            db.execute("DELETE FROM instances WHERE profile = ? AND region = ?", (profile_name, region_name))
+            self._insert(db, profile_name, region_name, instances, coach_tag)
+            db.execute("INSERT OR REPLACE INTO regions (profile, region, url_stem, refreshed_at) VALUES (?, ?, ?, ?)",
+                       (profile_name, region_name, url_stem, time.time()))
+
+    def store_instances(self, profile_name, region_name, instances, coach_tag="SammanCoach"):
+        """ Update just these instances, leaving the rest of the region as it is """
+        with self._connect() as db:
+            self._insert(db, profile_name, region_name, instances, coach_tag)
+
+    def instances(self, profile_name, region_name, name=None, coach=None, states=None):
+        """ The stored instance descriptions in a region, filtered the way InstanceDiscovery filters them.
+        name matches anywhere in the Name tag, and coach "*" matches any machine with a coach.
+        """
+        query = "SELECT description FROM instances WHERE profile = ? AND region = ?"
+        parameters = [profile_name, region_name]
+        if name:
+            query += " AND instr(name, ?) > 0"
+            parameters.append(name)
+        if coach == "*":
+            query += " AND coach IS NOT NULL"
+        elif coach:
+            query += " AND coach = ?"
+            parameters.append(coach)
+        if states:
+            query += f" AND state IN ({', '.join('?' for _ in states)})"
+            parameters.extend(states)
+        with self._connect() as db:
+            rows = db.execute(query + " ORDER BY name", parameters).fetchall()
+        return [json.loads(description) for description, in rows]
+
+    def invalidate(self, profile_name, region_names):
+        """ Make the next command sweep these regions, e.g. after launching machines in them """
+        with self._connect() as db:
+            db.executemany("DELETE FROM regions WHERE profile = ? AND region = ?",
+                           [(profile_name, region_name) for region_name in region_names])
+
+    def _insert(self, db, profile_name, region_name, instances, coach_tag):
+        db.executemany(
+            "INSERT OR REPLACE INTO instances (profile, region, instance_id, name, coach, session, state, description) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(profile_name, region_name, instance["InstanceId"], tag_value(instance, "Name"),
+              tag_value(instance, coach_tag), session_id(tag_value(instance, "Name")), instance["State"]["Name"],
+              json.dumps(instance, default=_json_default))
+             for instance in instances])
+
+
+class CachedDiscovery:
+    def __init__(self, discovery, region_name, profile_name, inventory, fresh=False):
+        """ Answers the same questions as the InstanceDiscovery it wraps, from the inventory while that is up to date.
+        With fresh, the first lookup sweeps the region whatever the state of the inventory.
+        """
+        self.discovery = discovery
+        self.region_name = region_name
+        self.profile_name = profile_name
+        self.inventory = inventory
+        self.fresh = fresh
+
+    def pages(self, name=None, coach=None, states=None):
+        self.bring_up_to_date()
+        instances = self.inventory.instances(self.profile_name, self.region_name,
+                                             name or self.discovery.url_stem, coach, states)
+        yield {"Reservations": [{"Instances": instances}]}
+
+    def instances(self, name=None, coach=None, states=None):
+        for page in self.pages(name, coach, states):
+            for reservation in page["Reservations"]:
+                yield from reservation["Instances"]
+
+    def bring_up_to_date(self):
+        sweep, changing = self.inventory.out_of_date(self.profile_name, self.region_name, self.discovery.url_stem)
+        if self.fresh or sweep:
+            self.sweep()
+        elif changing:
+            self.changed(changing)
+
+    def sweep(self):
+        """ Describe every ensemble machine in the region again. Other AWS calls go first, since this is the one
+        that can take many pages. """
+        with request_scheduler.priority(request_scheduler.LOW):
+            instances = list(self.discovery.instances())
+        self.inventory.store_region(self.profile_name, self.region_name, self.discovery.url_stem, instances,
+                                    self.discovery.coach_tag)
+        self.fresh = False
+
+    def invalidate(self):
+        """ Make the next lookup, in this command or the next, sweep the region - e.g. after starting or stopping
+        machines in it """
+        self.inventory.invalidate(self.profile_name, [self.region_name])
+        self.fresh = True
+
+    def changed(self, instance_ids):
+        """ Look up just these instances again, e.g. because they were about to change state when last seen """
+        from botocore.exceptions import ClientError
+        try:
+            response = self.discovery.ec2_client.describe_instances(InstanceIds=list(instance_ids))
+        except ClientError as e:
+            # instances that were terminated a while ago are gone, and the whole call fails
+            if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound":
+                raise
+            self.sweep()
+            return
+        instances = [instance for reservation in response["Reservations"] for instance in reservation["Instances"]]
+        self.inventory.store_instances(self.profile_name, self.region_name, instances, self.discovery.coach_tag)
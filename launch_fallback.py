@@ -0,0 +1,101 @@
+"""
+Keep launching when EC2 has no capacity for the instance type in an availability zone, or doesn't offer the type
+there at all. Each region has an ordered list of launch choices, instance types and subnets, and a launch tries
+them in order until one works:
+- aws_machine_spec.json can list "instance_types" to fall back to, best first - by default just "instance_type".
+  A region in aws_zones.json can have its own "instance_types" list instead.
+- a region in aws_zones.json can list "subnet_ids", one per availability zone, best first - by default EC2 picks.
+
+A choice that just failed for lack of capacity is remembered for a few minutes, so that the other rooms
+launched in the same run go straight to a choice that is likely to work.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+# the errors that mean this instance type, in this availability zone, might work elsewhere
+CAPACITY_ERROR_CODES = {
+    "InsufficientInstanceCapacity",
+    "InsufficientCapacity",
+    "InsufficientHostCapacity",
+    "Unsupported",
+}
+CAPACITY_MEMORY_SECONDS = 300
+
+
+@dataclass(frozen=True)
+class LaunchChoice:
+    instance_type: str
+    subnet_id: str = None
+
+    def __str__(self):
+        return f"{self.instance_type} in {self.subnet_id}" if self.subnet_id else self.instance_type
+
+
+def instance_types(region_config, aws_defaults):
+    """ The instance types a machine in this region may be launched as, best first """
+    return region_config.get("instance_types") or aws_defaults.get("instance_types") or [aws_defaults["instance_type"]]
+
+
+def launch_choices(region_config, aws_defaults):
+    """ Every instance type in every subnet, in order of preference - the instance type matters most """
+    subnet_ids = region_config.get("subnet_ids") or [None]
+    return [LaunchChoice(instance_type, subnet_id)
+            for instance_type in instance_types(region_config, aws_defaults) for subnet_id in subnet_ids]
+
+
+class CapacityMemory:
+    def __init__(self, seconds=CAPACITY_MEMORY_SECONDS, clock=time.monotonic):
+        """ Which launch choices failed for lack of capacity in each region during the last few seconds """
+        self.seconds = seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = {}
+
+    def failed(self, region_name, choice):
+        with self._lock:
+            self._failures[(region_name, choice)] = self.clock()
+
+    def recently_failed(self, region_name, choice):
+        with self._lock:
+            failed_at = self._failures.get((region_name, choice))
+            return failed_at is not None and self.clock() - failed_at < self.seconds
+
+    def clear(self):
+        with self._lock:
+            self._failures.clear()
+
+
+_capacity_memory = CapacityMemory()
+
+
+def capacity_memory():
+    """ The CapacityMemory every launch in this process shares """
+    return _capacity_memory
+
+
+def run_instances_with_fallback(ec2, region_name, choices, arguments_for, memory=None):
+    """ Call run_instances with the arguments for each choice in turn, until one launches.
+    The choices that failed recently are tried last rather than not at all, since capacity comes back.
+    Returns (the run_instances response, the choice that worked). Errors other than capacity errors are raised
+    straight away, and if every choice fails the last capacity error is raised.
+    Arguments:
+    - arguments_for - makes the run_instances arguments for a LaunchChoice
+    - memory - where capacity failures are remembered, capacity_memory() by default
+    """
+    from botocore.exceptions import ClientError
+    log = logging.getLogger(__name__)
+    memory = memory or capacity_memory()
+    ordered = sorted(choices, key=lambda choice: memory.recently_failed(region_name, choice))
+    last_error = None
+    for choice in ordered:
+        try:
+            return ec2.run_instances(**arguments_for(choice)), choice
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in CAPACITY_ERROR_CODES:
+                raise
+            log.warning(f"{region_name}: no capacity for {choice}, trying the next choice: {e}")
+            memory.failed(region_name, choice)
+            last_error = e
+    raise last_error
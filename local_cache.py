@@ -0,0 +1,35 @@
+"""
+Small files these scripts keep between runs, so that each new process doesn't have to ask AWS the same questions again.
+They live in $XDG_CACHE_HOME/ensemble-machine (usually ~/.cache/ensemble-machine) and can be deleted at any time.
+"""
+import json
+import logging
+import os
+import pathlib
+
+
+def cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    directory = pathlib.Path(base) / "ensemble-machine"
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def read_json_cache(name):
+    path = cache_directory() / name
+    if not path.exists():
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        logging.getLogger(__name__).warning(f"ignoring corrupt cache file {path}")
+        return {}
+
+
+def write_json_cache(name, data):
+    path = cache_directory() / name
+    temporary = path.with_suffix(".tmp")
+    with open(temporary, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary, path)
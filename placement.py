@@ -0,0 +1,78 @@
+"""
+Spread the rooms of a large classroom over several regions, instead of putting them all in one region
+where its vCPU quota caps the classroom and participants far away get a slow connection.
+
+Each region in aws_zones.json can say how many of the participants should be near it, and how many rooms it
+may have at most:
+
+    "eu-north-1": {"image_id": ..., "placement_weight": 3, "max_rooms": 20}
+
+Rooms are handed out one at a time to the region with the highest weight per room it already has,
+among the regions with room to spare, so they end up in proportion to the weights. A region with a weight of 0
+only gets rooms when the others are full. The vCPU quota headroom of every region is read in parallel first.
+"""
+import logging
+from dataclasses import dataclass
+
+import aws_clients
+from launch_fallback import instance_types
+from quotas import vcpu_headroom, vcpus_for_instance_types, InsufficientVcpuQuota
+from region_executor import RegionExecutor
+
+DEFAULT_PLACEMENT_WEIGHT = 1
+
+
+@dataclass
+class RegionCapacity:
+    region_name: str
+    weight: float = DEFAULT_PLACEMENT_WEIGHT
+    max_rooms: int = None
+
+    def has_room_for(self, rooms):
+        return self.max_rooms is None or rooms < self.max_rooms
+
+
+def region_capacities(config, region_names, region_executor=None):
+    """ A RegionCapacity for each region that could be read, limited by max_rooms and the region's vCPU headroom
+    for rooms of the largest instance type they might be launched as """
+    log = logging.getLogger(__name__)
+
+    def capacity(region_name):
+        region_config = config.region(region_name)
+        ec2 = aws_clients.client("ec2", region_name, config.profile_name)
+        limits = [region_config["max_rooms"]] if "max_rooms" in region_config else []
+        headroom = vcpu_headroom(ec2, aws_clients.client("service-quotas", region_name, config.profile_name))
+        if headroom is not None:
+            vcpus = vcpus_for_instance_types(ec2, instance_types(region_config, config.aws_defaults))
+            limits.append(max(headroom, 0) // vcpus)
+        return RegionCapacity(region_name, region_config.get("placement_weight", DEFAULT_PLACEMENT_WEIGHT),
+                              min(limits) if limits else None)
+
+    capacities, failures = (region_executor or RegionExecutor()).results(capacity, region_names)
+    for region_name, error in failures.items():
+        log.warning(f"not placing rooms in {region_name}, couldn't find out how many fit: {error}")
+    return [capacities[region_name] for region_name in region_names if region_name in capacities]
+
+
+def plan_placement(room_count, capacities):
+    """ {region_name: number of rooms}, in the order of capacities.
+    Raises InsufficientVcpuQuota if the regions can't take room_count rooms between them.
+    """
+    plan = {capacity.region_name: 0 for capacity in capacities}
+    for _ in range(room_count):
+        candidates = [capacity for capacity in capacities if capacity.has_room_for(plan[capacity.region_name])]
+        if not candidates:
+            raise InsufficientVcpuQuota(
+                f"{room_count} rooms don't fit in {', '.join(plan) or 'no regions'} - "
+                f"there is only room for {sum(plan.values())}")
+        chosen = max(candidates, key=lambda capacity: capacity.weight / (plan[capacity.region_name] + 1))
+        plan[chosen.region_name] += 1
+    return {region_name: rooms for region_name, rooms in plan.items() if rooms}
+
+
+def place_rooms(instances, plan):
+    """ Set the region of each room according to the plan, in room order """
+    regions = [region_name for region_name, rooms in plan.items() for _ in range(rooms)]
+    for instance, region_name in zip(instances, regions):
+        instance.region_name = region_name
+    return instances
@@ -0,0 +1,79 @@
+"""
+Check the account's EC2 vCPU quota before launching machines,
+so that a large classroom fails straight away instead of halfway through.
+"""
+import logging
+import re
+
+# "Running On-Demand Standard (A, C, D, H, I, M, R, T, Z) instances" - the quota t3 and m5 machines count against
+STANDARD_INSTANCES_VCPU_QUOTA_CODE = "L-1216C47A"
+# the letters an instance type starts with if it counts against that quota. G, P, X, F, Inf, DL, HPC and
+# the others have quotas of their own.
+STANDARD_INSTANCE_FAMILIES = {"a", "c", "d", "h", "i", "im", "is", "m", "r", "t", "z"}
+
+ACTIVE_INSTANCE_STATES = ["pending", "running"]
+
+
+class InsufficientVcpuQuota(Exception):
+    pass
+
+
+def vcpus_for_instance_types(ec2, instance_types):
+    """ The vCPUs of the largest of the instance types, which is what a machine that may be launched as any of them
+    can need - see launch_fallback.py """
+    response = ec2.describe_instance_types(InstanceTypes=sorted(set(instance_types)))
+    return max(instance_type["VCpuInfo"]["DefaultVCpus"] for instance_type in response["InstanceTypes"])
+
+
+def is_standard(instance_type):
+    """ Whether instances of this type count against the standard instances quota """
+    return re.match(r"[a-z]*", instance_type).group() in STANDARD_INSTANCE_FAMILIES
+
+
+def vcpus_in_use(ec2):
+    """ Count the vCPUs of the pending and running instances that count against the standard instances quota,
+    in the region the client is connected to """
+    total = 0
+    paginator = ec2.get_paginator("describe_instances")
+    pages = paginator.paginate(Filters=[{"Name": "instance-state-name", "Values": ACTIVE_INSTANCE_STATES}])
+    for page in pages:
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                if not is_standard(instance["InstanceType"]):
+                    continue
+                cpu_options = instance.get("CpuOptions", {})
+                total += cpu_options.get("CoreCount", 1) * cpu_options.get("ThreadsPerCore", 1)
+    return total
+
+
+def vcpu_quota(service_quotas):
+    response = service_quotas.get_service_quota(ServiceCode="ec2", QuotaCode=STANDARD_INSTANCES_VCPU_QUOTA_CODE)
+    return int(response["Quota"]["Value"])
+
+
+def vcpu_headroom(ec2, service_quotas):
+    """ How many more vCPUs can be started in this region, or None if the quota can't be read """
+    from botocore.exceptions import ClientError
+    log = logging.getLogger(__name__)
+    try:
+        quota = vcpu_quota(service_quotas)
+    except ClientError as e:
+        log.warning(f"couldn't read the vCPU quota, launching without checking it: {e}")
+        return None
+    return quota - vcpus_in_use(ec2)
+
+
+def check_vcpu_headroom(ec2, service_quotas, region_name, instance_types, machine_count):
+    """ Raise InsufficientVcpuQuota if starting machine_count instances, each of which might be launched as
+    the largest of instance_types, could exceed the quota """
+    headroom = vcpu_headroom(ec2, service_quotas)
+    if headroom is None:
+        return
+    needed = vcpus_for_instance_types(ec2, instance_types) * machine_count
+    launched_as = " or ".join(instance_types)
+    logging.getLogger(__name__).info(f"{region_name}: {machine_count} x {launched_as} needs up to {needed} vCPUs, "
+                                     f"{headroom} available")
+    if needed > headroom:
+        raise InsufficientVcpuQuota(
+            f"{machine_count} x {launched_as} needs up to {needed} vCPUs in {region_name} but only {headroom} are "
+            f"available under the account's vCPU quota - request a quota increase or use a smaller classroom")
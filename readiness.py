@@ -0,0 +1,197 @@
+"""
+Find out when the rooms of a classroom are actually usable: their name resolves, nginx has a certificate
+and answers https, and projector answers behind it. All the rooms are probed at once, each backing off on its own,
+and a table shows how far each room has got while they come up.
+
+summon.py waits for the rooms it launched this way, and classroom.py wait-ready does the same for a classroom file.
+"""
+import asyncio
+import contextlib
+import logging
+import random
+import socket
+import ssl
+import sys
+import time
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+# the stage a room is waiting for - each comes after the one before it
+DNS = "dns"
+TLS = "tls"
+PROJECTOR = "projector"
+READY = "ready"
+
+
+class NotReady(Exception):
+    def __init__(self, stage, message):
+        super().__init__(f"{stage}: {message}")
+        self.stage = stage
+        self.message = message
+
+
+@dataclass
+class RoomReadiness:
+    url: str
+    stage: str = DNS
+    attempts: int = 0
+    seconds: float = None
+    error: str = None
+
+    @property
+    def ready(self):
+        return self.stage == READY
+
+
+def describe(error):
+    return str(error) or type(error).__name__
+
+
+class ReadinessProber:
+    def __init__(self, deadline=1200, initial_delay=2.0, max_delay=30.0, timeout=10.0, max_concurrency=50,
+                 ssl_context=None, clock=time.monotonic):
+        """ Probes rooms over https until they are ready or the deadline has passed.
+        Arguments:
+        - deadline - seconds to wait for all the rooms, counted from when waiting starts
+        - initial_delay, max_delay - the seconds between attempts on one room start at initial_delay and double,
+          with jitter, up to max_delay
+        - timeout - seconds each of the dns lookup, the tls handshake and the http request may take
+        - max_concurrency - how many rooms are probed at the same moment
+        - ssl_context - what the certificates are checked against, the system's trusted CAs by default
+        """
+        self.log = logging.getLogger(__name__)
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.clock = clock
+
+    def wait_ready(self, urls, progress=None, since=None):
+        """ Returns a RoomReadiness for every url, in the same order, once they are all ready or the deadline
+        has passed. progress is called with all of them every time one of them changes.
+        since is the time on the prober's clock that the seconds until a room is ready are counted from,
+        e.g. when the rooms were launched - by default when waiting starts.
+        """
+        return asyncio.run(self.wait_all(urls, progress, since))
+
+    async def wait_all(self, urls, progress=None, since=None):
+        rooms = [RoomReadiness(url) for url in urls]
+        started = self.clock()
+        since = started if since is None else since
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        def changed():
+            if progress:
+                progress(rooms)
+
+        changed()
+        await asyncio.gather(*(self.wait_until_ready(room, started, since, semaphore, changed) for room in rooms))
+        return rooms
+
+    async def wait_until_ready(self, room, started, since, semaphore, changed):
+        delay = self.initial_delay
+        while True:
+            room.attempts += 1
+            async with semaphore:
+                try:
+                    await self.check(room.url)
+                except NotReady as e:
+                    room.stage, room.error = e.stage, e.message
+                else:
+                    room.stage, room.error = READY, None
+                    room.seconds = self.clock() - since
+                    self.log.debug(f"{room.url} ready after {room.seconds:.1f}s")
+                    changed()
+                    return
+            changed()
+            remaining = self.deadline - (self.clock() - started)
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(delay * random.uniform(0.5, 1.0), remaining))
+            delay = min(delay * 2, self.max_delay)
+
+    async def check(self, url):
+        """ Raises NotReady with the first stage that doesn't work yet """
+        parsed = urlparse(url.strip())
+        host, port = parsed.hostname, parsed.port or 443
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise NotReady(DNS, describe(e))
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=self.ssl_context, server_hostname=host), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise NotReady(TLS, describe(e))
+        try:
+            writer.write(f"GET / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise NotReady(PROJECTOR, describe(e))
+        finally:
+            writer.close()
+            with contextlib.suppress(OSError, asyncio.TimeoutError):
+                await asyncio.wait_for(writer.wait_closed(), self.timeout)
+        # nginx answers 502 until projector is listening behind it
+        status = status_line.decode(errors="replace").split()
+        if len(status) < 2 or status[1] != "200":
+            raise NotReady(PROJECTOR, " ".join(status[1:]) or "no response")
+
+
+def readiness_table(rooms):
+    lines = [f"{'url':50} {'waiting for':11} {'tries':>5} {'ready after':>11}  details"]
+    for room in rooms:
+        ready_after = f"{room.seconds:10.1f}s" if room.seconds is not None else ""
+        lines.append(f"{room.url.strip():50} {'-' if room.ready else room.stage:11} {room.attempts:5} "
+                     f"{ready_after:>11}  {room.error or ''}".rstrip())
+    ready = sum(1 for room in rooms if room.ready)
+    lines.append(f"{ready} of {len(rooms)} rooms ready")
+    return lines
+
+
+class ProgressTable:
+    def __init__(self, stream=None):
+        """ Shows readiness_table while the rooms come up. On a terminal the table is redrawn in place;
+        otherwise a line is printed whenever a room moves on to another stage.
+        """
+        self.stream = stream or sys.stdout
+        self.live = self.stream.isatty()
+        self._drawn_lines = 0
+        self._stages = {}
+
+    def __call__(self, rooms):
+        if self.live:
+            lines = readiness_table(rooms)
+            # move back up over the previous table and clear it
+            erase = f"\x1b[{self._drawn_lines}F\x1b[J" if self._drawn_lines else ""
+            self.stream.write(erase + "\n".join(lines) + "\n")
+            self._drawn_lines = len(lines)
+        else:
+            for room in rooms:
+                if self._stages.get(room.url) not in (None, room.stage):
+                    self.stream.write(f"{room.url.strip()}: " + (f"ready after {room.seconds:.1f}s\n" if room.ready
+                                                               else f"waiting for {room.stage}\n"))
+                self._stages[room.url] = room.stage
+        self.stream.flush()
+
+
+def wait_for_rooms(urls, prober=None, stream=None, since=None):
+    """ Wait for the rooms while showing their progress, and return a RoomReadiness for each.
+    Unless the table was redrawn live, it is printed in full once at the end, followed by an ERROR line
+    for every room that isn't ready. since is passed on to ReadinessProber.wait_ready.
+    """
+    stream = stream or sys.stdout
+    progress = ProgressTable(stream)
+    rooms = (prober or ReadinessProber()).wait_ready(urls, progress, since)
+    if not progress.live:
+        stream.write("\n".join(readiness_table(rooms)) + "\n")
+    for room in rooms:
+        if not room.ready:
+            stream.write(f"ERROR: {room.url.strip()} isn't ready, still waiting for {room.stage}"
+                         f"{': ' + room.error if room.error else ''}\n")
+    stream.flush()
+    return rooms
@@ -0,0 +1,107 @@
+"""
+Run the same piece of work in several AWS regions at once.
+Every multi-region command uses this, so the wall-clock time is that of the slowest region rather than the sum of all of them.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+
+
+@dataclass
+class RegionOutcome:
+    region_name: str
+    result: object = None
+    error: Exception = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class RegionTimeout(Exception):
+    pass
+
+
+_deadlines = threading.local()
+
+
+def check_deadline():
+    """ Raise RegionTimeout if the region this thread is working on has run out of time.
+    request_scheduler calls this before every AWS call.
+    """
+    deadline = getattr(_deadlines, "deadline", None)
+    if deadline is not None and time.monotonic() > deadline:
+        raise RegionTimeout(f"{_deadlines.region_name} timed out after {_deadlines.timeout}s")
+
+
+class RegionExecutor:
+    def __init__(self, max_workers=8, timeout=60):
+        """ A RegionExecutor calls a task once per region on a bounded pool of threads.
+        Arguments:
+        - max_workers - how many regions to work on at the same time
+        - timeout - seconds a single region may take, counted from when its task starts. A region that
+          takes longer is reported as failed with RegionTimeout, and its result is ignored if it arrives later.
+          Its thread isn't waited for, but its next AWS call raises RegionTimeout, see check_deadline, so the work
+          stops there. A call that is already in flight runs until botocore's own timeouts end it.
+        """
+        self.log = logging.getLogger(__name__)
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def outcomes(self, task, region_names):
+        """ Call task(region_name) for each region and yield a RegionOutcome for each one as soon as it finishes.
+        A region that raises or times out is yielded with its error set; the other regions carry on.
+        """
+        region_names = list(region_names)
+        if not region_names:
+            return
+        started = {}
+
+        def timed_task(region_name):
+            started[region_name] = time.monotonic()
+            _deadlines.deadline = started[region_name] + self.timeout
+            _deadlines.region_name = region_name
+            _deadlines.timeout = self.timeout
+            try:
+                return task(region_name)
+            finally:
+                _deadlines.deadline = None
+
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(region_names)))
+        try:
+            pending = {executor.submit(timed_task, region_name): region_name for region_name in region_names}
+            while pending:
+                done, _ = wait(pending, timeout=self._time_to_next_deadline(pending, started), return_when=FIRST_COMPLETED)
+                for future in done:
+                    region_name = pending.pop(future)
+                    try:
+                        yield RegionOutcome(region_name, result=future.result())
+                    except Exception as e:
+                        self.log.error(f"{region_name}: {e}")
+                        yield RegionOutcome(region_name, error=e)
+                for future, region_name in list(pending.items()):
+                    if region_name in started and time.monotonic() - started[region_name] > self.timeout:
+                        del pending[future]
+                        self.log.error(f"{region_name}: no answer after {self.timeout}s")
+                        yield RegionOutcome(region_name, error=RegionTimeout(f"{region_name} timed out after {self.timeout}s"))
+        finally:
+            # don't hold the caller up waiting for threads stuck in a region that timed out
+            executor.shutdown(wait=False)
+
+    def results(self, task, region_names):
+        """ Run task in every region and return ({region_name: result}, {region_name: error}) """
+        results, failures = {}, {}
+        for outcome in self.outcomes(task, region_names):
+            if outcome.ok:
+                results[outcome.region_name] = outcome.result
+            else:
+                failures[outcome.region_name] = outcome.error
+        return results, failures
+
+    def _time_to_next_deadline(self, pending, started):
+        deadlines = [started[region_name] + self.timeout for region_name in pending.values() if region_name in started]
+        if not deadlines:
+            return self.timeout
+        return max(0.0, min(deadlines) - time.monotonic())
@@ -0,0 +1,223 @@
+"""
+Run the same shell command on many ensemble machines at once, over ssh.
+Used by clone_kata.py and download_plugin.py, so that a whole classroom takes about as long as its slowest machine.
+"""
+import atexit
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from local_cache import cache_directory
+
+
+@dataclass
+class HostResult:
+    machine: object
+    exit_status: int = None
+    stdout: str = ""
+    stderr: str = ""
+    error: str = None
+    seconds: float = 0.0
+    attempts: int = 1
+
+    @property
+    def ok(self):
+        return self.error is None and self.exit_status == 0
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return "error"
+        return "ok" if self.exit_status == 0 else f"exit {self.exit_status}"
+
+
+class KeyFiles:
+    def __init__(self, config):
+        """ The private key for each region's key pair in aws_zones.json, looked up once per region """
+        self.config = config
+        self._key_files = {}
+
+    def for_region(self, region_name):
+        if region_name not in self._key_files:
+            key_name = self.config.region(region_name)["key_name"]
+            self._key_files[region_name] = os.path.expanduser(f"~/.ssh/{key_name}.pem")
+        return self._key_files[region_name]
+
+
+class ConnectionCache:
+    def __init__(self, max_idle=300):
+        """ Keeps ssh connections open between commands, so each machine pays for the handshake only once.
+        Connections that haven't been used for max_idle seconds are closed the next time the cache is used.
+        """
+        self.log = logging.getLogger(__name__)
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def get(self, key, connect):
+        """ The cached connection for key, or a new one made by calling connect() """
+        self.evict_idle()
+        with self._lock:
+            if key not in self._connections:
+                self._connections[key] = [connect(), time.monotonic()]
+            entry = self._connections[key]
+            entry[1] = time.monotonic()
+            return entry[0]
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, (_, last_used) in self._connections.items() if now - last_used > self.max_idle]
+            evicted = [self._connections.pop(key)[0] for key in idle]
+        for connection in evicted:
+            self.log.debug(f"closing idle connection {connection}")
+            connection.close()
+
+    def close_all(self):
+        with self._lock:
+            connections = [connection for connection, _ in self._connections.values()]
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+# shared by every FabricTransport in the process, so a script that runs several commands reuses the connections
+connection_cache = ConnectionCache()
+atexit.register(connection_cache.close_all)
+
+
+class FabricTransport:
+    def __init__(self, config, user="ubuntu", port=22, connect_timeout=15, connections=None):
+        """ Runs commands over ssh with fabric, using the key pair configured for each machine's region in aws_zones.json.
+        Authenticated connections are kept in a ConnectionCache and reused by later commands to the same machine.
+        user and port can be changed to point it at a local sshd container for testing.
+        """
+        self.key_files = KeyFiles(config)
+        self.user = user
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.connections = connections or connection_cache
+
+    def connect(self, machine):
+        from fabric import Connection
+        return Connection(host=machine.host_ip.strip(), user=self.user, port=self.port, connect_timeout=self.connect_timeout,
+                          connect_kwargs={"key_filename": self.key_files.for_region(machine.region_name)})
+
+    def run(self, machine, commandline, timeout):
+        """ returns (exit status, stdout, stderr) """
+        key = (self.user, machine.host_ip.strip(), self.port)
+        connection = self.connections.get(key, lambda: self.connect(machine))
+        result = connection.run(commandline, hide=True, warn=True, timeout=timeout)
+        return result.exited, result.stdout, result.stderr
+
+
+class OpenSshTransport:
+    def __init__(self, config, user="ubuntu", port=22, connect_timeout=15, control_persist="10m"):
+        """ Runs commands with the ssh command line client, sharing one master connection per machine through a
+        control socket. The master stays up for control_persist after the last command, so later runs of
+        clone_kata.py, download_plugin.py and friends skip the handshake too.
+        """
+        self.key_files = KeyFiles(config)
+        self.user = user
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.control_persist = control_persist
+        self.control_directory = cache_directory() / "ssh"
+        self.control_directory.mkdir(mode=0o700, exist_ok=True)
+
+    def ssh_command(self, machine, commandline):
+        return [
+            "ssh",
+            "-i", self.key_files.for_region(machine.region_name),
+            "-p", str(self.port),
+            "-o", "BatchMode=yes",
+            "-o", "StrictHostKeyChecking=accept-new",
+            "-o", f"ConnectTimeout={self.connect_timeout}",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={self.control_directory}/%C",
+            "-o", f"ControlPersist={self.control_persist}",
+            f"{self.user}@{machine.host_ip.strip()}",
+            commandline,
+        ]
+
+    def run(self, machine, commandline, timeout):
+        """ returns (exit status, stdout, stderr) - ssh itself exits with 255 if it couldn't connect """
+        completed = subprocess.run(self.ssh_command(machine, commandline), capture_output=True, text=True,
+                                   timeout=timeout, stdin=subprocess.DEVNULL)
+        return completed.returncode, completed.stdout, completed.stderr
+
+
+class RemoteExecutor:
+    def __init__(self, transport, max_workers=10, timeout=300):
+        """ A RemoteExecutor runs a command on several machines at the same time.
+        Arguments:
+        - transport - something with a run(machine, commandline, timeout) method returning (exit status, stdout, stderr)
+        - max_workers - how many machines to work on at once
+        - timeout - seconds the command may run on a single machine before that machine counts as failed
+        """
+        self.log = logging.getLogger(__name__)
+        self.transport = transport
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def run(self, commandline, machines, retries=0):
+        """ Run commandline on every machine and return a HostResult for each, in the same order as machines.
+        Machines that fail are tried again up to retries more times; machines that succeeded are left alone.
+        """
+        results = self._run_on(commandline, machines)
+        for _ in range(retries):
+            if all(result.ok for result in results):
+                break
+            results = self.retry_failed(commandline, results)
+        return results
+
+    def retry_failed(self, commandline, results):
+        """ Run commandline again on just the machines that failed in an earlier run, and return the updated results """
+        failed = [index for index, result in enumerate(results) if not result.ok]
+        self.log.info(f"retrying {len(failed)} failed machines")
+        retried = self._run_on(commandline, [results[index].machine for index in failed])
+        updated = list(results)
+        for index, result in zip(failed, retried):
+            result.attempts = results[index].attempts + 1
+            updated[index] = result
+        return updated
+
+    def _run_on(self, commandline, machines):
+        if not machines:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(machines))) as executor:
+            return list(executor.map(lambda machine: self._run_one(commandline, machine), machines))
+
+    def _run_one(self, commandline, machine):
+        self.log.info(f"will run remote commands on {machine.url}")
+        start = time.monotonic()
+        try:
+            exit_status, stdout, stderr = self.transport.run(machine, commandline, self.timeout)
+            result = HostResult(machine, exit_status=exit_status, stdout=stdout, stderr=stderr)
+        except Exception as e:
+            result = HostResult(machine, error=f"{type(e).__name__}: {e}")
+        result.seconds = time.monotonic() - start
+        if not result.ok:
+            self.log.warning(f"{machine.url}: {result.status} {result.error or result.stderr.strip()}")
+        return result
+
+
+def summary_table(results):
+    """ One line per machine, plus a total - for printing at the end of a run """
+    lines = [f"{'url':50} {'ip':16} {'status':8} {'seconds':>8} {'tries':>5}  details"]
+    for result in results:
+        details = "" if result.ok else (result.error or last_line(result.stderr))
+        lines.append(f"{result.machine.url.strip():50} {result.machine.host_ip.strip():16} {result.status:8} "
+                     f"{result.seconds:8.1f} {result.attempts:5}  {details}".rstrip())
+    succeeded = sum(1 for result in results if result.ok)
+    lines.append(f"{succeeded} of {len(results)} machines succeeded")
+    return lines
+
+
+def last_line(text):
+    lines = text.strip().splitlines()
+    return lines[-1] if lines else ""
@@ -0,0 +1,184 @@
+"""
+Keeps AWS calls under the rate the services will accept, so that adding parallelism doesn't just buy throttling errors.
+Each service and region gets a token bucket. Its rate goes up a little with every call that goes through,
+and is halved when AWS throttles a call (additive increase, multiplicative decrease).
+Callers waiting on the same bucket are served in priority order, e.g. DNS updates for machines that just came up
+go ahead of background work like refilling a warm pool.
+
+aws_clients attaches the scheduler to every client, so every call goes through it. Use priority() around
+the calls that matter most, or least:
+
+    with request_scheduler.priority(request_scheduler.HIGH):
+        route53.change_resource_record_sets(...)
+"""
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from api_metrics import THROTTLING_ERROR_CODES
+from region_executor import check_deadline
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+
+@dataclass
+class BucketLimits:
+    rate: float
+    burst: float
+    max_rate: float
+    min_rate: float = 0.5
+
+
+# the documented request rates - the EC2 API and Route53 throttle per account and region, Route53 globally
+SERVICE_LIMITS = {
+    "ec2": BucketLimits(rate=20, burst=100, max_rate=100),
+    "route53": BucketLimits(rate=5, burst=5, max_rate=5),
+}
+DEFAULT_LIMITS = BucketLimits(rate=10, burst=20, max_rate=50)
+GLOBAL_SERVICES = {"route53", "iam"}
+
+_priorities = threading.local()
+
+
+@contextlib.contextmanager
+def priority(level):
+    """ AWS calls made by this thread inside the with block wait in line at this priority """
+    previous = current_priority()
+    _priorities.level = level
+    try:
+        yield
+    finally:
+        _priorities.level = previous
+
+
+def current_priority():
+    return getattr(_priorities, "level", NORMAL)
+
+
+def prioritized(level, function):
+    """ function, made to run at this priority - for work handed to another thread, e.g. through an executor """
+    def at_priority(*args, **kwargs):
+        with priority(level):
+            return function(*args, **kwargs)
+    return at_priority
+
+
+class TokenBucket:
+    def __init__(self, limits, increase=1.0, decrease=0.5, clock=time.monotonic):
+        """ Hands out one token per call, at a rate that adapts to throttling.
+        Arguments:
+        - limits - the starting rate, the burst size, and the range the rate stays in, in calls per second
+        - increase - how much the rate goes up for every second's worth of calls that aren't throttled
+        - decrease - what the rate is multiplied by when a call is throttled. It is only cut once per second,
+          since the calls that were already in flight will be throttled too.
+        """
+        self.limits = limits
+        self.rate = limits.rate
+        self.tokens = limits.burst
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self._updated = clock()
+        self._last_decrease = None
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._tickets = itertools.count()
+
+    def acquire(self, level=NORMAL):
+        """ Block until a token is free and no caller of a higher priority, or who came earlier, is waiting.
+        Returns the seconds spent waiting.
+        """
+        started = self.clock()
+        with self._condition:
+            ticket = (level, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                self._refill()
+                if self._waiting[0] == ticket and self.tokens >= 1:
+                    heapq.heappop(self._waiting)
+                    self.tokens -= 1
+                    self._condition.notify_all()
+                    return self.clock() - started
+                timeout = (1 - self.tokens) / self.rate if self._waiting[0] == ticket else None
+                self._condition.wait(timeout)
+
+    def succeeded(self):
+        with self._condition:
+            self.rate = min(self.limits.max_rate, self.rate + self.increase / self.rate)
+
+    def throttled(self):
+        with self._condition:
+            now = self.clock()
+            if self._last_decrease is not None and now - self._last_decrease < 1:
+                return
+            self._last_decrease = now
+            self._refill()
+            self.rate = max(self.limits.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.limits.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RequestScheduler:
+    def __init__(self, service_limits=None, default_limits=DEFAULT_LIMITS):
+        """ One TokenBucket per service and region, created when the first call to it is made """
+        self.log = logging.getLogger(__name__)
+        self.service_limits = SERVICE_LIMITS if service_limits is None else service_limits
+        self.default_limits = default_limits
+        self._lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, service_name, region_name):
+        key = (service_name, None if service_name in GLOBAL_SERVICES else region_name)
+        with self._lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.service_limits.get(service_name, self.default_limits))
+            return self.buckets[key]
+
+    def reset(self):
+        with self._lock:
+            self.buckets.clear()
+
+    def attach(self, client):
+        client.meta.events.register("before-parameter-build", self._before_call)
+        client.meta.events.register("response-received", self._attempt_received)
+        client.meta.events.register("after-call", self._after_call)
+
+    def detach(self, client):
+        client.meta.events.unregister("before-parameter-build", self._before_call)
+        client.meta.events.unregister("response-received", self._attempt_received)
+        client.meta.events.unregister("after-call", self._after_call)
+
+    def _before_call(self, model, context, **kwargs):
+        # work in a region that has timed out stops here rather than carrying on in the background
+        check_deadline()
+        bucket = self.bucket(model.service_model.service_name, context.get("client_region"))
+        context["request_scheduler_bucket"] = bucket
+        waited = bucket.acquire(current_priority())
+        if waited > 1:
+            self.log.debug(f"{model.service_model.service_name}.{model.name} waited {waited:.1f}s for its turn")
+
+    def _attempt_received(self, parsed_response, context, **kwargs):
+        """ Every attempt at a call, including the ones botocore retries. Only throttling cuts the rate -
+        a retry after a 5xx error or a dropped connection says nothing about how fast the calls can go.
+        """
+        bucket = context.get("request_scheduler_bucket")
+        if bucket is None:
+            return
+        if (parsed_response or {}).get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            context["request_scheduler_throttled"] = True
+            bucket.throttled()
+
+    def _after_call(self, context, **kwargs):
+        bucket = context.get("request_scheduler_bucket")
+        if bucket is not None and not context.get("request_scheduler_throttled"):
+            bucket.succeeded()
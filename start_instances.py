@@ -8,6 +8,7 @@ import logging
 
 import click
 
+from cli_options import cached_option, profile_option
 from wrap_ec2_client import InstancesManager
 
 
@@ -22,14 +23,20 @@ from wrap_ec2_client import InstancesManager
     default="default",
     help="the name of the machine to start"
 )
-def main(aws_profile, name):
+@cached_option
+@profile_option
+def main(aws_profile, name, fresh):
     logging.basicConfig(level=logging.INFO)
 
-    from summon import read_aws_defaults, read_regions_config
-    aws_defaults = read_aws_defaults(profile_name=aws_profile)
-    regions = read_regions_config(profile_name=aws_profile).keys()
-    manager = InstancesManager(aws_defaults, regions, profile_name=aws_profile)
+    from configuration import configuration
+    config = configuration(aws_profile)
+    aws_defaults = config.aws_defaults
+    regions = config.region_names()
+    from inventory import Inventory
+    manager = InstancesManager(aws_defaults, regions, profile_name=aws_profile, inventory=Inventory(), fresh=fresh)
     manager.start_machine(name)
+    for region, error in manager.region_failures.items():
+        print(f"ERROR: couldn't start machines in {region}: {error}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
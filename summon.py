@@ -1,104 +1,287 @@
 #!/usr/bin/env python3
 import logging
 import csv
-import json
+import hashlib
 import os
-import pathlib
 import secrets
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import boto3
 import click
 from dataclasses import dataclass
 
 logging.basicConfig(level=logging.INFO)
 
+import aws_clients
+import request_scheduler
+from cli_options import ConfigDependentOption, ide_config_names, region_names, profile_option
+from configuration import configuration, read_ide_config, read_regions_config, read_aws_defaults
+from inventory import Inventory
+from ide_tuning import tuning_commands, instance_type_sizes
+from launch_fallback import launch_choices, instance_types, run_instances_with_fallback
+from placement import region_capacities, plan_placement, place_rooms
+from quotas import check_vcpu_headroom
+from readiness import ReadinessProber, wait_for_rooms
+from region_executor import RegionExecutor
 from update_dns import DnsUpdater
+from warm_pool import WarmPool, POOL_TAG, POOL_NAME_PREFIX
+from wrap_ec2_client import AddressWaiter, AddressWaitTimeout
+
+
+# In a batched launch every room shares the same user data, so each machine
+# reads its own dns name from its Name tag when it boots. summon.py tags the machines right after launching them,
+# and terminates any it couldn't tag, so a machine that still has no Name after a while gives up.
+DNS_NAME_FROM_NAME_TAG = "${DNS_NAME}"
+NAME_TAG_WAIT_SECONDS = 600
+READ_DNS_NAME_FROM_NAME_TAG = f"""\
+imds() {{
+  TOKEN=$(curl -sf -X PUT http://169.254.169.254/latest/api/token -H "X-aws-ec2-metadata-token-ttl-seconds: 60")
+  curl -sf -H "X-aws-ec2-metadata-token: $TOKEN" "http://169.254.169.254/latest/meta-data/$1"
+}}
+NAME_TAG_WAITED=0
+until DNS_NAME=$(imds tags/instance/Name); do
+  if [ "$NAME_TAG_WAITED" -ge {NAME_TAG_WAIT_SECONDS} ]; then
+    echo "ERROR: no Name tag after {NAME_TAG_WAIT_SECONDS}s, so this machine doesn't know which room it is" >&2
+    exit 1
+  fi
+  sleep 2
+  NAME_TAG_WAITED=$((NAME_TAG_WAITED + 2))
+done
+"""
+# create_tags is tried this many times, waiting twice as long after each failure, before a room's machine is given up
+NAME_TAG_ATTEMPTS = 4
+NAME_TAG_RETRY_SECONDS = 1
+
+# Every script records when each of its phases starts and ends, for boot_times.py to collect.
+# One tab separated line per event: boot id, phase, start or end, seconds since the epoch.
+# The boot phase is the time from the kernel starting until the script does.
+BOOT_PHASES_FILE = "/var/log/ensemble-boot-phases.tsv"
+RECORD_BOOT_PHASES = f"""\
+phase() {{
+  printf '%s\\t%s\\t%s\\t%s\\n' "$(cat /proc/sys/kernel/random/boot_id)" "$1" "$2" "${{3:-$(date +%s.%N)}}" | \\
+    sudo tee -a {BOOT_PHASES_FILE} > /dev/null
+}}
+phase boot start "$(awk -v now="$(date +%s.%N)" '{{printf "%.3f", now - $1}}' /proc/uptime)"
+phase boot end
+"""
 
+# run_step NAME "DEPENDENCIES" waits for the steps it comes after, then runs the function step_NAME as a phase.
+# It leaves NAME.failed behind instead of NAME.done if the step fails, or one of the steps it comes after did.
+RUN_STEP = """\
+STEPS=$(mktemp -d)
+run_step() {
+  trap "touch '$STEPS/$1.failed'" EXIT
+  for dependency in $2; do
+    until [ -e "$STEPS/$dependency.done" ]; do
+      if [ -e "$STEPS/$dependency.failed" ]; then exit 1; fi
+      sleep 0.2
+    done
+  done
+  phase "$1" start
+  "step_$(echo "$1" | tr - _)"
+  phase "$1" end
+  trap - EXIT
+  touch "$STEPS/$1.done"
+}
+"""
 
-def read_ide_config(config=None):
-    """ ide_config.json contains details of how to install software and configure projector for each kind of IDE you want to be able to summon. """
-    config = config or pathlib.Path().resolve() / "ide_config.json"
-    if not config.exists():
-        logging.warning("missing ide_config.json file, expected to be in current working directory")
-        return {}
-    with open(config) as f:
-        configs = json.load(f)
-        for key in configs.keys():
-            configs[key]["config_name"] = key
-        return configs
 
+def script_header(preamble=""):
+    return f"""\
+#! /bin/sh
+set -ex
+{RECORD_BOOT_PHASES}{RUN_STEP}{preamble}
+"""
 
-def read_regions_config(config=None, profile_name="default"):
-    """ aws_zones.json contains dictionaries for each aws zone you want to be able to summon instances in. """
-    config = config or pathlib.Path().resolve() / "aws_zones.json"
-    assert config.exists(), "missing aws_zones.json file, expected to be in current working directory"
-    with open(config) as f:
-        regions_config = json.load(f)
-        return regions_config[profile_name]
 
+@dataclass
+class Step:
+    """ One phase of a user data script. It starts once the steps named in after have finished,
+    alongside any other step that is ready. Steps named in after that aren't in the script are ignored,
+    e.g. a baked image has already done the provisioning steps that host_steps come after.
+    """
+    name: str
+    commands: str
+    after: tuple = ()
+
+    @property
+    def function_name(self):
+        return "step_" + self.name.replace("-", "_")
+
+    @property
+    def pid_variable(self):
+        return self.function_name.upper() + "_PID"
+
+
+def render_steps(steps):
+    """ Shell that starts every step as a background job, each waiting for the steps it comes after,
+    and then waits for all of them. The script fails if any step does.
+    """
+    names = {step.name for step in steps}
+    functions = "".join(f"""\
+{step.function_name}() {{
+{step.commands.strip()}
+}}
 
-def read_aws_defaults(config=None, profile_name="default"):
-    """ aws_defaults are values that are set the same for all regions """
-    config = config or pathlib.Path().resolve() / "aws_machine_spec.json"
-    assert config.exists(), "missing aws_machine_spec.json file, expected to be in current working directory"
-    with open(config) as f:
-        aws_defaults = json.load(f)
-        return aws_defaults[profile_name]
+""" for step in steps)
+    jobs = "".join(f"""run_step {step.name} "{' '.join(name for name in step.after if name in names)}" & \
+{step.pid_variable}=$!
+""" for step in steps)
+    waits = "".join(f"wait ${step.pid_variable}\n" for step in steps)
+    return functions + jobs + waits + "\n"
 
 
 def generate_script(dns_name, config_name,
                     name, extra_packages,
-                    snap_packages, environment, note=None):
-    required_packages = [
-        "less",
-        "python3-pip",
-        "libxext6",
-        "libxrender1",
-        "libxtst6",
-        "libfreetype6",
-        "libxi6",
-        "libxss1",
-        "nginx",
-        "certbot",
-        "python3-certbot-nginx",
-    ]
-    packages = required_packages + extra_packages
-    packages_argument = " ".join(packages)
-    snap_packages_to_install = " ".join(snap_packages)
-    install_snap_classic_packages = f"sudo snap install {snap_packages_to_install} --classic" if snap_packages else ""
-    environment_file = "\n".join(f"{key}={value}" for key, value in environment.items())
-    return f"""\
-#! /bin/sh
-set -ex
-
-sudo apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 --recv-keys 3FA7E0328081BFF6A14DA29AA6A19B38D3D831EF
-echo "deb https://download.mono-project.com/repo/ubuntu stable-focal main" | \
-  sudo tee /etc/apt/sources.list.d/mono-official-stable.list
+                    snap_packages, environment, note=None, apt_repositories=(), ide_archive_url=None, tuning=None,
+                    preamble="", cache_host=None, instance_sizes=None):
+    """ The complete user data script for a machine started from a plain ubuntu image.
+    With cache_host, it downloads through that classroom cache node, see cache_node.py.
+    With instance_sizes, the IDE's JVM is sized to whichever of those instance types the machine is,
+    see ide_tuning.py.
+    """
+    steps = provisioning_steps(config_name, name, extra_packages, snap_packages, environment, apt_repositories)
+    if cache_host:
+        from cache_node import room_cache_steps
+        steps = room_cache_steps(cache_host, ide_archive_url) + steps
+    return script_header(preamble) + render_steps(steps + host_steps(dns_name, config_name, tuning, instance_sizes))
+
+
+def generate_provisioning_script(config_name,
+                                 name, extra_packages,
+                                 snap_packages, environment, note=None, apt_repositories=(), ide_archive_url=None,
+                                 tuning=None):
+    """ Everything that is the same for every machine with this config - what bake.py puts into an image """
+    steps = provisioning_steps(config_name, name, extra_packages, snap_packages, environment, apt_repositories)
+    return script_header() + render_steps(steps)
+
+
+def generate_boot_script(dns_name, config_name, preamble="", tuning=None, instance_sizes=None):
+    """ The user data script for a machine started from a baked image: only the work that is specific to this machine """
+    return script_header(preamble) + render_steps(host_steps(dns_name, config_name, tuning, instance_sizes))
+
+
+def provisioning_hash(machine_config, base_image_id):
+    """ Identifies what a baked image was built from, so it is rebuilt when the config or the script changes """
+    provisioning_script = generate_provisioning_script(**machine_config)
+    return hashlib.sha256(f"{base_image_id}\n{provisioning_script}".encode()).hexdigest()
+
+
+def generate_pool_script(config_name,
+                         name, extra_packages,
+                         snap_packages, environment, note=None, apt_repositories=(), ide_archive_url=None,
+                         tuning=None, provisioned=False, instance_sizes=None):
+    """ The user data script for a warm pool machine: provision it unless its image is already provisioned,
+    install the service that does the per-host setup once it is claimed, then stop it until it is.
+    """
+    steps = "" if provisioned else render_steps(
+        provisioning_steps(config_name, name, extra_packages, snap_packages, environment, apt_repositories))
+    return script_header() + steps + host_setup_service(config_name, tuning, instance_sizes) + """
+sudo shutdown -h now
+"""
 
-sudo apt update -y
-sudo apt install -y {packages_argument}
 
-{install_snap_classic_packages}
+def host_setup_service(config_name, tuning=None, instance_sizes=None):
+    """ A service that runs host_steps at boot for the name in the machine's Name tag, once per name.
+    Pool machines boot with a pool- name while they are provisioned, so the setup waits until they are claimed.
+    If a step fails, e.g. certbot because the new name didn't resolve in time, systemd runs the setup again.
+    """
+    return f"""\
+cat << 'HOST_SETUP' | sudo tee /usr/local/bin/ensemble-host-setup
+{script_header(READ_DNS_NAME_FROM_NAME_TAG)}
+case "$DNS_NAME" in {POOL_NAME_PREFIX}*) exit 0 ;; esac
+if [ "$(cat /var/lib/ensemble-host-setup 2>/dev/null)" = "$DNS_NAME" ]; then
+  exit 0
+fi
+{render_steps(host_steps(DNS_NAME_FROM_NAME_TAG, config_name, tuning, instance_sizes))}
+echo "$DNS_NAME" > /var/lib/ensemble-host-setup
+HOST_SETUP
+sudo chmod +x /usr/local/bin/ensemble-host-setup
+
+cat << SCRIPT | sudo tee /lib/systemd/system/ensemble-host-setup.service
+[Unit]
+Description=Ensemble machine host setup
+Wants=network-online.target
+After=network-online.target
 
-sudo adduser --gecos "" --disabled-password typist
+[Service]
+Type=oneshot
+ExecStart=/usr/local/bin/ensemble-host-setup
+# the setup is only recorded as done once every step has worked, so a failed one is run again from the start
+Restart=on-failure
+RestartSec=60
 
-sudo -u typist git config --global user.name "Typist"
-sudo -u typist git config --global user.email "typist@example.com"
+[Install]
+WantedBy=multi-user.target
+SCRIPT
 
-sudo -u typist pip3 install projector-installer==1.6.0 --user
+sudo systemctl daemon-reload
+sudo systemctl enable ensemble-host-setup
+"""
 
-sudo -u typist /home/typist/.local/bin/projector \\
- --accept-license autoinstall \\
- --config-name "{config_name}" \\
- --ide-name "{name}" \\
- --port "8080"
 
+REQUIRED_PACKAGES = [
+    "less",
+    "python3-pip",
+    "libxext6",
+    "libxrender1",
+    "libxtst6",
+    "libfreetype6",
+    "libxi6",
+    "libxss1",
+    "nginx",
+    "certbot",
+    "python3-certbot-nginx",
+]
+PROJECTOR_INSTALLER_VERSION = "1.6.0"
+# how long certbot waits for the machine's name to resolve to it, and how many times it asks for a certificate -
+# Let's Encrypt allows 5 failed validations of a name per hour
+DNS_WAIT_SECONDS = 900
+CERTBOT_ATTEMPTS = 4
+
+
+def apt_repository_commands(apt_repositories):
+    """ Commands that add the third party apt repositories an ide config lists, e.g.
+    {"name": "mono-official-stable", "key": "3FA7E0...", "source": "deb https://download.mono-project.com/..."}
+    """
+    return "\n".join(f"""\
+sudo apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 --recv-keys {repository["key"]}
+echo "{repository["source"]}" | sudo tee /etc/apt/sources.list.d/{repository["name"]}.list""" for repository in apt_repositories)
+
+
+def provisioning_steps(config_name, name, extra_packages, snap_packages, environment, apt_repositories=()):
+    """ The Steps that install the IDE and everything it needs. The snap packages and the projector service
+    are independent of each other and of apt. The typist user is added after apt, since the maintainer scripts
+    of the packages apt installs can add users too, and both lock /etc/passwd.
+    The apt and projector steps also come after the artifact-cache and ide-archive steps, when there is a cache node.
+    """
+    packages = REQUIRED_PACKAGES + extra_packages
+    packages_argument = " ".join(packages)
+    snap_packages_to_install = " ".join(snap_packages)
+    environment_lines = "\n".join(f"{key}={value}" for key, value in environment.items())
+    environment_file = f"""\
 cat << ENV | sudo tee -a /etc/environment
-{environment_file}
+{environment_lines}
 ENV
 
-cat << SCRIPT | sudo tee /lib/systemd/system/{config_name}.service
+""" if environment else ""
+    steps = []
+    if apt_repositories:
+        steps.append(Step("apt-repositories", apt_repository_commands(apt_repositories)))
+    steps.append(Step("apt", f"""\
+sudo apt update -y
+sudo apt install -y {packages_argument}
+""", after=("apt-repositories", "artifact-cache")))
+    if snap_packages:
+        steps.append(Step("snap", f"sudo snap install {snap_packages_to_install} --classic"))
+    steps.append(Step("user", """\
+sudo adduser --gecos "" --disabled-password typist
+
+sudo -u typist git config --global user.name "Typist"
+sudo -u typist git config --global user.email "typist@example.com"
+""", after=("apt",)))
+    steps.append(Step("ide-service", f"""\
+{environment_file}cat << SCRIPT | sudo tee /lib/systemd/system/{config_name}.service
 [Unit]
 Description=Jetbrains Projector - {config_name}
 
@@ -114,9 +297,65 @@ SCRIPT
 
 sudo systemctl daemon-reload
 sudo systemctl enable "{config_name}"
-sudo systemctl start "{config_name}"
+"""))
+    steps.append(Step("projector-installer", f"""\
+sudo -u typist pip3 install projector-installer=={PROJECTOR_INSTALLER_VERSION} --user
+""", after=("apt", "user", "artifact-cache")))
+    steps.append(Step("projector-autoinstall", f"""\
+sudo -u typist /home/typist/.local/bin/projector \\
+ --accept-license autoinstall \\
+ --config-name "{config_name}" \\
+ --ide-name "{name}" \\
+ --port "8080"
+""", after=("projector-installer", "ide-archive")))
+    return steps
+
+
+def certbot_commands(dns_name):
+    """ Configure nginx with a let's encrypt certificate. Let's Encrypt looks the name up itself, and a machine
+    can get here within seconds of booting, before summon has sent its A record or Route53 has made it visible.
+    So certbot waits until the name resolves to this machine's public address, and is tried again with backoff,
+    no more often than Let's Encrypt's limit on failed validations allows.
+    """
+    return f"""\
+TOKEN=$(curl -sf -X PUT http://169.254.169.254/latest/api/token -H "X-aws-ec2-metadata-token-ttl-seconds: 60") || true
+PUBLIC_IP=$(curl -sf -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/public-ipv4) || true
+waited=0
+until getent hosts {dns_name} | awk '{{print $1}}' | grep -qxF "$PUBLIC_IP"; do
+  if [ "$waited" -ge {DNS_WAIT_SECONDS} ]; then
+    echo "{dns_name} doesn't resolve to $PUBLIC_IP after {DNS_WAIT_SECONDS}s, asking for a certificate anyway"
+    break
+  fi
+  sleep 10
+  waited=$((waited + 10))
+done
+attempt=1
+delay=30
+until sudo certbot --nginx \
+  --non-interactive \
+  --redirect \
+  --agree-tos \
+  --register-unsafely-without-email \
+  --domain {dns_name}; do
+  if [ "$attempt" -ge {CERTBOT_ATTEMPTS} ]; then
+    exit 1
+  fi
+  sleep "$delay"
+  attempt=$((attempt + 1))
+  delay=$((delay * 2))
+done
+"""
+
 
-#configure nginx
+def host_steps(dns_name, config_name, tuning=None, instance_sizes=None):
+    """ The Steps that are specific to one machine. nginx and certbot don't need the IDE to be running,
+    and certbot waits for the machine's name to resolve to it however soon after boot it gets to run.
+    The IDE is tuned for the machine's instance type when it is one of those in instance_sizes.
+    """
+    steps = [Step("ide-tuning", tuning_commands(tuning, instance_sizes), after=("projector-autoinstall",))] \
+        if instance_sizes else []
+    return steps + [
+        Step("nginx", f"""\
 cat << CONFIG | sudo tee /etc/nginx/sites-available/default
 server {{
   listen       80;
@@ -131,16 +370,13 @@ server {{
   }}
 }}
 CONFIG
-
-# configure nginx with let's encrypt certificate
-sudo certbot --nginx \
-  --non-interactive \
-  --redirect \
-  --agree-tos \
-  --register-unsafely-without-email \
-  --domain {dns_name}
-
-"""
+""", after=("apt",)),
+        Step("certbot", certbot_commands(dns_name), after=("nginx",)),
+        Step("ide-start", f"""\
+sudo hostnamectl set-hostname {dns_name}
+sudo systemctl start "{config_name}"
+""", after=("projector-autoinstall", "ide-service", "snap", "ide-tuning")),
+    ]
 
 
 @dataclass
@@ -151,6 +387,14 @@ class ProjectorInstance:
     region_name: str
     room: int = 0
     instance_id: str = None
+    instance_type: str = None
+    availability_zone: str = None
+
+    def launched_as(self, instance):
+        """ Record the machine run_instances started for this room, and which launch choice it got """
+        self.instance_id = instance["InstanceId"]
+        self.instance_type = instance.get("InstanceType")
+        self.availability_zone = instance.get("Placement", {}).get("AvailabilityZone")
 
 
 def create_instances(classroom_size, config_name, session_id, coach, region_name, url_stem):
@@ -168,13 +412,16 @@ def create_instances(classroom_size, config_name, session_id, coach, region_name
 
 
 def write_classroom_file(f, instances):
-    writer = csv.DictWriter(f, ["room", "region", "id", "url", "team", "comments"])
+    writer = csv.DictWriter(f, ["room", "region", "id", "instance_type", "availability_zone", "url", "team",
+                                "comments"])
     writer.writeheader()
     for instance in instances:
         writer.writerow({
             "room": instance.room,
             "region": instance.region_name,
             "id": instance.instance_id,
+            "instance_type": instance.instance_type,
+            "availability_zone": instance.availability_zone,
             "url": f"https://{instance.dns_name}",
             "team": "",
             "comments": ""
@@ -184,12 +431,16 @@ def write_classroom_file(f, instances):
 @click.command()
 @click.option(
     "--config-name",
+    cls=ConfigDependentOption,
     help="normally the shortname for the IDE like pycharm or idea",
-    prompt=f"what config [{', '.join(read_ide_config())}]?"
+    prompt="what config",
+    prompt_from=ide_config_names,
 )
 @click.option(
     "--region-name",
-    help=f"the aws region name: {', '.join(read_regions_config().keys())}",
+    cls=ConfigDependentOption,
+    help="the aws region name",
+    help_from=region_names,
     default=None
 )
 @click.option(
@@ -207,18 +458,84 @@ def write_classroom_file(f, instances):
     default="Samman",
     help="The name of the Samman Coach who owns these instances"
 )
-def summon(config_name, region_name, aws_profile, classroom_size, coach):
+@click.option(
+    "--batch/--one-at-a-time",
+    default=True,
+    help="launch rooms that share a config and region with a single run_instances call"
+)
+@click.option(
+    "--max-workers",
+    default=4,
+    help="how many config/region groups to launch in parallel"
+)
+@click.option(
+    "--dns-deadline",
+    default=600,
+    help="how many seconds to wait for the new machines to get ip addresses and DNS records"
+)
+@click.option(
+    "--warm-pool/--no-warm-pool",
+    default=True,
+    help="start stopped machines from the warm pool, see warm_pool.py, before launching new ones"
+)
+@click.option(
+    "--cache-node/--no-cache-node",
+    default=False,
+    help="launch a machine that caches apt, pip and IDE downloads for the rooms, see cache_node.py"
+)
+@click.option(
+    "--spread/--one-region",
+    default=False,
+    help="spread the rooms over the regions in aws_zones.json by their capacity and placement_weight, see placement.py"
+)
+@click.option(
+    "--ready-deadline",
+    default=1200,
+    help="how many seconds to wait for every room to answer over https - 0 not to wait"
+)
+@profile_option
+def summon(config_name, region_name, aws_profile, classroom_size, coach, batch, max_workers, dns_deadline, warm_pool,
+           cache_node, spread, ready_deadline):
+    if spread and region_name:
+        raise click.UsageError("--spread picks the regions itself, so it can't be used with --region-name")
     coach = coach or os.getlogin()
     session_id = secrets.token_hex(4)
-    aws_defaults = read_aws_defaults(profile_name=aws_profile)
+    config = configuration(aws_profile)
+    aws_defaults = config.aws_defaults
 
     region_name = region_name or aws_defaults["region"]
+    # fail before launching anything if the config or region is unknown
+    config.ide_config(config_name)
+    config.region(region_name)
     instances = create_instances(classroom_size, config_name, session_id, coach, region_name, aws_defaults["url_stem"])
-
-    session = boto3.Session(profile_name=aws_profile, region_name=region_name)
-    ec2 = session.client("ec2")
-    for projector_instance in instances:
-        summon_projector_instance(ec2, projector_instance, profile_name=aws_profile, aws_defaults=aws_defaults)
+    if spread:
+        capacities = region_capacities(config, config.region_names())
+        plan = plan_placement(len(instances), capacities)
+        place_rooms(instances, plan)
+        print("placing rooms: " + ", ".join(f"{rooms} in {region_name}" for region_name, rooms in plan.items()))
+
+    aws_regions = {instance.region_name for instance in instances}
+    # on the clock the readiness prober uses, so that the time it takes a room to be ready counts from here
+    launched_at = time.monotonic()
+    try:
+        claimed = claim_from_warm_pools(instances, config) if warm_pool else {}
+        to_launch = [instance for instance in instances if not instance.instance_id]
+        cache_hosts = {}
+        if cache_node and to_launch:
+            from cache_node import launch_cache_nodes
+            cache_hosts = launch_cache_nodes(to_launch, config, session_id)
+        if batch:
+            launch_classroom(to_launch, config, max_workers=max_workers, cache_hosts=cache_hosts)
+        else:
+            for projector_instance in to_launch:
+                ec2 = aws_clients.client("ec2", projector_instance.region_name, aws_profile)
+                summon_projector_instance(ec2, projector_instance, config,
+                                          cache_hosts.get(projector_instance.region_name))
+    finally:
+        # so that the next instances.py or clone_kata.py sees the claimed and new machines, even if a launch failed
+        Inventory().invalidate(aws_profile, aws_regions)
+    refill_executor = ThreadPoolExecutor(max_workers=max_workers)
+    refills = refill_warm_pools(claimed, config, refill_executor)
 
     if len(instances) > 1:
         filename = f"{session_id}-classroom.csv"
@@ -227,41 +544,94 @@ def summon(config_name, region_name, aws_profile, classroom_size, coach):
             write_classroom_file(f, instances)
 
     print("Updating DNS records...")
-    # Hack: we're simply guessing the new machine has been created here.
-    # A better/more stable/quicker solution would be to check with AWS when the machine is up,
-    # and update DNS then.
-    # Inspiration:
-    #    for status in ec2.meta.client.describe_instance_status()['InstanceStatuses']:
-    #    response = ec2.monitor_instances(InstanceIds=['INSTANCE_ID'])
-    #    https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Waiter.InstanceRunning
-    time.sleep(15)
-    aws_regions = read_regions_config(profile_name=aws_profile).keys()
-    DnsUpdater(aws_defaults, aws_regions, aws_profile).update_ensemble_machine_dns_records()
-
-
-def summon_projector_instance(ec2, projector_instance: ProjectorInstance, profile_name, aws_defaults):
-    machine_config = read_ide_config()[projector_instance.config_name]
-    user_data = generate_script(
-        projector_instance.dns_name,
-        **machine_config,
-    )
+    instance_ids_by_client = []
+    for region_name in aws_regions:
+        ec2 = aws_clients.client("ec2", region_name, aws_profile)
+        instance_ids = [instance.instance_id for instance in instances if instance.region_name == region_name]
+        instance_ids_by_client.append((ec2, instance_ids))
+    waiter = AddressWaiter(instance_ids_by_client, deadline=dns_deadline)
+    try:
+        DnsUpdater(aws_defaults, aws_regions, aws_profile).update_dns_records_when_addressed(waiter)
+    except AddressWaitTimeout as e:
+        print(f"{e} - run update_dns.py once they are up")
+
+    for future in as_completed(refills):
+        config_name, region_name = refills[future]
+        try:
+            print(f"refilling the {config_name} pool in {region_name} with {len(future.result())} machines")
+        except Exception as e:
+            print(f"ERROR: couldn't refill the {config_name} pool in {region_name}: {e}")
+    refill_executor.shutdown()
+
+    if ready_deadline:
+        print("Waiting for the rooms to be ready...")
+        rooms = wait_for_rooms([f"https://{instance.dns_name}" for instance in instances],
+                               ReadinessProber(deadline=ready_deadline), since=launched_at)
+        if not all(room.ready for room in rooms):
+            raise SystemExit(1)
+
+
+def summon_projector_instance(ec2, projector_instance: ProjectorInstance, config, cache_host=None):
+    machine_config = config.ide_config(projector_instance.config_name)
+    aws_defaults = config.aws_defaults
+    region_config = config.region(projector_instance.region_name)
+    baked_image = config.baked_image(projector_instance.region_name, projector_instance.config_name)
+    image_id, user_data = image_and_user_data(ec2, projector_instance.dns_name, machine_config, region_config, aws_defaults,
+                                              baked_image, cache_host=cache_host)
     tags = [
         {'Key': 'Name', 'Value': projector_instance.dns_name},
         {'Key': aws_defaults["coach_tag"], 'Value': projector_instance.coach},
     ]
-    instance = launch_instance(ec2, tags, user_data, projector_instance.region_name, profile_name, aws_defaults)
+    instance = launch_instance(ec2, tags, user_data, region_config, aws_defaults, image_id,
+                               projector_instance.region_name)
 
     # set the instance_id in the ProjectorInstance now that we have it
-    projector_instance.instance_id = instance["InstanceId"]
+    projector_instance.launched_as(instance)
+
+
+def launch_instance(ec2, tags, user_data, region_config, aws_defaults, image_id=None, region_name=None):
+    response = run_with_fallback(ec2, region_name, 1, tags, user_data, region_config, aws_defaults, image_id)
+    return response['Instances'][0]
 
 
-def launch_instance(ec2, tags, user_data, region_name, profile_name, aws_defaults):
-    region_config = read_regions_config(profile_name=profile_name)[region_name]
-    response = ec2.run_instances(
-        MinCount=1,
-        MaxCount=1,
-        ImageId=region_config["image_id"],
-        InstanceType= aws_defaults["instance_type"],
+def run_with_fallback(ec2, region_name, count, tags, user_data, region_config, aws_defaults, image_id=None):
+    """ run_instances, trying the region's launch choices in turn when EC2 has no capacity, see launch_fallback.py """
+    response, choice = run_instances_with_fallback(
+        ec2, region_name, launch_choices(region_config, aws_defaults),
+        lambda choice: run_instances_arguments(count, tags, user_data, region_config, aws_defaults, image_id, choice))
+    logging.info(f"{region_name}: launched {count} x {choice}")
+    return response
+
+
+def image_and_user_data(ec2, dns_name, machine_config, region_config, aws_defaults, baked_image=None, preamble="",
+                        cache_host=None):
+    """ Use the image bake.py made for this config if it is up to date, so that the machine only does its own
+    per-host setup at boot. Otherwise start from the region's plain image and install everything,
+    through the classroom's cache node if there is one.
+    """
+    sizes = instance_type_sizes(ec2, instance_types(region_config, aws_defaults))
+    if up_to_date(baked_image, machine_config, region_config):
+        return baked_image["image_id"], generate_boot_script(dns_name, machine_config["config_name"], preamble,
+                                                             machine_config.get("tuning"), sizes)
+    return region_config["image_id"], generate_script(dns_name, preamble=preamble, cache_host=cache_host,
+                                                      instance_sizes=sizes, **machine_config)
+
+
+def up_to_date(baked_image, machine_config, region_config):
+    if baked_image and baked_image["hash"] == provisioning_hash(machine_config, region_config["image_id"]):
+        return True
+    if baked_image:
+        logging.warning(f"the baked image for {machine_config['config_name']} is out of date, run bake.py to rebuild it")
+    return False
+
+
+def run_instances_arguments(count, tags, user_data, region_config, aws_defaults, image_id=None, choice=None):
+    """ choice is the LaunchChoice to launch with, otherwise it is the default instance type wherever EC2 likes """
+    arguments = dict(
+        MinCount=count,
+        MaxCount=count,
+        ImageId=image_id or region_config["image_id"],
+        InstanceType=choice.instance_type if choice else aws_defaults["instance_type"],
         KeyName=region_config["key_name"],
         SecurityGroupIds=region_config["security_group_ids"],
         UserData=user_data,
@@ -274,9 +644,150 @@ def launch_instance(ec2, tags, user_data, region_name, profile_name, aws_default
                 'VolumeType': aws_defaults["volume_type"],
                 'VolumeSize': aws_defaults["volume_size"],
             }
-        }]
+        }],
+        # lets a machine read its own Name tag, see READ_DNS_NAME_FROM_NAME_TAG
+        MetadataOptions={'InstanceMetadataTags': 'enabled'},
     )
-    return response['Instances'][0]
+    if choice and choice.subnet_id:
+        arguments["SubnetId"] = choice.subnet_id
+    return arguments
+
+
+def launch_groups(instances):
+    """ Rooms with the same config, region and coach can share one run_instances call """
+    groups = {}
+    for instance in instances:
+        key = (instance.config_name, instance.region_name, instance.coach)
+        groups.setdefault(key, []).append(instance)
+    return groups
+
+
+def launch_classroom(instances, config, max_workers=4, cache_hosts=None):
+    """ Launch every room of a classroom, one run_instances call per launch group.
+    The vCPU quota of each region is checked before anything is started, and the groups are launched in parallel,
+    with at least one worker per region so that no region waits for another.
+    cache_hosts has the address of the cache node in each region that has one.
+    """
+    cache_hosts = cache_hosts or {}
+    groups = launch_groups(instances)
+    profile_name = config.profile_name
+    aws_defaults = config.aws_defaults
+
+    def ec2_client_with_enough_vcpus(region_name):
+        ec2 = aws_clients.client("ec2", region_name, profile_name)
+        rooms_in_region = [instance for instance in instances if instance.region_name == region_name]
+        check_vcpu_headroom(ec2, aws_clients.client("service-quotas", region_name, profile_name), region_name,
+                            instance_types(config.region(region_name), aws_defaults), len(rooms_in_region))
+        return ec2
+
+    regions = {region_name for _, region_name, _ in groups}
+    ec2_clients, failures = RegionExecutor().results(ec2_client_with_enough_vcpus, regions)
+    if failures:
+        raise next(iter(failures.values()))
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(max_workers, len(regions))) as executor:
+        futures = {}
+        for key, group in groups.items():
+            config_name, region_name, _ = key
+            future = executor.submit(launch_group, ec2_clients[region_name], group,
+                                     config.ide_config(config_name), config.region(region_name), aws_defaults,
+                                     config.baked_image(region_name, config_name), cache_hosts.get(region_name))
+            futures[future] = key
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"failed to launch {futures[future]}: {e}")
+                failures.append(e)
+    if failures:
+        raise failures[0]
+
+
+def launch_group(ec2, projector_instances, machine_config, region_config, aws_defaults, baked_image=None,
+                 cache_host=None, sleep=time.sleep):
+    """ Start all the rooms in a launch group with one run_instances call, then give each its own Name tag.
+    A machine that couldn't be tagged is terminated, since nothing could find it without a Name,
+    and the first error is raised once the other rooms are tagged.
+    """
+    image_id, user_data = image_and_user_data(ec2, DNS_NAME_FROM_NAME_TAG, machine_config, region_config, aws_defaults,
+                                              baked_image, preamble=READ_DNS_NAME_FROM_NAME_TAG, cache_host=cache_host)
+    tags = [{'Key': aws_defaults["coach_tag"], 'Value': projector_instances[0].coach}]
+    response = run_with_fallback(ec2, projector_instances[0].region_name, len(projector_instances), tags, user_data,
+                                 region_config, aws_defaults, image_id)
+
+    launched = sorted(response["Instances"], key=lambda instance: instance["AmiLaunchIndex"])
+    errors = {}
+    for projector_instance, instance in zip(projector_instances, launched):
+        try:
+            name_machine(ec2, instance["InstanceId"], projector_instance.dns_name, sleep)
+        except Exception as e:
+            errors[instance["InstanceId"]] = e
+            continue
+        projector_instance.launched_as(instance)
+        logging.info(f"launched {projector_instance.dns_name} as {projector_instance.instance_id} "
+                     f"({projector_instance.instance_type} in {projector_instance.availability_zone})")
+    if errors:
+        logging.error(f"terminating {', '.join(errors)}, which couldn't be given their Name tags")
+        ec2.terminate_instances(InstanceIds=list(errors))
+        raise next(iter(errors.values()))
+
+
+def name_machine(ec2, instance_id, dns_name, sleep=time.sleep):
+    """ Give a machine its Name tag, retrying NAME_TAG_ATTEMPTS times """
+    for attempt in range(NAME_TAG_ATTEMPTS):
+        try:
+            ec2.create_tags(Resources=[instance_id], Tags=[{'Key': 'Name', 'Value': dns_name}])
+            return
+        except Exception as e:
+            if attempt == NAME_TAG_ATTEMPTS - 1:
+                raise
+            logging.warning(f"couldn't tag {instance_id} with Name {dns_name}, trying again: {e}")
+            sleep(NAME_TAG_RETRY_SECONDS * 2 ** attempt)
+
+
+def claim_from_warm_pools(instances, config):
+    """ Give rooms stopped machines from the warm pools, and return how many were claimed from each
+    (config_name, region_name) pool. The rooms that got one have their instance_id set.
+    """
+    claimed = {}
+    for (config_name, region_name, _), group in launch_groups(instances).items():
+        ec2 = aws_clients.client("ec2", region_name, config.profile_name)
+        claimed_rooms = WarmPool(ec2, config_name, config.aws_defaults).claim(group)
+        if claimed_rooms:
+            key = (config_name, region_name)
+            claimed[key] = claimed.get(key, 0) + len(claimed_rooms)
+    return claimed
+
+
+def refill_warm_pools(claimed, config, executor):
+    """ Launch replacements for the claimed pool machines on the executor, so it happens while summon waits
+    for DNS, behind the DNS updates in the line for AWS calls. Returns a dict of futures to (config_name, region_name).
+    """
+    refills = {}
+    for (config_name, region_name), count in claimed.items():
+        ec2 = aws_clients.client("ec2", region_name, config.profile_name)
+        future = executor.submit(request_scheduler.prioritized(request_scheduler.LOW, launch_pool_machines),
+                                 ec2, count, config.ide_config(config_name), config.region(region_name),
+                                 config.aws_defaults, config.baked_image(region_name, config_name), region_name)
+        refills[future] = (config_name, region_name)
+    return refills
+
+
+def launch_pool_machines(ec2, count, machine_config, region_config, aws_defaults, baked_image=None, region_name=None):
+    """ Start count machines that provision themselves for the warm pool and then stop. Returns their ids. """
+    config_name = machine_config["config_name"]
+    provisioned = up_to_date(baked_image, machine_config, region_config)
+    image_id = baked_image["image_id"] if provisioned else region_config["image_id"]
+    sizes = instance_type_sizes(ec2, instance_types(region_config, aws_defaults))
+    user_data = generate_pool_script(provisioned=provisioned, instance_sizes=sizes, **machine_config)
+    tags = [
+        {'Key': 'Name', 'Value': f"{POOL_NAME_PREFIX}{config_name}"},
+        {'Key': POOL_TAG, 'Value': config_name},
+        {'Key': aws_defaults["coach_tag"], 'Value': "warm pool"},
+    ]
+    response = run_with_fallback(ec2, region_name, count, tags, user_data, region_config, aws_defaults, image_id)
+    return [instance["InstanceId"] for instance in response["Instances"]]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+import json
+
+import botocore.exceptions
+import click
+import pytest
+from click.testing import CliRunner
+
+import aws_clients
+from api_metrics import ApiMetrics
+from benchmarks.control_plane import benchmark_environment, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from cli_options import profile_option
+
+
+@pytest.fixture
+def fake_aws():
+    fake_aws = FakeAws(latency=0.03)
+    with benchmark_environment(fake_aws):
+        yield fake_aws
+
+
+def test_calls_are_counted_and_timed_per_region_and_operation(fake_aws):
+    fake_aws.add_instance("eu-north-1", "idea-1", "emily")
+    metrics = ApiMetrics()
+    aws_clients.instrument(metrics)
+    try:
+        aws_clients.client("ec2", "eu-north-1", PROFILE_NAME).describe_instances()
+        aws_clients.client("ec2", "eu-north-1", PROFILE_NAME).describe_instances()
+        with pytest.raises(botocore.exceptions.ClientError):
+            aws_clients.client("ec2", "ca-central-1", PROFILE_NAME).describe_instances(InstanceIds=["i-missing"])
+    finally:
+        aws_clients.uninstrument(metrics)
+    aws_clients.client("ec2", "eu-north-1", PROFILE_NAME).describe_instances()
+
+    describe = metrics.operations[("eu-north-1", "ec2", "DescribeInstances")]
+    assert (describe.calls, describe.errors) == (2, 0)
+    assert describe.total_seconds >= 0.06
+    assert sum(describe.latency_histogram) == 2
+    assert describe.percentile_ms(0.5) == 50
+    missing = metrics.operations[("ca-central-1", "ec2", "DescribeInstances")]
+    assert (missing.calls, missing.errors) == (1, 1)
+    assert metrics.by_region()["eu-north-1"][0] == 2
+
+
+def test_retries_are_counted(fake_aws):
+    fake_aws.throttle_rate = 0.5
+    fake_aws.backoff = 0
+    fake_aws.max_attempts = 10
+    metrics = ApiMetrics()
+    aws_clients.instrument(metrics)
+    try:
+        for _ in range(10):
+            aws_clients.client("ec2", "eu-north-1", PROFILE_NAME).describe_instances()
+    finally:
+        aws_clients.uninstrument(metrics)
+
+    assert metrics.operations[("eu-north-1", "ec2", "DescribeInstances")].retries == sum(fake_aws.throttled.values())
+
+
+@click.command()
+@profile_option
+def describe():
+    aws_clients.client("ec2", "eu-north-1", PROFILE_NAME).describe_instances()
+
+
+def test_profile_option_prints_a_summary_or_writes_json(fake_aws, tmp_path):
+    result = CliRunner().invoke(describe, ["--profile"])
+
+    assert result.exit_code == 0, result.output
+    assert "ec2.DescribeInstances" in result.output
+    assert "1 AWS calls in" in result.output
+
+    CliRunner().invoke(describe, ["--profile", str(tmp_path / "profile.json")])
+
+    profile = json.loads((tmp_path / "profile.json").read_text())
+    assert [(operation["operation_name"], operation["calls"]) for operation in profile["operations"]] == [
+        ("DescribeInstances", 1)]
+    assert profile["regions"]["eu-north-1"]["calls"] == 1
@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+
+
+def test_clients_are_shared_per_profile_region_and_service():
+    aws_clients.clear()
+
+    ec2 = aws_clients.client("ec2", "eu-north-1")
+
+    assert aws_clients.client("ec2", "eu-north-1") is ec2
+    assert aws_clients.client("ec2", "ca-central-1") is not ec2
+    assert aws_clients.client("route53", "eu-north-1") is not ec2
+
+
+def test_threads_get_the_same_client():
+    aws_clients.clear()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: aws_clients.client("ec2", "eu-north-1"), range(16)))
+
+    assert all(client is clients[0] for client in clients)
+
+
+def test_pool_size_is_tunable():
+    aws_clients.configure(max_pool_connections=50)
+
+    assert aws_clients.client("ec2", "eu-north-1").meta.config.max_pool_connections == 50
+    aws_clients.configure()
@@ -0,0 +1,32 @@
+import json
+
+from bake import images_to_bake, record_baked_image
+from configuration import Configuration
+from summon import provisioning_hash
+from tests.test_configuration import write_config
+
+
+def test_images_are_baked_when_missing_or_out_of_date(tmp_path):
+    write_config(tmp_path)
+    config = Configuration(directory=tmp_path)
+
+    stale = images_to_bake(config, ["clion"], ["eu-central-1"])
+
+    image_hash = provisioning_hash(config.ide_config("clion"), "ami-05f7491af5eef733c")
+    assert stale == [("clion", "eu-central-1", image_hash)]
+
+    record_baked_image(tmp_path / "aws_images.json", "default", "eu-central-1", "clion",
+                       {"image_id": "ami-baked", "hash": image_hash})
+    config.refresh()
+    assert images_to_bake(config, ["clion"], ["eu-central-1"]) == []
+    assert images_to_bake(config, ["clion"], ["eu-central-1"], force=True) == stale
+
+
+def test_record_baked_image_returns_the_replaced_record(tmp_path):
+    images_file = tmp_path / "aws_images.json"
+    record_baked_image(images_file, "default", "eu-central-1", "clion", {"image_id": "ami-old", "hash": "a"})
+
+    replaced = record_baked_image(images_file, "default", "eu-central-1", "clion", {"image_id": "ami-new", "hash": "b"})
+
+    assert replaced["image_id"] == "ami-old"
+    assert json.loads(images_file.read_text())["default"]["eu-central-1"]["clion"]["image_id"] == "ami-new"
@@ -0,0 +1,59 @@
+from boot_times import parse_boot_phases, config_name_of, phase_percentiles, collect_boot_times, TOTAL
+from clone_kata import KataMachine
+from remote import RemoteExecutor
+
+PHASES_FILE = """\
+bake\tboot\tstart\t100.0
+bake\tboot\tend\t130.0
+bake\tapt\tstart\t130.0
+bake\tapt\tend\t400.0
+claimed\tboot\tstart\t1000.0
+claimed\tboot\tend\t1020.0
+claimed\tide-start\tstart\t1020.0
+claimed\tide-start\tend\t1021.5
+claimed\tcertbot\tstart\t1021.5
+"""
+
+
+def test_only_the_latest_boot_counts():
+    phases, unfinished = parse_boot_phases(PHASES_FILE)
+
+    assert phases == {"boot": 20.0, "ide-start": 1.5, TOTAL: 21.5}
+    assert unfinished == ["certbot"]
+
+
+def test_config_name_is_the_longest_config_the_machine_name_starts_with():
+    assert config_name_of("https://idea-c7f3aa50-1.codekata.proagile.link", ["idea", "idea-ultimate"]) == "idea"
+    assert config_name_of("idea-ultimate-c7f3aa50.codekata.proagile.link", ["idea", "idea-ultimate"]) == "idea-ultimate"
+    assert config_name_of("https://goland-c7f3aa50-2.codekata.proagile.link", ["idea"]) == "goland"
+
+
+class PhasesTransport:
+    def __init__(self, phases_by_ip):
+        self.phases_by_ip = phases_by_ip
+
+    def run(self, machine, commandline, timeout):
+        if machine.host_ip not in self.phases_by_ip:
+            return 1, "", "cat: /var/log/ensemble-boot-phases.tsv: No such file or directory"
+        return 0, self.phases_by_ip[machine.host_ip], ""
+
+
+def phases_file(boot_seconds, apt_seconds):
+    return f"b\tboot\tstart\t0\nb\tboot\tend\t{boot_seconds}\nb\tapt\tstart\t{boot_seconds}\n" \
+           f"b\tapt\tend\t{boot_seconds + apt_seconds}\n"
+
+
+def test_percentiles_per_config_and_region():
+    machines = [KataMachine(region_name="eu-north-1", host_ip=f"10.0.0.{room}",
+                            url=f"https://idea-c7f3aa50-{room}.codekata.proagile.link") for room in range(1, 11)]
+    machines.append(KataMachine(region_name="ca-central-1", host_ip="10.0.1.1",
+                                url="https://clion-c7f3aa50-1.codekata.proagile.link"))
+    transport = PhasesTransport({f"10.0.0.{room}": phases_file(20, room * 10) for room in range(1, 10)})
+
+    boot_times = collect_boot_times(machines, RemoteExecutor(transport), ["idea", "clion"])
+
+    assert [times.error is not None for times in boot_times].count(True) == 2
+    percentiles = phase_percentiles(boot_times)
+    assert list(percentiles) == [("idea", "eu-north-1")]
+    assert percentiles[("idea", "eu-north-1")]["apt"] == {"count": 9, "p50": 50, "p90": 90, "max": 90}
+    assert percentiles[("idea", "eu-north-1")][TOTAL]["p50"] == 70
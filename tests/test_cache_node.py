@@ -0,0 +1,119 @@
+import functools
+import http.server
+import subprocess
+import threading
+
+import pytest
+from approvaltests import verify
+
+from benchmarks.control_plane import benchmark_environment, benchmark_directory, write_config, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from cache_node import generate_cache_node_script, room_cache_steps, launch_cache_nodes, cache_nodes
+from configuration import configuration, read_ide_config
+from summon import RUN_STEP, Step, render_steps, create_instances, generate_script
+import aws_clients
+
+IDEA_ARCHIVE_URL = "https://download.jetbrains.com/idea/ideaIU-2021.2.tar.gz"
+
+
+def test_cache_node_script():
+    configs = read_ide_config()
+
+    verify(generate_cache_node_script([configs["idea"], configs["rider"]]))
+
+
+def test_rooms_download_through_the_cache_node():
+    script = generate_script("c7f3aa50-1-idea.codekata.proagile.link", cache_host="172.31.0.7",
+                             **read_ide_config()["idea"])
+
+    assert "172.31.0.7:3142" in script
+    assert "172.31.0.7:8081/jetbrains/idea/ideaIU-2021.2.tar.gz" in script
+    assert 'run_step apt "artifact-cache"' in script
+    assert 'run_step projector-autoinstall "projector-installer ide-archive"' in script
+
+
+@pytest.fixture
+def stand_in_cache(tmp_path):
+    """ One local http server standing in for all three caches on the cache node """
+    served = tmp_path / "served"
+    (served / "jetbrains" / "idea").mkdir(parents=True)
+    (served / "jetbrains" / "idea" / "ideaIU-2021.2.tar.gz").write_text("the whole IDE")
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(served))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def run_locally(steps, root):
+    """ Run the steps with dash, with the files they write under root instead of / """
+    (root / "etc" / "apt" / "apt.conf.d").mkdir(parents=True)
+    script = "set -e\nphase() { :; }\n" + RUN_STEP + render_steps(steps)
+    script = script.replace("sudo -u typist ", "").replace("sudo ", "")
+    script = script.replace("/etc/", f"{root}/etc/").replace("/home/typist", f"{root}/home/typist")
+    return subprocess.run(["dash", "-c", script], capture_output=True, text=True, timeout=60)
+
+
+def provisioning_stand_ins(seen):
+    """ apt and projector-installer steps that keep a copy of the apt and pip config they were run with """
+    return [Step("apt", f"cp /etc/apt/apt.conf.d/01ensemble-cache {seen}/apt.conf", after=("artifact-cache",)),
+            Step("projector-installer", f"cp /etc/pip.conf {seen}/pip.conf", after=("apt", "artifact-cache"))]
+
+
+def test_room_uses_the_cache_node_when_it_answers(stand_in_cache, tmp_path):
+    ports = {"apt": stand_in_cache, "pip": stand_in_cache, "archives": stand_in_cache}
+    seen = tmp_path / "seen"
+    seen.mkdir()
+
+    result = run_locally(room_cache_steps("127.0.0.1", IDEA_ARCHIVE_URL, wait_seconds=5, ports=ports) +
+                         provisioning_stand_ins(seen), tmp_path)
+
+    assert result.returncode == 0, result.stderr
+    apt_proxy = (seen / "apt.conf").read_text()
+    assert apt_proxy == f'Acquire::http::Proxy "http://127.0.0.1:{stand_in_cache}";\n'
+    assert f"index-url = http://127.0.0.1:{stand_in_cache}/root/pypi/+simple/" in (seen / "pip.conf").read_text()
+    archive = tmp_path / "home" / "typist" / ".projector" / "cache" / "ideaIU-2021.2.tar.gz"
+    assert archive.read_text() == "the whole IDE"
+    # the cache node doesn't outlive the classroom's start, so the room no longer uses it afterwards
+    assert not (tmp_path / "etc" / "apt" / "apt.conf.d" / "01ensemble-cache").exists()
+    assert not (tmp_path / "etc" / "pip.conf").exists()
+
+
+def test_room_downloads_from_the_internet_when_the_cache_node_is_missing(tmp_path):
+    ports = {"apt": 9, "pip": 9, "archives": 9}
+
+    result = run_locally(room_cache_steps("127.0.0.1", IDEA_ARCHIVE_URL, wait_seconds=0, ports=ports), tmp_path)
+
+    assert result.returncode == 0, result.stderr
+    assert "downloading from the internet" in result.stdout
+    assert not (tmp_path / "etc" / "pip.conf").exists()
+    assert not (tmp_path / "home" / "typist" / ".projector" / "cache" / "ideaIU-2021.2.tar.gz").exists()
+
+
+def test_one_cache_node_per_region():
+    fake_aws = FakeAws()
+    with benchmark_environment(fake_aws):
+        write_config(benchmark_directory(), region_count=3)
+        config = configuration(PROFILE_NAME)
+        rooms = create_instances(3, "idea", "c7f3aa50", "emily", "eu-north-1", "codekata.proagile.link") + \
+            create_instances(2, "idea", "c7f3aa50", "emily", "ca-central-1", "codekata.proagile.link")
+
+        cache_hosts = launch_cache_nodes(rooms, config, "c7f3aa50")
+
+        assert sorted(cache_hosts) == ["ca-central-1", "eu-north-1"]
+        assert all(host.startswith("172.31.") for host in cache_hosts.values())
+        ec2 = aws_clients.client("ec2", "eu-north-1", PROFILE_NAME)
+        assert len(list(cache_nodes(ec2, "c7f3aa50"))) == 1
+
+
+def test_rooms_go_without_a_cache_node_where_one_cant_be_launched():
+    fake_aws = FakeAws(no_capacity=[("ca-central-1", "t3.large", None)])
+    with benchmark_environment(fake_aws):
+        write_config(benchmark_directory(), region_count=3)
+        rooms = create_instances(3, "idea", "c7f3aa50", "emily", "eu-north-1", "codekata.proagile.link") + \
+            create_instances(2, "idea", "c7f3aa50", "emily", "ca-central-1", "codekata.proagile.link")
+
+        cache_hosts = launch_cache_nodes(rooms, configuration(PROFILE_NAME), "c7f3aa50")
+
+    assert sorted(cache_hosts) == ["eu-north-1"]
@@ -0,0 +1,63 @@
+from io import StringIO
+
+import aws_clients
+from classroom import Classroom, ClassroomActions
+from inventory import Inventory
+from region_executor import RegionExecutor
+
+CLASSROOM_FILE = """\
+room,region,id,url,team,comments
+1,ca-central-1,i-1,https://idea-c7f3aa50-1.codekata.proagile.link,,
+2,eu-north-1,i-2,https://idea-c7f3aa50-2.codekata.proagile.link,,
+3,ca-central-1,i-3,https://idea-c7f3aa50-3.codekata.proagile.link,,
+"""
+
+
+def test_classroom_is_indexed_by_room_id_url_and_region():
+    classroom = Classroom.read(StringIO(CLASSROOM_FILE))
+
+    assert classroom.by_room["2"].instance_id == "i-2"
+    assert classroom.by_id["i-3"].room == "3"
+    assert classroom.with_url(" https://idea-c7f3aa50-1.codekata.proagile.link/").room == "1"
+    assert classroom.ids_by_region() == {"ca-central-1": ["i-1", "i-3"], "eu-north-1": ["i-2"]}
+
+
+class RegionEc2:
+    def __init__(self, region_name, calls):
+        self.region_name = region_name
+        self.calls = calls
+
+    def stop_instances(self, InstanceIds):
+        if self.region_name == "eu-north-1":
+            raise RuntimeError("UnauthorizedOperation")
+        self.calls.append((self.region_name, InstanceIds))
+        return {"StoppingInstances": [{"InstanceId": i, "CurrentState": {"Name": "stopping"}} for i in InstanceIds]}
+
+
+def test_stop_calls_each_region_once_and_reports_every_room(monkeypatch):
+    calls = []
+    monkeypatch.setattr(aws_clients, "client", lambda service, region_name, profile_name: RegionEc2(region_name, calls))
+    classroom = Classroom.read(StringIO(CLASSROOM_FILE))
+
+    results = ClassroomActions(classroom, region_executor=RegionExecutor()).stop()
+
+    assert calls == [("ca-central-1", ["i-1", "i-3"])]
+    assert [(result.room.room, result.state, result.ok) for result in results] == [
+        ("1", "stopping", True),
+        ("2", None, False),
+        ("3", "stopping", True),
+    ]
+    assert "UnauthorizedOperation" in results[1].error
+
+
+def test_every_region_acted_in_is_swept_again_by_the_next_command(monkeypatch, tmp_path):
+    monkeypatch.setattr(aws_clients, "client", lambda service, region_name, profile_name: RegionEc2(region_name, []))
+    inventory = Inventory(tmp_path / "inventory.sqlite3")
+    for region_name in ["ca-central-1", "eu-north-1"]:
+        inventory.store_region("default", region_name, "codekata.proagile.link", [])
+
+    ClassroomActions(Classroom.read(StringIO(CLASSROOM_FILE)), region_executor=RegionExecutor(),
+                     inventory=inventory).stop()
+
+    assert inventory.out_of_date("default", "ca-central-1", "codekata.proagile.link") == (True, [])
+    assert inventory.out_of_date("default", "eu-north-1", "codekata.proagile.link") == (True, [])
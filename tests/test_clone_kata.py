@@ -2,7 +2,9 @@ from io import StringIO
 
 from approvaltests import verify_all
 
-from clone_kata import read_classroom_file, KataMachine
+from benchmarks.control_plane import benchmark_environment, benchmark_directory, write_config, PROFILE_NAME, URL_STEM
+from benchmarks.fake_aws import FakeAws
+from clone_kata import read_classroom_file, KataMachine, determine_machines_to_update
 from instances import RunningInstance
 
 
@@ -18,4 +20,20 @@ room,region,id,url,team,comments
 		RunningInstance("18.157.73.26", "running", "emily", "https://c7f3aa50-2-idea.codekata.proagile.link", "2022-01-31", region_name="eu-north-1"),
 	])
 
-	verify_all("machines", result)
\ No newline at end of file
+	verify_all("machines", result)
+
+
+def test_coach_only_narrows_the_selection_by_coach():
+	fake_aws = FakeAws()
+	with benchmark_environment(fake_aws):
+		region_name = write_config(benchmark_directory(), region_count=1)[0]
+		fake_aws.add_instance(region_name, f"idea-c7f3aa50-1.{URL_STEM}", "emily")
+		llewellyn = fake_aws.add_instance(region_name, f"idea-c7f3aa51-1.{URL_STEM}", "llewellyn")
+		llewellyn_ip = fake_aws.instances[llewellyn]["PublicIpAddress"]
+
+		by_coach = determine_machines_to_update(PROFILE_NAME, None, "emily", None, region_name, URL_STEM, fresh=True)
+		by_host_ip = determine_machines_to_update(PROFILE_NAME, None, "emily", llewellyn_ip, region_name, URL_STEM,
+												  fresh=True)
+
+	assert [machine.url.strip() for machine in by_coach] == [f"https://idea-c7f3aa50-1.{URL_STEM}"]
+	assert [machine.url.strip() for machine in by_host_ip] == [f"https://idea-c7f3aa51-1.{URL_STEM}"]
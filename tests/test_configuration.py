@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from configuration import Configuration, ConfigurationError
+
+AWS_ZONES = """\
+{
+    "default": {
+        "eu-central-1": {
+            "image_id": "ami-05f7491af5eef733c",
+            "security_group_ids": ["sg-0d66d1b4ba3786ff3"],
+            "key_name": "pem-eu-central-1"
+        }
+    }
+}
+"""
+
+AWS_MACHINE_SPEC = """\
+{
+  "default": {
+    "region": "eu-central-1",
+    "instance_type": "t3.large",
+    "volume_type": "gp2",
+    "volume_size": 16,
+    "coach_tag": "SammanCoach",
+    "url_stem": "codekata.proagile.link"
+  }
+}
+"""
+
+IDE_CONFIG = """\
+{
+    "clion": {
+        "name": "CLion 2021.2",
+        "extra_packages": [],
+        "snap_packages": [],
+        "environment": {}
+    }
+}
+"""
+
+
+def write_config(directory, ide_config=IDE_CONFIG, aws_zones=AWS_ZONES):
+    (directory / "ide_config.json").write_text(ide_config)
+    (directory / "aws_zones.json").write_text(aws_zones)
+    (directory / "aws_machine_spec.json").write_text(AWS_MACHINE_SPEC)
+
+
+def test_records_are_resolved_up_front(tmp_path):
+    write_config(tmp_path)
+
+    config = Configuration(directory=tmp_path)
+
+    assert config.ide_config("clion")["config_name"] == "clion"
+    assert config.region("eu-central-1")["key_name"] == "pem-eu-central-1"
+    assert config.region_names() == ["eu-central-1"]
+    assert config.aws_defaults["url_stem"] == "codekata.proagile.link"
+
+
+def test_files_are_only_read_again_when_they_change(tmp_path):
+    write_config(tmp_path)
+    config = Configuration(directory=tmp_path)
+    first_records = config.ide_configs
+
+    assert config.refresh().ide_configs is first_records
+
+    ide_config_file = tmp_path / "ide_config.json"
+    ide_config_file.write_text(IDE_CONFIG.replace("CLion 2021.2", "CLion 2022.1"))
+    stat = ide_config_file.stat()
+    os.utime(ide_config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert config.refresh().ide_config("clion")["name"] == "CLion 2022.1"
+
+
+def test_invalid_region_is_reported_up_front(tmp_path):
+    write_config(tmp_path, aws_zones=AWS_ZONES.replace('"key_name"', '"key"'))
+
+    with pytest.raises(ConfigurationError, match="eu-central-1.*missing key_name"):
+        Configuration(directory=tmp_path)
+
+
+def test_unknown_config_name(tmp_path):
+    write_config(tmp_path)
+
+    with pytest.raises(ConfigurationError, match="expected one of: clion"):
+        Configuration(directory=tmp_path).ide_config("rider")
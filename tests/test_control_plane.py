@@ -0,0 +1,44 @@
+import pytest
+
+from benchmarks.control_plane import measure, regressions, SCENARIOS
+from benchmarks.fake_aws import FakeAws
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_scenarios_run_against_the_fake_aws(scenario):
+    measurement = measure(scenario, rooms=3, region_count=2)
+
+    assert measurement.api_calls > 0
+    assert measurement.peak_memory_kb > 0
+
+
+def test_instances_and_update_dns_make_one_sweep_per_region():
+    assert measure("instances", rooms=10, region_count=3).api_calls == 3
+    # one sweep per region, one page of records and one batch of changes
+    assert measure("update_dns", rooms=10, region_count=3).api_calls == 5
+
+
+def test_throttled_calls_are_retried_until_attempts_run_out():
+    class Model:
+        name = "DescribeInstanceTypes"
+
+        class service_model:
+            service_name = "ec2"
+
+    context = {"client_region": "eu-north-1", "fake_aws_params": {"InstanceTypes": ["t3.large"]}}
+
+    http, parsed = FakeAws(throttle_rate=1.0, max_attempts=3, backoff=0).respond(model=Model, context=context)
+    assert (http.status_code, parsed["Error"]["Code"]) == (400, "Throttling")
+
+    fake_aws = FakeAws(throttle_rate=0.5, max_attempts=10, backoff=0, seed=1)
+    http, parsed = fake_aws.respond(model=Model, context=context)
+    assert http.status_code == 200
+    assert fake_aws.calls["ec2.DescribeInstanceTypes"] == fake_aws.throttled["ec2.DescribeInstanceTypes"] + 1
+
+
+def test_more_calls_than_the_baseline_is_a_regression():
+    measurement = measure("instances", rooms=1, region_count=1)
+    baseline = {"seconds": 60.0, "api_calls": 0, "throttled": 0}
+
+    assert regressions([measurement], {measurement.key: baseline}, tolerance=0.25) == [
+        f"{measurement.key}: 1 AWS calls, baseline 0"]
@@ -0,0 +1,95 @@
+import pathlib
+import subprocess
+
+import pytest
+from approvaltests import verify
+
+import aws_clients
+from benchmarks.control_plane import benchmark_environment, benchmark_directory, write_config, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from configuration import ConfigurationError
+from ide_tuning import Tuning, render_vmoptions, tuning_commands, heap_mb, instance_type_sizes
+from summon import generate_script, read_ide_config, RUN_STEP, render_steps, Step
+
+IDE_VMOPTIONS = pathlib.Path(__file__).parent.parent / "clion64.vmoptions"
+INSTANCE_SIZES = {"t3.large": (8192, 2), "m5.xlarge": (16384, 4)}
+
+
+def test_heap_grows_with_the_machine_within_limits():
+    tuning = Tuning.from_config({"heap_fraction": 0.35, "max_heap_mb": 8192})
+
+    assert [heap_mb(tuning, memory_mb) for memory_mb in [2048, 8192, 16384, 65536]] == [1024, 2816, 5632, 8192]
+
+
+def test_vmoptions_for_a_small_and_a_large_machine():
+    tuning = Tuning.from_config({"properties": {"idea.max.intellisense.filesize": "5000"}})
+
+    small = render_vmoptions(tuning, 8192, 2).splitlines()
+    large = render_vmoptions(tuning, 32768, 8).splitlines()
+
+    assert small[:2] == ["-Xmx4096m", "-Xms1024m"]
+    assert "-XX:ParallelGCThreads=2" in small and "-XX:ConcGCThreads=1" in small
+    assert large[:2] == ["-Xmx16384m", "-Xms4096m"]
+    assert "-XX:CICompilerCount=4" in large and "-XX:ConcGCThreads=2" in large
+    assert large[-2:] == ["-DORG_JETBRAINS_PROJECTOR_SERVER_AUTO_KEYMAP=false", "-Didea.max.intellisense.filesize=5000"]
+
+
+def test_unknown_tuning_settings_are_refused():
+    with pytest.raises(ConfigurationError):
+        Tuning.from_config({"heap_percent": 50})
+    with pytest.raises(ConfigurationError):
+        Tuning.from_config({"gc": "Z"})
+
+
+def test_instance_sizes_come_from_ec2():
+    with benchmark_environment(FakeAws()):
+        write_config(benchmark_directory(), region_count=1)
+        ec2 = aws_clients.client("ec2", "eu-north-1", PROFILE_NAME)
+
+        assert instance_type_sizes(ec2, ["m5.xlarge", "t3.large", "m5.xlarge"]) == INSTANCE_SIZES
+
+
+def test_generate_script_with_tuning():
+    machine_config = read_ide_config()["clion"]
+
+    script = generate_script("c7f3aa50-1-clion.codekata.proagile.link", instance_sizes=INSTANCE_SIZES,
+                             **machine_config)
+
+    verify(script)
+
+
+def tune_locally(tmp_path, ide_vmoptions, tuning):
+    """ Run the ide-tuning step with dash on an m5.xlarge, and return the IDE's vmoptions lines afterwards """
+    bin_directory = tmp_path / "home" / "typist" / ".projector" / "apps" / "clion-2021.2" / "bin"
+    bin_directory.mkdir(parents=True)
+    (bin_directory / "clion64.vmoptions").write_text(ide_vmoptions)
+    commands = tuning_commands(tuning, INSTANCE_SIZES)
+    commands = "\n".join(line for line in commands.splitlines() if "169.254.169.254" not in line)
+    script = "set -e\nphase() { :; }\nINSTANCE_TYPE=m5.xlarge\n" + RUN_STEP + render_steps([Step("ide-tuning", commands)])
+    script = script.replace("sudo -u typist ", "").replace("/home/typist", f"{tmp_path}/home/typist")
+
+    result = subprocess.run(["dash", "-c", script], capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stderr == ""
+    return (bin_directory / "clion64.vmoptions").read_text().splitlines()
+
+
+def test_tuned_options_replace_the_ides_own(tmp_path):
+    vmoptions = tune_locally(tmp_path, IDE_VMOPTIONS.read_text(), {"gc": "Parallel"})
+
+    assert [option for option in vmoptions if option.startswith(("-Xm", "-XX:+Use", "-XX:CICompilerCount"))] == [
+        "-Xmx8192m", "-Xms2048m", "-XX:+UseParallelGC", "-XX:CICompilerCount=2"]
+    assert vmoptions.count("-DORG_JETBRAINS_PROJECTOR_SERVER_AUTO_KEYMAP=false") == 1
+    assert "-XX:NewSize=128m" not in vmoptions
+    assert "-XX:-OmitStackTraceInFastThrow" in vmoptions
+
+
+def test_only_the_properties_that_are_tuned_are_replaced(tmp_path):
+    ide_vmoptions = "-Dsun.io.useCanonCaches=false\n-Dsun-io-useCanonCaches=false\n"
+
+    vmoptions = tune_locally(tmp_path, ide_vmoptions, {"properties": {"sun.io.useCanonCaches": "true"}})
+
+    assert "-Dsun.io.useCanonCaches=false" not in vmoptions
+    assert vmoptions.count("-Dsun.io.useCanonCaches=true") == 1
+    assert "-Dsun-io-useCanonCaches=false" in vmoptions
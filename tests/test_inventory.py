@@ -0,0 +1,96 @@
+import datetime
+
+from inventory import Inventory, CachedDiscovery, session_id
+from wrap_ec2_client import InstanceDiscovery
+
+
+def instance(instance_id, name, state="running", coach="emily"):
+    return {
+        "InstanceId": instance_id,
+        "State": {"Name": state},
+        "Tags": [{"Key": "Name", "Value": name}, {"Key": "SammanCoach", "Value": coach}],
+        "LaunchTime": datetime.datetime(2021, 10, 1, 12, 0, tzinfo=datetime.timezone.utc),
+    }
+
+
+class CountingEc2:
+    def __init__(self, instances):
+        self.instances = instances
+        self.sweeps = 0
+        self.described = []
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Filters):
+        self.sweeps += 1
+        yield {"Reservations": [{"Instances": self.instances}]}
+
+    def describe_instances(self, InstanceIds):
+        self.described.append(InstanceIds)
+        return {"Reservations": [{"Instances": [i for i in self.instances if i["InstanceId"] in InstanceIds]}]}
+
+
+def cached_discovery(ec2, tmp_path, fresh=False):
+    discovery = InstanceDiscovery(ec2, "codekata.proagile.link")
+    return CachedDiscovery(discovery, "eu-north-1", "default", Inventory(tmp_path / "inventory.sqlite3"), fresh)
+
+
+def test_a_second_lookup_is_answered_from_the_inventory(tmp_path):
+    ec2 = CountingEc2([
+        instance("i-1", "idea-c7f3aa50-1.codekata.proagile.link"),
+        instance("i-2", "idea-c7f3aa50-2.codekata.proagile.link", state="stopped", coach="llewellyn"),
+    ])
+
+    assert [i["InstanceId"] for i in cached_discovery(ec2, tmp_path).instances()] == ["i-1", "i-2"]
+    later = cached_discovery(ec2, tmp_path)
+
+    assert [i["InstanceId"] for i in later.instances(coach="llewellyn")] == ["i-2"]
+    assert [i["InstanceId"] for i in later.instances(states=["running"])] == ["i-1"]
+    assert list(later.instances(name="-3.")) == []
+    assert next(later.instances())["LaunchTime"] == "2021-10-01T12:00:00+00:00"
+    assert ec2.sweeps == 1
+
+
+def test_fresh_and_expired_inventories_sweep_the_region_again(tmp_path):
+    ec2 = CountingEc2([instance("i-1", "idea-c7f3aa50.codekata.proagile.link")])
+    list(cached_discovery(ec2, tmp_path).instances())
+
+    list(cached_discovery(ec2, tmp_path, fresh=True).instances())
+    expired = cached_discovery(ec2, tmp_path)
+    expired.inventory.ttl = -1
+    list(expired.instances())
+
+    assert ec2.sweeps == 3
+
+
+def test_only_changing_machines_are_looked_up_again(tmp_path):
+    pending = instance("i-2", "idea-c7f3aa50-2.codekata.proagile.link", state="pending")
+    ec2 = CountingEc2([instance("i-1", "idea-c7f3aa50-1.codekata.proagile.link"), pending])
+    list(cached_discovery(ec2, tmp_path).instances())
+
+    pending["State"]["Name"] = "running"
+    running = list(cached_discovery(ec2, tmp_path).instances(states=["running"]))
+
+    assert [i["InstanceId"] for i in running] == ["i-1", "i-2"]
+    assert ec2.sweeps == 1
+    assert ec2.described == [["i-2"]]
+
+
+def test_session_id_comes_from_the_name():
+    assert session_id("idea-c7f3aa50-12.codekata.proagile.link") == "c7f3aa50"
+    assert session_id("idea-c7f3aa50.codekata.proagile.link") == "c7f3aa50"
+    assert session_id("pool-idea") is None
+
+
+def test_starting_or_stopping_machines_makes_the_next_command_sweep_again(tmp_path):
+    ec2 = CountingEc2([instance("i-1", "idea-c7f3aa50-1.codekata.proagile.link", state="stopped")])
+    discovery = cached_discovery(ec2, tmp_path)
+    list(discovery.instances())
+
+    discovery.invalidate()
+    ec2.instances[0]["State"]["Name"] = "pending"
+    next_command = cached_discovery(ec2, tmp_path)
+
+    assert [i["State"]["Name"] for i in next_command.instances()] == ["pending"]
+    assert ec2.sweeps == 2
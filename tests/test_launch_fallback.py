@@ -0,0 +1,114 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from benchmarks.control_plane import benchmark_environment, benchmark_directory, write_config, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from configuration import configuration
+from launch_fallback import LaunchChoice, CapacityMemory, launch_choices, run_instances_with_fallback, capacity_memory
+from quotas import InsufficientVcpuQuota
+from summon import create_instances, launch_classroom
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class NoCapacityEc2:
+    def __init__(self, error_codes):
+        """ run_instances fails with the error code given for the instance type, and succeeds for the others """
+        self.error_codes = error_codes
+        self.tried = []
+
+    def run_instances(self, InstanceType):
+        self.tried.append(InstanceType)
+        if InstanceType in self.error_codes:
+            raise ClientError({"Error": {"Code": self.error_codes[InstanceType], "Message": "no"}}, "RunInstances")
+        return {"Instances": [{"InstanceId": "i-1", "InstanceType": InstanceType}]}
+
+
+def instance_type_arguments(choice):
+    return {"InstanceType": choice.instance_type}
+
+
+def test_choices_are_every_instance_type_in_every_subnet():
+    region_config = {"subnet_ids": ["subnet-a", "subnet-b"]}
+    aws_defaults = {"instance_type": "t3.large", "instance_types": ["t3.large", "m5.large"]}
+
+    assert launch_choices(region_config, aws_defaults) == [
+        LaunchChoice("t3.large", "subnet-a"), LaunchChoice("t3.large", "subnet-b"),
+        LaunchChoice("m5.large", "subnet-a"), LaunchChoice("m5.large", "subnet-b")]
+    assert launch_choices({}, {"instance_type": "t3.large"}) == [LaunchChoice("t3.large")]
+    assert launch_choices({"instance_types": ["t3a.large"]}, aws_defaults) == [LaunchChoice("t3a.large")]
+
+
+def test_capacity_failures_are_skipped_until_they_are_forgotten():
+    clock = FakeClock()
+    memory = CapacityMemory(seconds=300, clock=clock)
+    choices = [LaunchChoice("t3.large"), LaunchChoice("m5.large")]
+    ec2 = NoCapacityEc2({"t3.large": "InsufficientInstanceCapacity"})
+
+    _, first = run_instances_with_fallback(ec2, "eu-north-1", choices, instance_type_arguments, memory)
+    _, second = run_instances_with_fallback(ec2, "eu-north-1", choices, instance_type_arguments, memory)
+    clock.now = 301
+    run_instances_with_fallback(ec2, "eu-north-1", choices, instance_type_arguments, memory)
+
+    assert (first, second) == (LaunchChoice("m5.large"), LaunchChoice("m5.large"))
+    assert ec2.tried == ["t3.large", "m5.large", "m5.large", "t3.large", "m5.large"]
+
+
+def test_other_errors_are_not_retried_and_the_last_capacity_error_is_raised():
+    choices = [LaunchChoice("t3.large"), LaunchChoice("m5.large")]
+    memory = CapacityMemory()
+
+    with pytest.raises(ClientError, match="UnauthorizedOperation"):
+        run_instances_with_fallback(NoCapacityEc2({"t3.large": "UnauthorizedOperation"}), "eu-north-1", choices,
+                                    instance_type_arguments, memory)
+    with pytest.raises(ClientError, match="Unsupported"):
+        run_instances_with_fallback(NoCapacityEc2({"t3.large": "InsufficientInstanceCapacity",
+                                                   "m5.large": "Unsupported"}), "eu-north-1", choices,
+                                    instance_type_arguments, memory)
+
+
+def test_classroom_launch_falls_back_and_records_the_choice_for_each_room():
+    fake_aws = FakeAws(no_capacity=[("eu-north-1", "t3.large", "subnet-a")],
+                       subnet_zones={"subnet-a": "eu-north-1a", "subnet-b": "eu-north-1b"})
+    capacity_memory().clear()
+    with benchmark_environment(fake_aws):
+        directory = benchmark_directory()
+        write_config(directory, region_count=2)
+        zones = json.loads((directory / "aws_zones.json").read_text())
+        zones[PROFILE_NAME]["eu-north-1"]["subnet_ids"] = ["subnet-a", "subnet-b"]
+        (directory / "aws_zones.json").write_text(json.dumps(zones))
+        rooms = create_instances(2, "idea", "c7f3aa50", "emily", "eu-north-1", "codekata.proagile.link") + \
+            create_instances(1, "idea", "c7f3aa51", "emily", "eu-central-1", "codekata.proagile.link")
+
+        launch_classroom(rooms, configuration(PROFILE_NAME))
+
+    assert [(room.instance_type, room.availability_zone) for room in rooms] == [
+        ("t3.large", "eu-north-1b"), ("t3.large", "eu-north-1b"), ("t3.large", "eu-central-1a")]
+    assert fake_aws.calls["ec2.RunInstances"] == 3
+    assert capacity_memory().recently_failed("eu-north-1", LaunchChoice("t3.large", "subnet-a"))
+    capacity_memory().clear()
+
+
+def test_the_quota_is_checked_for_the_largest_instance_type_a_room_might_get():
+    fake_aws = FakeAws(vcpu_quotas={"eu-north-1": 8})
+    with benchmark_environment(fake_aws):
+        directory = benchmark_directory()
+        write_config(directory, region_count=1)
+        zones = json.loads((directory / "aws_zones.json").read_text())
+        zones[PROFILE_NAME]["eu-north-1"]["instance_types"] = ["t3.large", "m5.xlarge"]
+        (directory / "aws_zones.json").write_text(json.dumps(zones))
+        rooms = create_instances(3, "idea", "c7f3aa50", "emily", "eu-north-1", "codekata.proagile.link")
+
+        # 3 x t3.large would fit in 8 vCPUs, but they might all be launched as m5.xlarge
+        with pytest.raises(InsufficientVcpuQuota, match="up to 12 vCPUs"):
+            launch_classroom(rooms, configuration(PROFILE_NAME))
+
+    assert fake_aws.calls["ec2.RunInstances"] == 0
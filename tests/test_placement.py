@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from benchmarks.control_plane import benchmark_environment, benchmark_directory, write_config, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from configuration import configuration
+from placement import RegionCapacity, plan_placement, place_rooms, region_capacities
+from quotas import InsufficientVcpuQuota, is_standard
+from summon import create_instances
+
+
+def test_rooms_are_placed_in_proportion_to_the_weights():
+    capacities = [RegionCapacity("eu-north-1", weight=3), RegionCapacity("us-east-1", weight=1)]
+
+    assert plan_placement(8, capacities) == {"eu-north-1": 6, "us-east-1": 2}
+
+
+def test_full_regions_overflow_into_the_others():
+    capacities = [RegionCapacity("eu-north-1", weight=3, max_rooms=2), RegionCapacity("us-east-1", weight=1),
+                  RegionCapacity("ap-southeast-2", weight=0)]
+
+    assert plan_placement(5, capacities) == {"eu-north-1": 2, "us-east-1": 3}
+    capacities[1].max_rooms = 1
+    assert plan_placement(5, capacities) == {"eu-north-1": 2, "us-east-1": 1, "ap-southeast-2": 2}
+
+
+def test_too_many_rooms_for_the_regions():
+    with pytest.raises(InsufficientVcpuQuota):
+        plan_placement(3, [RegionCapacity("eu-north-1", max_rooms=2)])
+
+
+def test_rooms_are_given_their_regions_in_room_order():
+    instances = create_instances(3, "idea", "c7f3aa50", "emily", "eu-north-1", "codekata.proagile.link")
+
+    place_rooms(instances, {"ca-central-1": 1, "eu-central-1": 2})
+
+    assert [(instance.room, instance.region_name) for instance in instances] == [
+        (1, "ca-central-1"), (2, "eu-central-1"), (3, "eu-central-1")]
+
+
+def test_only_standard_instance_types_count_against_the_standard_quota():
+    assert [is_standard(t) for t in ["t3.large", "m5a.xlarge", "c7gn.large", "im4gn.large", "z1d.large"]] == [True] * 5
+    assert [is_standard(t) for t in ["g4dn.xlarge", "p3.2xlarge", "x2iedn.xlarge", "inf1.xlarge", "hpc6a.48xlarge",
+                                     "dl1.24xlarge", "f1.2xlarge"]] == [False] * 7
+
+
+def test_capacity_is_limited_by_max_rooms_and_vcpu_headroom():
+    fake_aws = FakeAws(vcpu_quotas={"eu-north-1": 10})
+    with benchmark_environment(fake_aws):
+        region_names = write_config(benchmark_directory(), region_count=3)
+        zones_file = benchmark_directory() / "aws_zones.json"
+        zones = json.loads(zones_file.read_text())
+        zones[PROFILE_NAME]["eu-central-1"].update(placement_weight=2, max_rooms=4)
+        zones_file.write_text(json.dumps(zones))
+        fake_aws.add_instance("eu-north-1", "idea-1", "emily")
+        # counts against a quota of its own
+        fake_aws.add_instance("eu-north-1", "training-1", "emily", instance_type="g4dn.xlarge")
+
+        capacities = region_capacities(configuration(PROFILE_NAME), region_names)
+
+    assert capacities == [RegionCapacity("eu-north-1", 1, 4), RegionCapacity("eu-central-1", 2, 4),
+                          RegionCapacity("ca-central-1", 1, 50000)]
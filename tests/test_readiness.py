@@ -0,0 +1,145 @@
+import http.server
+import io
+import shutil
+import ssl
+import subprocess
+import threading
+
+import pytest
+
+from readiness import ReadinessProber, RoomReadiness, ProgressTable, wait_for_rooms, READY, TLS, PROJECTOR, DNS
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if not shutil.which("openssl"):
+        pytest.skip("needs openssl to make a certificate")
+    directory = tmp_path_factory.mktemp("certificate")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost", "-keyout", str(directory / "key.pem"),
+                    "-out", str(directory / "cert.pem")], check=True, capture_output=True)
+    return directory / "cert.pem", directory / "key.pem"
+
+
+class Room:
+    def __init__(self, certificate, bad_gateways):
+        """ nginx in front of projector, answering 502 until projector has started """
+        self.bad_gateways = bad_gateways
+        room = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if room.bad_gateways:
+                    room.bad_gateways -= 1
+                    self.send_response(502)
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*certificate)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"https://localhost:{self.server.server_address[1]}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def prober(certificate, deadline=5):
+    return ReadinessProber(deadline=deadline, initial_delay=0.01, max_delay=0.05, timeout=2,
+                           ssl_context=ssl.create_default_context(cafile=str(certificate[0])))
+
+
+def test_rooms_are_ready_once_projector_answers_behind_nginx(certificate):
+    rooms = [Room(certificate, bad_gateways) for bad_gateways in [0, 3]]
+    try:
+        readiness = prober(certificate).wait_ready([room.url for room in rooms])
+    finally:
+        for room in rooms:
+            room.close()
+
+    assert [room.stage for room in readiness] == [READY, READY]
+    assert [room.attempts for room in readiness] == [1, 4]
+    assert readiness[1].seconds >= readiness[0].seconds
+
+
+def test_each_room_reports_the_stage_it_is_stuck_at(certificate):
+    untrusted = ReadinessProber(deadline=0, timeout=2)
+    room = Room(certificate, bad_gateways=100)
+    try:
+        stuck_at_projector = prober(certificate, deadline=0.1).wait_ready([room.url])[0]
+        untrusted_certificate = untrusted.wait_ready([room.url])[0]
+    finally:
+        room.close()
+    no_server = prober(certificate, deadline=0).wait_ready([room.url])[0]
+    no_name = prober(certificate, deadline=0).wait_ready(["https://room.invalid"])[0]
+
+    assert (stuck_at_projector.stage, stuck_at_projector.error) == (PROJECTOR, "502 Bad Gateway")
+    assert stuck_at_projector.seconds is None
+    assert untrusted_certificate.stage == TLS
+    assert no_server.stage == TLS
+    assert no_name.stage == DNS
+
+
+def test_progress_lines_when_not_on_a_terminal(certificate):
+    room = Room(certificate, bad_gateways=1)
+    output = io.StringIO()
+    try:
+        readiness = wait_for_rooms([room.url], prober(certificate), output)
+    finally:
+        room.close()
+
+    lines = output.getvalue().splitlines()
+    assert lines[0] == f"{room.url}: waiting for projector"
+    assert lines[1] == f"{room.url}: ready after {readiness[0].seconds:.1f}s"
+    assert lines[-1] == "1 of 1 rooms ready"
+
+
+class SteppingClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        self.now += 0.001
+        return self.now
+
+
+def test_time_to_ready_counts_from_the_launch_and_unready_rooms_are_errors(certificate):
+    room = Room(certificate, bad_gateways=0)
+    clock = SteppingClock()
+    output = io.StringIO()
+    probe = ReadinessProber(deadline=0, timeout=2, clock=clock,
+                            ssl_context=ssl.create_default_context(cafile=str(certificate[0])))
+    try:
+        readiness = wait_for_rooms([room.url, "https://room.invalid"], probe, output, since=clock.now - 60)
+    finally:
+        room.close()
+
+    assert 60 < readiness[0].seconds < 61
+    assert output.getvalue().splitlines()[-1].startswith("ERROR: https://room.invalid isn't ready, still waiting for dns")
+
+
+class Terminal(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def test_progress_table_is_redrawn_in_place_on_a_terminal():
+    terminal = Terminal()
+    progress = ProgressTable(terminal)
+    rooms = [RoomReadiness("https://idea-c7f3aa50-1.codekata.proagile.link")]
+
+    progress(rooms)
+    rooms[0].stage, rooms[0].seconds, rooms[0].attempts = READY, 42.0, 3
+    progress(rooms)
+
+    drawn = terminal.getvalue()
+    assert drawn.count("\x1b[3F\x1b[J") == 1
+    assert drawn.endswith("42.0s\n1 of 1 rooms ready\n")
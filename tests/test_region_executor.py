@@ -0,0 +1,57 @@
+import time
+
+import aws_clients
+from benchmarks.control_plane import benchmark_environment, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from region_executor import RegionExecutor, RegionTimeout
+
+
+def test_failing_region_does_not_stop_the_others():
+    def task(region_name):
+        if region_name == "eu-north-1":
+            raise Exception("no credentials for this region")
+        return region_name.upper()
+
+    results, failures = RegionExecutor().results(task, ["ca-central-1", "eu-north-1", "eu-central-1"])
+
+    assert results == {"ca-central-1": "CA-CENTRAL-1", "eu-central-1": "EU-CENTRAL-1"}
+    assert list(failures.keys()) == ["eu-north-1"]
+
+
+def test_results_arrive_as_each_region_finishes():
+    def task(region_name):
+        time.sleep({"slow": 0.2, "fast": 0}[region_name])
+        return region_name
+
+    outcomes = RegionExecutor().outcomes(task, ["slow", "fast"])
+
+    assert [outcome.region_name for outcome in outcomes] == ["fast", "slow"]
+
+
+def test_slow_region_times_out():
+    def task(region_name):
+        time.sleep({"stuck": 1, "fine": 0}[region_name])
+        return region_name
+
+    results, failures = RegionExecutor(timeout=0.1).results(task, ["stuck", "fine"])
+
+    assert results == {"fine": "fine"}
+    assert isinstance(failures["stuck"], RegionTimeout)
+
+
+def test_a_region_that_timed_out_makes_no_more_aws_calls():
+    fake_aws = FakeAws()
+    with benchmark_environment(fake_aws):
+        def task(region_name):
+            ec2 = aws_clients.client("ec2", region_name, PROFILE_NAME)
+            for _ in range(100):
+                ec2.describe_instances()
+                time.sleep(0.01)
+
+        _, failures = RegionExecutor(timeout=0.1).results(task, ["eu-north-1"])
+        time.sleep(0.1)
+        calls = fake_aws.calls["ec2.DescribeInstances"]
+        time.sleep(0.1)
+
+        assert isinstance(failures["eu-north-1"], RegionTimeout)
+        assert fake_aws.calls["ec2.DescribeInstances"] == calls
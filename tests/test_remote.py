@@ -0,0 +1,104 @@
+from approvaltests import verify
+
+from clone_kata import KataMachine
+from remote import RemoteExecutor, HostResult, summary_table, ConnectionCache, KeyFiles
+
+
+class FakeTransport:
+    """ Fails on the hosts it's told to, a given number of times each """
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.commands = []
+
+    def run(self, machine, commandline, timeout):
+        self.commands.append((machine.host_ip, commandline))
+        if self.failures.get(machine.host_ip, 0) > 0:
+            self.failures[machine.host_ip] -= 1
+            return 128, "", f"fatal: could not clone on {machine.host_ip}"
+        return 0, "Cloning into 'starter'...", ""
+
+
+def machine(room):
+    return KataMachine(region_name="eu-north-1", host_ip=f"10.0.0.{room}",
+                       url=f"https://idea-c7f3aa50-{room}.codekata.proagile.link")
+
+
+def test_command_runs_on_every_machine():
+    transport = FakeTransport()
+    machines = [machine(room) for room in range(1, 4)]
+
+    results = RemoteExecutor(transport).run("git clone", machines)
+
+    assert [result.ok for result in results] == [True, True, True]
+    assert sorted(host for host, _ in transport.commands) == ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+
+
+def test_only_failed_machines_are_retried():
+    transport = FakeTransport(failures={"10.0.0.2": 1})
+    machines = [machine(room) for room in range(1, 4)]
+
+    results = RemoteExecutor(transport).run("git clone", machines, retries=2)
+
+    assert [result.ok for result in results] == [True, True, True]
+    assert [result.attempts for result in results] == [1, 2, 1]
+    assert len(transport.commands) == 4
+
+
+def test_exceptions_become_failed_results():
+    class UnreachableTransport:
+        def run(self, machine, commandline, timeout):
+            raise TimeoutError("timed out connecting")
+
+    results = RemoteExecutor(UnreachableTransport()).run("git clone", [machine(1)])
+
+    assert results[0].status == "error"
+    assert results[0].error == "TimeoutError: timed out connecting"
+
+
+def test_summary_table():
+    results = [
+        HostResult(machine(1), exit_status=0, seconds=3.25),
+        HostResult(machine(2), exit_status=128, stderr="Cloning...\nfatal: repository not found\n", seconds=1.5),
+        HostResult(machine(3), error="TimeoutError: timed out connecting", seconds=15.0, attempts=2),
+    ]
+
+    verify("\n".join(summary_table(results)))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_connections_are_reused_until_idle():
+    cache = ConnectionCache(max_idle=60)
+
+    first = cache.get("10.0.0.1", FakeConnection)
+
+    assert cache.get("10.0.0.1", FakeConnection) is first
+    assert cache.get("10.0.0.2", FakeConnection) is not first
+
+    cache.max_idle = 0
+    cache.evict_idle()
+
+    assert first.closed
+    assert cache.get("10.0.0.1", FakeConnection) is not first
+
+
+def test_key_file_is_looked_up_once_per_region():
+    class CountingConfig:
+        lookups = 0
+
+        def region(self, region_name):
+            self.lookups += 1
+            return {"key_name": f"pem-{region_name}"}
+
+    config = CountingConfig()
+    key_files = KeyFiles(config)
+
+    assert key_files.for_region("eu-north-1").endswith("/.ssh/pem-eu-north-1.pem")
+    key_files.for_region("eu-north-1")
+    assert config.lookups == 1
@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+import request_scheduler
+from benchmarks.control_plane import benchmark_environment, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from request_scheduler import BucketLimits, TokenBucket, RequestScheduler, HIGH, LOW
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_is_halved_on_throttling_at_most_once_a_second_and_grows_back():
+    clock = FakeClock()
+    bucket = TokenBucket(BucketLimits(rate=20, burst=20, max_rate=21), clock=clock)
+
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 10
+    clock.now = 1.5
+    bucket.throttled()
+    assert bucket.rate == 5
+
+    for _ in range(400):
+        bucket.succeeded()
+    assert bucket.rate == 21
+
+
+def wait_until(condition, timeout=5):
+    give_up_at = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < give_up_at, "timed out"
+        time.sleep(0.001)
+
+
+def test_waiting_callers_are_served_in_priority_order():
+    clock = FakeClock()
+    bucket = TokenBucket(BucketLimits(rate=20, burst=1, max_rate=20), clock=clock)
+    bucket.acquire()
+    served = []
+
+    def take(level):
+        bucket.acquire(level)
+        served.append(level)
+
+    def add_tokens(seconds):
+        with bucket._condition:
+            clock.now += seconds
+            bucket._condition.notify_all()
+
+    low = threading.Thread(target=take, args=(LOW,))
+    low.start()
+    wait_until(lambda: len(bucket._waiting) == 1)
+    high = threading.Thread(target=take, args=(HIGH,))
+    high.start()
+    wait_until(lambda: len(bucket._waiting) == 2)
+    # the clock stands still until now, so neither of them could have had a token before both were waiting
+    add_tokens(1)
+    wait_until(lambda: served)
+    add_tokens(1)
+    low.join()
+    high.join()
+
+    assert served == [HIGH, LOW]
+
+
+def test_only_throttling_cuts_the_rate():
+    scheduler = RequestScheduler()
+    bucket = TokenBucket(BucketLimits(rate=20, burst=20, max_rate=20), clock=FakeClock())
+
+    def call(*attempt_errors):
+        context = {"request_scheduler_bucket": bucket}
+        for error_code in attempt_errors:
+            scheduler._attempt_received(parsed_response={"Error": {"Code": error_code}}, context=context)
+        scheduler._attempt_received(parsed_response={"ResponseMetadata": {"RetryAttempts": len(attempt_errors)}},
+                                    context=context)
+        scheduler._after_call(http_response=None, parsed={}, context=context)
+
+    call("InternalError", "ServiceUnavailable")
+    assert bucket.rate == 20
+    call("InternalError", "RequestLimitExceeded")
+    assert bucket.rate == 10
+
+
+def test_priority_follows_the_thread():
+    with request_scheduler.priority(HIGH):
+        assert request_scheduler.current_priority() == HIGH
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(request_scheduler.current_priority).result() == request_scheduler.NORMAL
+            assert executor.submit(request_scheduler.prioritized(LOW, request_scheduler.current_priority)).result() == LOW
+    assert request_scheduler.current_priority() == request_scheduler.NORMAL
+
+
+def test_calls_stay_under_the_rate_aws_allows():
+    fake_aws = FakeAws(rate_limits={"ec2": (20, 100)})
+    with benchmark_environment(fake_aws):
+        ec2 = aws_clients.client("ec2", "eu-north-1", PROFILE_NAME)
+        instance_ids = [fake_aws.add_instance("eu-north-1", f"idea-{i}", "emily") for i in range(120)]
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(lambda instance_id: ec2.create_tags(Resources=[instance_id], Tags=[]), instance_ids))
+
+    # it probes for a higher rate now and then, so the odd call is throttled - but not one in ten
+    assert sum(fake_aws.throttled.values()) < len(instance_ids) / 10
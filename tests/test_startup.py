@@ -0,0 +1,22 @@
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.startup import ENTRY_POINTS, REPO_ROOT, measure_import
+
+
+@pytest.mark.parametrize("module", ENTRY_POINTS)
+def test_entry_point_imports_no_heavy_modules(module, tmp_path):
+    _, heavy = measure_import(module, cwd=tmp_path)
+
+    assert heavy == []
+
+
+@pytest.mark.parametrize("module", ["summon", "instances", "clone_kata", "update_dns"])
+def test_help_works_without_config_files(module, tmp_path):
+    result = subprocess.run([sys.executable, str(REPO_ROOT / f"{module}.py"), "--help"], cwd=tmp_path,
+                            capture_output=True, text=True, env={"PYTHONPATH": str(REPO_ROOT), "PATH": ""})
+
+    assert result.returncode == 0, result.stderr
+    assert "Usage:" in result.stdout
@@ -1,10 +1,13 @@
 import io
 import json
 
+import pytest
 from approvaltests import verify, verify_all
+from click.testing import CliRunner
+from approvaltests.namer.default_namer_factory import NamerFactory
 
 from summon import write_classroom_file, create_instances, ProjectorInstance, generate_script, read_ide_config, \
-    read_regions_config, read_aws_defaults
+    read_regions_config, read_aws_defaults, launch_groups, launch_group, generate_pool_script, summon
 
 
 def test_create_several_instances():
@@ -43,13 +46,14 @@ def test_write_classroom():
     verify(f.getvalue())
 
 
-def test_generate_script():
-    dns_name = "c7f3aa50-1-idea.codekata.proagile.link"
-    machine_config = read_ide_config()["idea"]
+@pytest.mark.parametrize("config_name", list(read_ide_config()))
+def test_generate_script(config_name):
+    dns_name = f"c7f3aa50-1-{config_name}.codekata.proagile.link"
+    machine_config = read_ide_config()[config_name]
 
     script = generate_script(dns_name, **machine_config)
 
-    verify(script)
+    verify(script, options=NamerFactory.with_parameters(config_name))
 
 
 def test_read_config(tmp_path):
@@ -119,3 +123,86 @@ def test_read_aws_config(tmp_path):
     assert aws_defaults["volume_size"] == 16
     assert aws_defaults["url_stem"] == "codekata.proagile.link"
 
+
+def test_launch_groups():
+    instances = create_instances(3, "idea", "c7f3aa50", "emily", "ca-central-1", url_stem="codekata.proagile.link")
+    instances.append(ProjectorInstance("rider", "rider-c7f3aa50-4.codekata.proagile.link", "emily", "eu-north-1", room=4))
+
+    groups = launch_groups(instances)
+
+    assert {key: [i.room for i in group] for key, group in groups.items()} == {
+        ("idea", "ca-central-1", "emily"): [1, 2, 3],
+        ("rider", "eu-north-1", "emily"): [4],
+    }
+
+
+class FakeEc2:
+    def __init__(self, tag_failures=()):
+        """ tag_failures - for each instance id, how many create_tags calls on it fail before one works """
+        self.calls = []
+        self.tag_failures = dict(tag_failures)
+
+    def run_instances(self, **kwargs):
+        self.calls.append(("run_instances", kwargs["MinCount"], kwargs["MaxCount"]))
+        return {"Instances": [{"InstanceId": f"i-{index}", "AmiLaunchIndex": index}
+                              for index in reversed(range(kwargs["MaxCount"]))]}
+
+    def describe_instance_types(self, InstanceTypes):
+        return {"InstanceTypes": [{"InstanceType": instance_type, "MemoryInfo": {"SizeInMiB": 8192},
+                                   "VCpuInfo": {"DefaultVCpus": 2}} for instance_type in InstanceTypes]}
+
+    def create_tags(self, Resources, Tags):
+        self.calls.append(("create_tags", Resources, Tags))
+        if self.tag_failures.get(Resources[0], 0) > 0:
+            self.tag_failures[Resources[0]] -= 1
+            raise RuntimeError("RequestLimitExceeded")
+
+    def terminate_instances(self, InstanceIds):
+        self.calls.append(("terminate_instances", InstanceIds))
+
+
+def test_launch_group_tags_each_room():
+    ec2 = FakeEc2()
+    instances = create_instances(2, "idea", "c7f3aa50", "emily", "ca-central-1", url_stem="codekata.proagile.link")
+    region_config = {"image_id": "ami-1", "key_name": "pem", "security_group_ids": ["sg-1"]}
+    aws_defaults = {"coach_tag": "SammanCoach", "instance_type": "t3.large", "volume_type": "gp2", "volume_size": 16}
+
+    launch_group(ec2, instances, read_ide_config()["idea"], region_config, aws_defaults)
+
+    assert [i.instance_id for i in instances] == ["i-0", "i-1"]
+    assert ec2.calls == [
+        ("run_instances", 2, 2),
+        ("create_tags", ["i-0"], [{"Key": "Name", "Value": "idea-c7f3aa50-1.codekata.proagile.link"}]),
+        ("create_tags", ["i-1"], [{"Key": "Name", "Value": "idea-c7f3aa50-2.codekata.proagile.link"}]),
+    ]
+
+
+def test_launch_group_retries_tagging_and_terminates_machines_it_couldnt_tag():
+    ec2 = FakeEc2(tag_failures={"i-0": 1, "i-1": 10})
+    instances = create_instances(3, "idea", "c7f3aa50", "emily", "ca-central-1", url_stem="codekata.proagile.link")
+    region_config = {"image_id": "ami-1", "key_name": "pem", "security_group_ids": ["sg-1"]}
+    aws_defaults = {"coach_tag": "SammanCoach", "instance_type": "t3.large", "volume_type": "gp2", "volume_size": 16}
+    sleeps = []
+
+    with pytest.raises(RuntimeError, match="RequestLimitExceeded"):
+        launch_group(ec2, instances, read_ide_config()["idea"], region_config, aws_defaults, sleep=sleeps.append)
+
+    assert [i.instance_id for i in instances] == ["i-0", None, "i-2"]
+    assert sleeps == [1, 1, 2, 4]
+    assert ec2.calls[-1] == ("terminate_instances", ["i-1"])
+
+
+def test_generate_pool_script():
+    machine_config = read_ide_config()["idea"]
+
+    script = generate_pool_script(**machine_config)
+
+    verify(script)
+
+
+def test_spread_cant_be_combined_with_a_region():
+    result = CliRunner().invoke(summon, ["--config-name", "idea", "--region-name", "eu-north-1", "--spread",
+                                         "--classroom-size", "2", "--coach", "emily"])
+
+    assert result.exit_code == 2
+    assert "--spread picks the regions itself" in result.output
@@ -0,0 +1,109 @@
+from benchmarks.control_plane import benchmark_environment, benchmark_directory, write_config, PROFILE_NAME, \
+    REGION_NAMES
+from benchmarks.fake_aws import FakeAws
+from configuration import configuration
+from local_cache import read_json_cache, write_json_cache
+from update_dns import changes_needed, change_batches, upsert_a_record, DnsWatcher, DnsUpdater, HOSTED_ZONES_CACHE
+
+
+def test_only_changed_records_are_sent():
+    current = {
+        "idea-c7f3aa50-1.codekata.proagile.link": "10.0.0.1",
+        "idea-c7f3aa50-2.codekata.proagile.link": "10.0.0.2",
+    }
+    wanted = {
+        "idea-c7f3aa50-1.codekata.proagile.link": "10.0.0.1",
+        "idea-c7f3aa50-2.codekata.proagile.link": "10.0.0.22",
+        "idea-c7f3aa50-3.codekata.proagile.link": "10.0.0.3",
+    }
+
+    changes = changes_needed(current, wanted)
+
+    assert [change["ResourceRecordSet"]["Name"] for change in changes] == [
+        "idea-c7f3aa50-2.codekata.proagile.link",
+        "idea-c7f3aa50-3.codekata.proagile.link",
+    ]
+
+
+def test_upserts_are_split_at_the_route53_limit():
+    changes = [upsert_a_record(f"room-{i}.codekata.proagile.link", "10.0.0.1") for i in range(1201)]
+
+    batches = list(change_batches(changes))
+
+    assert [len(batch) for batch in batches] == [500, 500, 201]
+
+
+class ScriptedMachines:
+    """ An InstancesManager whose machines go through the states in polls, one poll per cycle """
+    def __init__(self, polls):
+        self.polls = iter(polls)
+        self.region_failures = {}
+
+    def machine_states(self):
+        return next(self.polls)
+
+
+class RecordingDnsUpdater:
+    def __init__(self, polls, failures=()):
+        """ apply_changes raises the failures, one per call, before it starts to work """
+        self.instance_manager = ScriptedMachines(polls)
+        self.applied = []
+        self.reads = 0
+        self.failures = list(failures)
+
+    def current_a_records(self):
+        self.reads += 1
+        return {"room-1.codekata.proagile.link": "10.0.0.1"}
+
+    def apply_changes(self, changes, wait=False):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.applied.append([(c["ResourceRecordSet"]["Name"], c["ResourceRecordSet"]["ResourceRecords"][0]["Value"])
+                             for c in changes])
+
+
+def test_watcher_polls_fast_while_machines_change_and_backs_off_when_stable():
+    room_1 = "room-1.codekata.proagile.link"
+    updater = RecordingDnsUpdater([
+        [(room_1, "pending", None)],
+        [(room_1, "running", "10.0.0.9")],
+        [(room_1, "running", "10.0.0.9")],
+        [(room_1, "running", "10.0.0.9")],
+        [(room_1, "running", "10.0.0.9")],
+    ])
+    sleeps = []
+
+    DnsWatcher(updater, fast_interval=5, slow_interval=30, backoff=2, sleep=sleeps.append).watch(cycles=5)
+
+    assert updater.applied == [[(room_1, "10.0.0.9")]]
+    assert sleeps == [5, 5, 10, 20]
+
+
+def test_watcher_survives_failed_cycles_and_reads_the_zone_again_when_slow():
+    room_1 = "room-1.codekata.proagile.link"
+    updater = RecordingDnsUpdater([[(room_1, "running", "10.0.0.9")]] * 6, failures=[RuntimeError("Throttling")])
+    sleeps = []
+
+    DnsWatcher(updater, fast_interval=5, slow_interval=10, backoff=2, sleep=sleeps.append).watch(cycles=6)
+
+    # the zone always has the old address, as if something else kept changing it back,
+    # so it is put right after the failed cycle and again after every read on a slow cycle
+    assert sleeps == [10, 5, 10, 5, 10]
+    assert updater.applied == [[(room_1, "10.0.0.9")]] * 3
+    assert updater.reads == 4
+
+
+def test_a_cached_zone_id_for_a_zone_that_was_created_again_is_looked_up_again():
+    fake_aws = FakeAws(hosted_zone_id="/hostedzone/ZRECREATED")
+    with benchmark_environment(fake_aws):
+        write_config(benchmark_directory(), region_count=1)
+        aws_defaults = dict(configuration(PROFILE_NAME).aws_defaults)
+        del aws_defaults["hosted_dns_zone_id"]
+        write_json_cache(HOSTED_ZONES_CACHE, {f"{PROFILE_NAME}:proagile.link.": "/hostedzone/ZFAKEAWS"})
+        updater = DnsUpdater(aws_defaults, REGION_NAMES[:1], PROFILE_NAME)
+
+        updater.apply_changes([upsert_a_record("room-1.codekata.proagile.link", "10.0.0.1")])
+
+        assert read_json_cache(HOSTED_ZONES_CACHE) == {f"{PROFILE_NAME}:proagile.link.": "/hostedzone/ZRECREATED"}
+    assert fake_aws.records == {"room-1.codekata.proagile.link": "10.0.0.1"}
+    assert fake_aws.calls["route53.ChangeResourceRecordSets"] == 2
@@ -0,0 +1,98 @@
+from summon import ProjectorInstance, create_instances
+from warm_pool import WarmPool, pool_status, CLAIM_TAG
+
+
+class PoolEc2:
+    def __init__(self, instances, fail_to_start=False, rival_claims=()):
+        """ rival_claims - ids of machines another summon claims right after this one tags them """
+        self.instances = instances
+        self.fail_to_start = fail_to_start
+        self.rival_claims = rival_claims
+        self.calls = []
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Filters):
+        states = next(f["Values"] for f in Filters if f["Name"] == "instance-state-name")
+        yield {"Reservations": [{"Instances": [i for i in self.instances if i["State"]["Name"] in states]}]}
+
+    def describe_instances(self, InstanceIds):
+        return {"Reservations": [{"Instances": [i for i in self.instances if i["InstanceId"] in InstanceIds]}]}
+
+    def delete_tags(self, Resources, Tags):
+        self.calls.append(("delete_tags", Resources))
+        for instance in self.tagged(Resources):
+            instance["Tags"] = [tag for tag in instance["Tags"] if tag["Key"] not in {t["Key"] for t in Tags}]
+
+    def create_tags(self, Resources, Tags):
+        tags = {tag["Key"]: tag["Value"] for tag in Tags}
+        if CLAIM_TAG not in tags:
+            self.calls.append(("create_tags", Resources, tags))
+        for instance in self.tagged(Resources):
+            rival = CLAIM_TAG in tags and instance["InstanceId"] in self.rival_claims
+            instance_tags = dict(tags, **{CLAIM_TAG: "theirs"}) if rival else tags
+            instance["Tags"] = [tag for tag in instance["Tags"] if tag["Key"] not in instance_tags] + \
+                [{"Key": key, "Value": value} for key, value in instance_tags.items()]
+
+    def tagged(self, instance_ids):
+        return [instance for instance in self.instances if instance["InstanceId"] in instance_ids]
+
+    def start_instances(self, InstanceIds):
+        if self.fail_to_start:
+            raise RuntimeError("InsufficientInstanceCapacity")
+        self.calls.append(("start_instances", InstanceIds))
+
+    def terminate_instances(self, InstanceIds):
+        self.calls.append(("terminate_instances", InstanceIds))
+
+
+def pool_machine(instance_id, state="stopped"):
+    return {"InstanceId": instance_id, "State": {"Name": state}, "Tags": [{"Key": "EnsemblePool", "Value": "idea"}]}
+
+
+def test_claim_gives_rooms_stopped_machines_until_the_pool_runs_dry():
+    ec2 = PoolEc2([pool_machine("i-1"), pool_machine("i-2", "pending"), pool_machine("i-3")])
+    rooms = create_instances(3, "idea", "c7f3aa50", "emily", "ca-central-1", url_stem="codekata.proagile.link")
+
+    claimed = WarmPool(ec2, "idea", {"coach_tag": "SammanCoach"}).claim(rooms)
+
+    assert [room.room for room in claimed] == [1, 2]
+    assert [room.instance_id for room in rooms] == ["i-1", "i-3", None]
+    assert ec2.calls == [
+        ("delete_tags", ["i-1", "i-3"]),
+        ("create_tags", ["i-1"], {"Name": "idea-c7f3aa50-1.codekata.proagile.link", "SammanCoach": "emily"}),
+        ("create_tags", ["i-3"], {"Name": "idea-c7f3aa50-2.codekata.proagile.link", "SammanCoach": "emily"}),
+        ("start_instances", ["i-1", "i-3"]),
+    ]
+
+
+def test_machines_another_summon_claimed_at_the_same_time_are_left_to_it():
+    ec2 = PoolEc2([pool_machine("i-1"), pool_machine("i-2")], rival_claims=["i-1"])
+    rooms = create_instances(2, "idea", "c7f3aa50", "emily", "ca-central-1", url_stem="codekata.proagile.link")
+
+    claimed = WarmPool(ec2, "idea", {"coach_tag": "SammanCoach"}).claim(rooms)
+
+    assert [room.room for room in claimed] == [1]
+    assert [room.instance_id for room in rooms] == ["i-2", None]
+    assert ec2.calls[0] == ("delete_tags", ["i-2"])
+    assert ec2.calls[-1] == ("start_instances", ["i-2"])
+
+
+def test_machines_that_wont_start_go_back_to_the_pool():
+    ec2 = PoolEc2([pool_machine("i-1")], fail_to_start=True)
+    room = ProjectorInstance("idea", "idea-c7f3aa50.codekata.proagile.link", "emily", "ca-central-1")
+
+    claimed = WarmPool(ec2, "idea", {"coach_tag": "SammanCoach"}).claim([room])
+
+    assert claimed == []
+    assert room.instance_id is None
+    assert ec2.calls[-1] == ("create_tags", ["i-1"], {"Name": "pool-idea", "EnsemblePool": "idea", "SammanCoach": "warm pool"})
+
+
+def test_trim_terminates_only_stopped_surplus():
+    ec2 = PoolEc2([pool_machine("i-1", "pending"), pool_machine("i-2"), pool_machine("i-3")])
+    pool = WarmPool(ec2, "idea", {"coach_tag": "SammanCoach"})
+
+    assert pool.trim(2) == ["i-2"]
+    assert pool_status(pool.machines()) == {"pending": 1, "stopped": 2}
@@ -1,10 +1,15 @@
 import datetime
 import json
 
+import pytest
 from dateutil.tz import tzutc
 
+from benchmarks.control_plane import benchmark_environment, benchmark_directory, write_config, PROFILE_NAME
+from benchmarks.fake_aws import FakeAws
+from configuration import configuration
 from tests.test_instances import SAMPLE_RESPONSE
-from wrap_ec2_client import InstanceDataParser
+from wrap_ec2_client import InstanceDataParser, AddressWaiter, AddressWaitTimeout, InstanceDiscovery, \
+    InstancesManager
 
 
 def test_parse_machine_description():
@@ -90,3 +95,104 @@ def test_parse_instance_no_ip():
     machine_descriptions = parser.machine_with_name(obj, "1d2ff333-clion.codekata.proagile.link")
     assert list(machine_descriptions) == [('i-0490a14f0963de4f7',
                                            '1d2ff333-clion.codekata.proagile.link')]
+
+
+class SlowlyAddressedEc2:
+    """ Hands out a public ip address to one more instance each time it is polled """
+    def __init__(self, instance_ids):
+        self.instance_ids = instance_ids
+        self.polls = 0
+
+    def describe_instances(self, InstanceIds):
+        self.polls += 1
+        instances = []
+        for index, instance_id in enumerate(InstanceIds):
+            instance = {"InstanceId": instance_id, "Tags": [{"Key": "Name", "Value": f"{instance_id}.codekata.proagile.link"}]}
+            if self.instance_ids.index(instance_id) < self.polls:
+                instance["PublicIpAddress"] = f"10.0.0.{index}"
+            instances.append(instance)
+        return {"Reservations": [{"Instances": instances}]}
+
+
+def test_address_waiter_yields_each_instance_once():
+    ec2 = SlowlyAddressedEc2(["i-1", "i-2"])
+    waiter = AddressWaiter([(ec2, ["i-1", "i-2"])], first_delay=0)
+
+    addressed = [instance_id for instance_id, _, _ in waiter.addresses()]
+
+    assert addressed == ["i-1", "i-2"]
+    assert ec2.polls == 2
+
+
+def test_address_waiter_batches_the_instances_addressed_in_each_poll():
+    ec2 = SlowlyAddressedEc2(["i-1", "i-2", "i-3"])
+    ec2.polls = 1
+    waiter = AddressWaiter([(ec2, ["i-1", "i-2", "i-3"])], first_delay=0)
+
+    batches = [[instance_id for instance_id, _, _ in batch] for batch in waiter.address_batches()]
+
+    assert batches == [["i-1", "i-2"], ["i-3"]]
+
+
+def test_address_waiter_gives_up_at_deadline():
+    ec2 = SlowlyAddressedEc2(["i-1", "i-2", "i-3"])
+    waiter = AddressWaiter([(ec2, ["i-1", "i-2", "i-3"])], deadline=0, first_delay=0.1)
+
+    with pytest.raises(AddressWaitTimeout) as timeout:
+        list(waiter.addresses())
+
+    assert timeout.value.instance_ids == {"i-2", "i-3"}
+
+
+class PagedEc2:
+    def __init__(self, pages):
+        self.pages = pages
+        self.filters = None
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "describe_instances"
+        return self
+
+    def paginate(self, Filters):
+        self.filters = Filters
+        yield from self.pages
+
+
+def test_discovery_filters_on_the_server_and_reads_every_page():
+    ec2 = PagedEc2([
+        {"Reservations": [{"Instances": [{"InstanceId": "i-1"}]}]},
+        {"Reservations": [{"Instances": [{"InstanceId": "i-2"}, {"InstanceId": "i-3"}]}]},
+    ])
+    discovery = InstanceDiscovery(ec2, "codekata.proagile.link")
+
+    instances = discovery.instances(coach="emily", states=["running"])
+
+    assert [instance["InstanceId"] for instance in instances] == ["i-1", "i-2", "i-3"]
+    assert ec2.filters == [
+        {"Name": "tag:Name", "Values": ["*codekata.proagile.link*"]},
+        {"Name": "tag:SammanCoach", "Values": ["emily"]},
+        {"Name": "instance-state-name", "Values": ["running"]},
+    ]
+
+
+class UnreachableDiscovery:
+    def instances(self, **kwargs):
+        raise ConnectionError("Could not connect to the endpoint URL")
+
+
+def test_machines_in_a_region_that_cant_be_polled_keep_their_last_known_state():
+    fake_aws = FakeAws()
+    with benchmark_environment(fake_aws):
+        region_names = write_config(benchmark_directory(), region_count=2)
+        fake_aws.add_instance(region_names[0], "idea-1.codekata.proagile.link", "emily")
+        fake_aws.add_instance(region_names[1], "idea-2.codekata.proagile.link", "emily", state="stopped")
+        manager = InstancesManager(configuration(PROFILE_NAME).aws_defaults, region_names, PROFILE_NAME)
+        before = sorted(manager.machine_states())
+
+        manager.discovery[region_names[1]] = UnreachableDiscovery()
+        after = sorted(manager.machine_states())
+
+    assert [(name, state) for name, state, _ in after] == [
+        ("idea-1.codekata.proagile.link", "running"), ("idea-2.codekata.proagile.link", "stopped")]
+    assert after == before
+    assert list(manager.region_failures) == [region_names[1]]
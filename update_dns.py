@@ -4,85 +4,293 @@
 When an ensemble machine starts or is restarted, the IP address changes.
 The DNS record must be updated to point at the new IP, and that's what this script does.
 
-You should run this script by hand whenever you restart ensemble machines.
+Run it by hand whenever you restart ensemble machines, or leave it running with --watch
+to have it update the records as the machines come up.
 """
 import logging
+import time
 
-import boto3
 import click
 
+import aws_clients
+import request_scheduler
+from cli_options import cached_option, profile_option
+from local_cache import read_json_cache, write_json_cache
 from wrap_ec2_client import InstancesManager
 
+HOSTED_ZONES_CACHE = "hosted_zones.json"
+
+# Route53 accepts at most 1000 ResourceRecord elements and 32000 characters of record values per ChangeBatch.
+# An UPSERT counts twice towards both limits.
+MAX_RECORDS_PER_BATCH = 1000
+MAX_VALUE_CHARACTERS_PER_BATCH = 32000
+
+# a machine in one of these states is about to get, or lose, an ip address
+CHANGING_STATES = {"pending", "stopping"}
+
 
 class DnsUpdater:
-    def __init__(self, aws_defaults, aws_regions, profile_name=None):
+    def __init__(self, aws_defaults, aws_regions, profile_name=None, inventory=None, fresh=False):
         """ A DnsUpdater can change records in Route53 so that you get a human-readable url for your ensemble machines.
         Arguments:
         - aws_defaults - usually read from the file 'aws_machine_spec.json'.
         - aws_regions - usually the keys from the 'aws_zones.json' - all the ec2 regions where you have machines whose dns records should be updated.
         - profile_name - the AWS profile to use for credentials for boto3. Your profile names are usually listed in the file ~/.aws/credentials
+        - inventory, fresh - where to look the machines up, see InstancesManager
          """
         self.log = logging.getLogger(__name__)
 
-        self.instance_manager = InstancesManager(aws_defaults, aws_regions, profile_name)
-        session = boto3.Session(profile_name=profile_name, region_name=aws_defaults["region"])
-        self.route53 = session.client("route53")
+        self.instance_manager = InstancesManager(aws_defaults, aws_regions, profile_name, inventory=inventory,
+                                                 fresh=fresh)
+        self.route53 = aws_clients.client("route53", aws_defaults["region"], profile_name)
+        self.profile_name = profile_name
         self.hosted_dns_zone_name = aws_defaults["hosted_dns_zone_name"]
         self._pa_link_zone_id = aws_defaults.get("hosted_dns_zone_id", None)
+        self._zone_id_configured = self._pa_link_zone_id is not None
 
-    def update_ensemble_machine_dns_records(self):
-        for _, machine, ipv4 in self.instance_manager.list_machines_and_addresses():
-            self.update_dns_record(machine, ipv4)
-
-    def update_dns_record(self, machine, ipv4):
-        change_data = {
-            'Comment': 'DNS update for ensemble machine via script',
-            'Changes': [{
-                'Action': 'UPSERT',
-                'ResourceRecordSet': {
-                    'Name': machine,
-                    'Type': 'A',
-                    'TTL': 300,
-                    'ResourceRecords': [{
-                        'Value': ipv4
-                    }]
-                }
-            }]
-        }
-        self.route53.change_resource_record_sets(HostedZoneId=self.hosted_zone_id(), ChangeBatch=change_data)
-        self.log.debug(f"Updated DNS info for {machine}")
+    def update_ensemble_machine_dns_records(self, wait=False):
+        """ Bring the hosted zone up to date with the ip addresses of all the ensemble machines.
+        Only records that are missing or point at the wrong address are sent to Route53.
+        If wait is True, return only once Route53 reports the changes are INSYNC.
+        """
+        wanted = {machine: ipv4 for _, machine, ipv4 in self.instance_manager.list_machines_and_addresses()}
+        changes = changes_needed(self.current_a_records(), wanted)
+        if not changes:
+            self.log.info("All DNS records are already up to date")
+            return
+        self.log.info(f"Updating {len(changes)} of {len(wanted)} DNS records")
+        self.apply_changes(changes, wait=wait)
+
+    def current_a_records(self):
+        """ The A records in the hosted zone, as a dict of name (without the trailing dot) to ip address """
+        def list_records(zone_id):
+            records = {}
+            paginator = self.route53.get_paginator("list_resource_record_sets")
+            for page in paginator.paginate(HostedZoneId=zone_id):
+                for record_set in page["ResourceRecordSets"]:
+                    if record_set["Type"] == "A" and "ResourceRecords" in record_set:
+                        name = record_set["Name"].rstrip(".")
+                        records[name] = record_set["ResourceRecords"][0]["Value"]
+            return records
+        return self.in_hosted_zone(list_records)
 
+    def apply_changes(self, changes, wait=False):
+        change_ids = []
+        for batch in change_batches(changes):
+            change_data = {
+                'Comment': 'DNS update for ensemble machines via script',
+                'Changes': batch,
+            }
+            response = self.in_hosted_zone(lambda zone_id: self.route53.change_resource_record_sets(
+                HostedZoneId=zone_id, ChangeBatch=change_data))
+            change_ids.append(response["ChangeInfo"]["Id"])
+            self.log.debug(f"Sent {len(batch)} DNS changes as {change_ids[-1]}")
+        if wait:
+            waiter = self.route53.get_waiter("resource_record_sets_changed")
+            for change_id in change_ids:
+                waiter.wait(Id=change_id)
+            self.log.info("DNS changes are INSYNC")
+
+    def update_dns_records_when_addressed(self, address_waiter):
+        """ Push the DNS records for the machines the AddressWaiter sees get a public ip address, every time it looks.
+        These calls go ahead of any background work, since people are waiting for the urls.
+        """
+        with request_scheduler.priority(request_scheduler.HIGH):
+            for batch in address_waiter.address_batches():
+                self.apply_changes([upsert_a_record(machine, ipv4) for _, machine, ipv4 in batch])
+                for _, machine, ipv4 in batch:
+                    self.log.info(f"{machine} is reachable at {ipv4}")
+
+    def in_hosted_zone(self, call):
+        """ call(zone id) and return what it returns. If the zone id came from the cache file and Route53 says
+        there is no such zone, e.g. because the zone was deleted and created again, look it up again and retry once.
+        """
+        try:
+            return call(self.hosted_zone_id())
+        except self.route53.exceptions.NoSuchHostedZone:
+            if self._zone_id_configured:
+                raise
+            self.log.warning(f"the cached zone id {self._pa_link_zone_id} for {self.hosted_dns_zone_name} "
+                             f"no longer exists, looking it up again")
+            self.forget_hosted_zone_id()
+            return call(self.hosted_zone_id())
+
+    def forget_hosted_zone_id(self):
+        cache_key = f"{self.profile_name}:{self.hosted_dns_zone_name}"
+        cached_zones = read_json_cache(HOSTED_ZONES_CACHE)
+        if cached_zones.pop(cache_key, None) is not None:
+            write_json_cache(HOSTED_ZONES_CACHE, cached_zones)
+        self._pa_link_zone_id = None
 
     def hosted_zone_id(self):
         """ Use the route53 api to look up the hosted zone for this domain name.
-        Store it in a class member variable so we only do the lookup once.
+        Store it in a class member variable, and in a cache file on disk, so we only do the lookup once.
         If you prefer, you can specify the zone id in the aws_machine_spec under the key 'hosted_dns_zone_id' and avoid this lookup.
         """
+        cache_key = f"{self.profile_name}:{self.hosted_dns_zone_name}"
+        if self._pa_link_zone_id is None:
+            self._pa_link_zone_id = read_json_cache(HOSTED_ZONES_CACHE).get(cache_key)
         if self._pa_link_zone_id is None:
-            result = self.route53.list_hosted_zones()
-            for zone in result["HostedZones"]:
+            paginator = self.route53.get_paginator("list_hosted_zones")
+            zones = (zone for page in paginator.paginate() for zone in page["HostedZones"])
+            for zone in zones:
                 if zone["Name"] == self.hosted_dns_zone_name:
                     self._pa_link_zone_id = zone["Id"]
                     self.log.debug(f"Using AWS Hosted Zone: {self._pa_link_zone_id}")
+                    cached_zones = read_json_cache(HOSTED_ZONES_CACHE)
+                    cached_zones[cache_key] = self._pa_link_zone_id
+                    write_json_cache(HOSTED_ZONES_CACHE, cached_zones)
                     break
         if self._pa_link_zone_id is None:
             raise Exception(f"Couldn't find Zone ID for {self.hosted_dns_zone_name} - no work can be done")
         return self._pa_link_zone_id
 
 
+class DnsWatcher:
+    def __init__(self, dns_updater, fast_interval=5, slow_interval=60, backoff=2, sleep=time.sleep):
+        """ Keeps the hosted zone in step with the ip addresses of the ensemble machines, for as long as it runs.
+        Arguments:
+        - dns_updater - the DnsUpdater whose InstancesManager is polled and whose hosted zone is updated
+        - fast_interval - seconds between polls while any machine is starting, stopping or waiting for an address
+        - slow_interval - the longest time between polls. Once every machine is stable the interval grows by backoff
+          from fast_interval up to this.
+        """
+        self.log = logging.getLogger(__name__)
+        self.dns_updater = dns_updater
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.backoff = backoff
+        self.sleep = sleep
+        self.records = None
+
+    def watch(self, cycles=None):
+        """ Reconcile over and over, or only cycles times. The records in the hosted zone are read again
+        on every slow cycle, so records changed by anything else are put right too. A cycle that fails,
+        e.g. because AWS throttled it or couldn't be reached, is logged and the next one comes later.
+        """
+        interval = self.fast_interval
+        cycle = 0
+        while True:
+            try:
+                if self.records is None or interval >= self.slow_interval:
+                    self.records = self.dns_updater.current_a_records()
+                changing = self.reconcile()
+            except Exception as e:
+                self.log.warning(f"couldn't bring the DNS records up to date, trying again later: {e}")
+                # some of the changes might have been made, so the records are read again
+                self.records = None
+                changing = False
+            cycle += 1
+            if cycles is not None and cycle >= cycles:
+                return
+            interval = self.fast_interval if changing else min(interval * self.backoff, self.slow_interval)
+            self.log.debug(f"next poll in {interval}s")
+            self.sleep(interval)
+
+    def reconcile(self):
+        """ Push the records that changed since the last cycle, and return whether machines are still changing """
+        start = time.monotonic()
+        instance_manager = self.dns_updater.instance_manager
+        machines = list(instance_manager.machine_states())
+        for region, error in instance_manager.region_failures.items():
+            self.log.warning(f"couldn't poll machines in {region}, going on with their last known state: {error}")
+        wanted = {name: ip for name, state, ip in machines if ip}
+        changes = changes_needed(self.records, wanted)
+        if changes:
+            self.dns_updater.apply_changes(changes)
+            self.records.update({name.rstrip("."): ip for name, ip in wanted.items()})
+        changing = any(state in CHANGING_STATES or (state == "running" and not ip) for _, state, ip in machines)
+        self.log.info(f"reconciled {len(machines)} machines in {time.monotonic() - start:.2f}s, "
+                      f"{len(changes)} DNS changes, {'some' if changing else 'no'} machines changing")
+        return changing or bool(changes)
+
+
+def upsert_a_record(machine, ipv4):
+    return {
+        'Action': 'UPSERT',
+        'ResourceRecordSet': {
+            'Name': machine,
+            'Type': 'A',
+            'TTL': 300,
+            'ResourceRecords': [{
+                'Value': ipv4
+            }]
+        }
+    }
+
+
+def changes_needed(current_records, wanted_records):
+    """ UPSERTs for every wanted record that is missing from, or different in, the current records """
+    return [upsert_a_record(machine, ipv4)
+            for machine, ipv4 in sorted(wanted_records.items())
+            if current_records.get(machine.rstrip(".")) != ipv4]
+
+
+def change_batches(changes):
+    """ Split changes into as few ChangeBatches as Route53's per-request limits allow """
+    batch, records, characters = [], 0, 0
+    for change in changes:
+        weight = 2 if change["Action"] == "UPSERT" else 1
+        values = change["ResourceRecordSet"]["ResourceRecords"]
+        change_records = weight * len(values)
+        change_characters = weight * sum(len(value["Value"]) for value in values)
+        if batch and (records + change_records > MAX_RECORDS_PER_BATCH
+                      or characters + change_characters > MAX_VALUE_CHARACTERS_PER_BATCH):
+            yield batch
+            batch, records, characters = [], 0, 0
+        batch.append(change)
+        records += change_records
+        characters += change_characters
+    if batch:
+        yield batch
+
+
 @click.command()
 @click.option(
     "--aws-profile",
     default="default",
     help="the aws profile"
 )
-def main(aws_profile):
+@click.option(
+    "--wait/--no-wait",
+    default=False,
+    help="wait until Route53 reports the changes are INSYNC"
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="keep running, and update records as machines start and stop"
+)
+@click.option(
+    "--fast-interval",
+    default=5,
+    help="with --watch, seconds between polls while machines are starting or stopping"
+)
+@click.option(
+    "--slow-interval",
+    default=60,
+    help="with --watch, the longest time between polls when nothing is changing"
+)
+@cached_option
+@profile_option
+def main(aws_profile, wait, fresh, watch, fast_interval, slow_interval):
     logging.basicConfig(level=logging.INFO)
 
-    from summon import read_aws_defaults, read_regions_config
-    aws_defaults = read_aws_defaults(profile_name=aws_profile)
-    regions = read_regions_config(profile_name=aws_profile).keys()
-    DnsUpdater(aws_defaults, regions, profile_name=aws_profile).update_ensemble_machine_dns_records()
+    from configuration import configuration
+    config = configuration(aws_profile)
+    aws_defaults = config.aws_defaults
+    regions = config.region_names()
+    if watch:
+        # the inventory would hide the state changes the watcher is looking for
+        watcher = DnsWatcher(DnsUpdater(aws_defaults, regions, profile_name=aws_profile), fast_interval, slow_interval)
+        try:
+            watcher.watch()
+        except KeyboardInterrupt:
+            pass
+        return
+    from inventory import Inventory
+    updater = DnsUpdater(aws_defaults, regions, profile_name=aws_profile, inventory=Inventory(), fresh=fresh)
+    updater.update_ensemble_machine_dns_records(wait=wait)
 
 
 if __name__ == '__main__':
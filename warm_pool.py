@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+A warm pool is a set of fully provisioned, stopped machines for one IDE config in one region.
+summon.py claims machines from it before launching new ones: claiming only renames a machine and starts it,
+which takes about as long as booting, instead of the tens of minutes provisioning takes.
+
+Pool machines are named pool-<config name>, so they don't show up in instances.py or get stopped by shutdown.py,
+and they carry an EnsemblePool tag with their config name until they are claimed.
+"""
+import logging
+import uuid
+
+import click
+
+import aws_clients
+from cli_options import ConfigDependentOption, ide_config_names, region_names
+from configuration import configuration
+
+POOL_TAG = "EnsemblePool"
+CLAIM_TAG = "EnsembleClaim"
+POOL_NAME_PREFIX = "pool-"
+POOL_STATES = ["pending", "running", "stopping", "stopped"]
+
+
+class WarmPool:
+    def __init__(self, ec2_client, config_name, aws_defaults):
+        """ The warm pool for one config, in the region of the ec2 client """
+        self.log = logging.getLogger(__name__)
+        self.ec2_client = ec2_client
+        self.config_name = config_name
+        self.coach_tag = aws_defaults.get("coach_tag", "SammanCoach")
+
+    def machines(self, states=POOL_STATES):
+        """ yields the instance descriptions of the machines in the pool, including those still being provisioned """
+        paginator = self.ec2_client.get_paginator("describe_instances")
+        filters = [
+            {'Name': f'tag:{POOL_TAG}', 'Values': [self.config_name]},
+            {'Name': 'instance-state-name', 'Values': list(states)},
+        ]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page["Reservations"]:
+                yield from reservation["Instances"]
+
+    def claim(self, projector_instances):
+        """ Give as many of the rooms as possible a stopped machine from the pool, and start those machines.
+        Each claimed machine is retagged with the room's Name and coach, and does the per-host setup for that
+        name when it boots. Returns the rooms that got a machine - the rest still need launching.
+        """
+        stopped = [instance["InstanceId"] for instance in self.machines(states=["stopped"])]
+        if not stopped:
+            return []
+        claimed = list(zip(projector_instances, self.take(stopped[:len(projector_instances)])))
+        if not claimed:
+            return []
+        instance_ids = [instance_id for _, instance_id in claimed]
+        for projector_instance, instance_id in claimed:
+            self.ec2_client.create_tags(Resources=[instance_id], Tags=[
+                {'Key': 'Name', 'Value': projector_instance.dns_name},
+                {'Key': self.coach_tag, 'Value': projector_instance.coach},
+            ])
+        try:
+            self.ec2_client.start_instances(InstanceIds=instance_ids)
+        except Exception as e:
+            self.log.warning(f"couldn't start machines from the {self.config_name} pool, launching new ones instead: {e}")
+            self.release(instance_ids)
+            return []
+        for projector_instance, instance_id in claimed:
+            projector_instance.instance_id = instance_id
+            self.log.info(f"claimed {instance_id} from the {self.config_name} pool for {projector_instance.dns_name}")
+        return [projector_instance for projector_instance, _ in claimed]
+
+    def take(self, instance_ids):
+        """ Take the machines out of the pool for this summon alone, and return the ids of the ones it got.
+        Another summon may be taking the same machines. EC2 can't change a tag only if it has a given value,
+        so each machine is tagged with a token for this claim, and read back before and after its EnsemblePool
+        tag is removed. A machine is ours only if it was still in the pool with our token on it the first time,
+        and still has our token the second time - if another summon's token replaced ours in between, neither
+        summon gets it, and it stays stopped outside the pool.
+        """
+        token = uuid.uuid4().hex
+        self.ec2_client.create_tags(Resources=instance_ids, Tags=[{'Key': CLAIM_TAG, 'Value': token}])
+        in_pool = self.holding(instance_ids, token, in_pool=True)
+        if not in_pool:
+            return []
+        self.ec2_client.delete_tags(Resources=in_pool, Tags=[{'Key': POOL_TAG, 'Value': self.config_name}])
+        taken = self.holding(in_pool, token)
+        for instance_id in set(in_pool) - set(taken):
+            self.log.warning(f"another summon claimed {instance_id} from the {self.config_name} pool at the same "
+                             f"time, so neither gets it - it is stopped, and out of the pool")
+        return taken
+
+    def holding(self, instance_ids, token, in_pool=False):
+        """ The ids of the machines that have the claim token, and with in_pool, are still in the pool """
+        response = self.ec2_client.describe_instances(InstanceIds=instance_ids)
+        tags = {instance["InstanceId"]: {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+                for reservation in response["Reservations"] for instance in reservation["Instances"]}
+        return [instance_id for instance_id in instance_ids
+                if tags.get(instance_id, {}).get(CLAIM_TAG) == token
+                and (not in_pool or tags[instance_id].get(POOL_TAG) == self.config_name)]
+
+    def release(self, instance_ids):
+        """ Put claimed machines that never started back in the pool """
+        self.ec2_client.create_tags(Resources=instance_ids, Tags=[
+            {'Key': 'Name', 'Value': f"{POOL_NAME_PREFIX}{self.config_name}"},
+            {'Key': POOL_TAG, 'Value': self.config_name},
+            {'Key': self.coach_tag, 'Value': "warm pool"},
+        ])
+
+    def trim(self, size):
+        """ Terminate stopped machines until the pool is no bigger than size, and return their ids """
+        machines = list(self.machines())
+        surplus = len(machines) - size
+        stopped = [instance["InstanceId"] for instance in machines if instance["State"]["Name"] == "stopped"]
+        to_terminate = stopped[:max(surplus, 0)]
+        if to_terminate:
+            self.ec2_client.terminate_instances(InstanceIds=to_terminate)
+        return to_terminate
+
+
+def pool_status(instances):
+    """ How many pool machines are in each state - stopped ones are ready to claim, the others are still provisioning """
+    counts = {}
+    for instance in instances:
+        state = instance["State"]["Name"]
+        counts[state] = counts.get(state, 0) + 1
+    return counts
+
+
+@click.command()
+@click.option(
+    "--config-name",
+    cls=ConfigDependentOption,
+    help="the config of the machines in the pool",
+    prompt="what config",
+    prompt_from=ide_config_names,
+)
+@click.option(
+    "--region-name",
+    cls=ConfigDependentOption,
+    help="the aws region name",
+    help_from=region_names,
+    default=None
+)
+@click.option(
+    "--aws-profile",
+    default="default",
+    help="the aws profile, if you don't use the default"
+)
+@click.option(
+    "--size",
+    type=int,
+    default=None,
+    help="how many machines the pool should have - leave it out to just see what's in the pool"
+)
+def warm_pool(config_name, region_name, aws_profile, size):
+    from summon import launch_pool_machines
+
+    logging.basicConfig(level=logging.INFO)
+    config = configuration(aws_profile)
+    region_name = region_name or config.aws_defaults["region"]
+    machine_config = config.ide_config(config_name)
+    region_config = config.region(region_name)
+    ec2 = aws_clients.client("ec2", region_name, aws_profile)
+    pool = WarmPool(ec2, config_name, config.aws_defaults)
+
+    if size is not None:
+        shortfall = size - len(list(pool.machines()))
+        if shortfall > 0:
+            launched = launch_pool_machines(ec2, shortfall, machine_config, region_config, config.aws_defaults,
+                                            config.baked_image(region_name, config_name), region_name)
+            print(f"provisioning {len(launched)} machines, they stop themselves when they are ready")
+        elif shortfall < 0:
+            terminated = pool.trim(size)
+            print(f"terminated {len(terminated)} machines")
+
+    status = pool_status(pool.machines())
+    print(f"{config_name} pool in {region_name}: " +
+          (", ".join(f"{count} {state}" for state, count in sorted(status.items())) or "empty"))
+
+
+if __name__ == "__main__":
+    warm_pool()
@@ -1,41 +1,201 @@
 import logging
+import time
 
-import boto3
+import aws_clients
+from region_executor import RegionExecutor
+
+
+class InstanceDiscovery:
+    def __init__(self, ec2_client, url_stem, coach_tag="SammanCoach"):
+        """ Finds ensemble machines in one region with paginated describe_instances calls.
+        The filtering by name, coach and state is done by EC2, so only matching instances are transferred,
+        and pages are fetched one at a time as the caller asks for them.
+        """
+        self.ec2_client = ec2_client
+        self.url_stem = url_stem
+        self.coach_tag = coach_tag
+
+    def filters(self, name=None, coach=None, states=None):
+        filters = [{'Name': 'tag:Name', 'Values': [f"*{name or self.url_stem}*"]}]
+        if coach:
+            filters.append({'Name': f'tag:{self.coach_tag}', 'Values': [coach]})
+        if states:
+            filters.append({'Name': 'instance-state-name', 'Values': list(states)})
+        return filters
+
+    def pages(self, name=None, coach=None, states=None):
+        """ yields describe_instances responses, one page at a time """
+        paginator = self.ec2_client.get_paginator("describe_instances")
+        yield from paginator.paginate(Filters=self.filters(name, coach, states))
+
+    def instances(self, name=None, coach=None, states=None):
+        """ yields the instance descriptions of all the matching instances """
+        for page in self.pages(name, coach, states):
+            for reservation in page["Reservations"]:
+                yield from reservation["Instances"]
+
+    def invalidate(self):
+        """ Told that machines were just started or stopped - nothing to do, since every lookup asks EC2 """
 
 
 class InstancesManager:
-    def __init__(self, aws_defaults, aws_regions, profile_name=None):
+    def __init__(self, aws_defaults, aws_regions, profile_name=None, region_executor=None, inventory=None,
+                 fresh=False):
+        """ Finds, starts and stops ensemble machines in all the regions at once.
+        With an inventory, machines are looked up in it while it is up to date - see inventory.py - unless fresh is set.
+        """
         self.log = logging.getLogger(__name__)
 
-        self.ec2_region_clients = []
+        self.ec2_region_clients = {}
+        self.discovery = {}
         for region in aws_regions:
-            region_session = boto3.Session(profile_name=profile_name, region_name=region)
-            region_client = region_session.client("ec2")
-            self.ec2_region_clients.append(region_client)
+            region_client = aws_clients.client("ec2", region, profile_name)
+            self.ec2_region_clients[region] = region_client
+            discovery = InstanceDiscovery(region_client, aws_defaults["url_stem"],
+                                          aws_defaults.get("coach_tag", "SammanCoach"))
+            if inventory:
+                from inventory import CachedDiscovery
+                discovery = CachedDiscovery(discovery, region, profile_name or "default", inventory, fresh)
+            self.discovery[region] = discovery
 
         self.url_stem = aws_defaults["url_stem"]
+        self.region_executor = region_executor or RegionExecutor()
+        self.region_failures = {}
+        self.last_known_states = {}
 
     def list_machines_and_addresses(self):
         parser = InstanceDataParser(self.url_stem)
-        for ec2_client in self.ec2_region_clients:
-            result = ec2_client.describe_instances()
-            yield from parser.machine_from_instance_description(result)
+
+        def machines_in_region(region):
+            pages = self.discovery[region].pages(states=["pending", "running"])
+            return [machine for page in pages for machine in parser.machine_from_instance_description(page)]
+
+        for machines in self._in_every_region(machines_in_region):
+            yield from machines
 
     def stop_all_machines(self):
         parser = InstanceDataParser(self.url_stem)
-        for ec2_client in self.ec2_region_clients:
-            result = ec2_client.describe_instances()
-            machines = [id for id, name, ip in parser.machine_from_instance_description(result)]
+
+        def stop_machines_in_region(region):
+            ec2_client = self.ec2_region_clients[region]
+            pages = self.discovery[region].pages(states=["pending", "running"])
+            machines = [id for page in pages for id, name, ip in parser.machine_from_instance_description(page)]
             if machines:
                 ec2_client.stop_instances(InstanceIds=machines)
+                self.discovery[region].invalidate()
+            return machines
+
+        return [id for machines in self._in_every_region(stop_machines_in_region) for id in machines]
 
     def start_machine(self, name):
         parser = InstanceDataParser(self.url_stem)
-        for ec2_client in self.ec2_region_clients:
-            result = ec2_client.describe_instances()
-            machines = [id for id, name in parser.machine_with_name(result, name)]
+
+        def start_machines_in_region(region):
+            ec2_client = self.ec2_region_clients[region]
+            pages = self.discovery[region].pages(name=name, states=["stopped"])
+            machines = [id for page in pages for id, machine_name in parser.machine_with_name(page, name)]
             if machines:
                 ec2_client.start_instances(InstanceIds=machines)
+                self.discovery[region].invalidate()
+            return machines
+
+        return [id for machines in self._in_every_region(start_machines_in_region) for id in machines]
+
+    def machine_states(self):
+        """ yields (name, state, public ip address or None) for every ensemble machine that isn't terminated.
+        The machines in a region that can't be polled this time are yielded as they were the last time it could be,
+        so that a failed poll doesn't look as if they were gone. The region is still reported in region_failures.
+        """
+        def states_in_region(region):
+            instances = self.discovery[region].instances(states=["pending", "running", "stopping", "stopped"])
+            return region, [(name_tag(instance), instance["State"]["Name"], instance.get("PublicIpAddress"))
+                            for instance in instances]
+
+        for region, machines in self._in_every_region(states_in_region):
+            self.last_known_states[region] = machines
+            yield from machines
+        for region in self.region_failures:
+            yield from self.last_known_states.get(region, [])
+
+    def _in_every_region(self, task):
+        """ Run task in all regions concurrently, yielding each region's result as it arrives.
+        Regions that fail are logged and collected in self.region_failures, and the others carry on.
+        """
+        self.region_failures = {}
+        for outcome in self.region_executor.outcomes(task, self.ec2_region_clients.keys()):
+            if outcome.ok:
+                yield outcome.result
+            else:
+                self.region_failures[outcome.region_name] = outcome.error
+
+
+def name_tag(instance):
+    return next((tag["Value"] for tag in instance.get("Tags", []) if tag["Key"] == "Name"), "")
+
+
+class AddressWaitTimeout(Exception):
+    def __init__(self, instance_ids):
+        super().__init__(f"gave up waiting for a public ip address for {', '.join(sorted(instance_ids))}")
+        self.instance_ids = instance_ids
+
+
+class AddressWaiter:
+    """ Waits for newly launched instances to get a public ip address.
+    Unlike EC2.Waiter.InstanceRunning, which only returns once every instance is running,
+    this yields each instance as soon as it has an address, so the caller can act on it straight away.
+    Arguments:
+    - instance_ids_by_client - pairs of (ec2 client, instance ids in that client's region)
+    - deadline - seconds to wait in total before raising AddressWaitTimeout
+    - first_delay, max_delay, backoff - the polling interval starts at first_delay and grows by backoff up to max_delay
+    """
+    def __init__(self, instance_ids_by_client, deadline=600, first_delay=2, max_delay=20, backoff=1.5):
+        self.log = logging.getLogger(__name__)
+        self.pending = [(ec2_client, set(instance_ids)) for ec2_client, instance_ids in instance_ids_by_client]
+        self.deadline = deadline
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.parser = InstanceDataParser(url_stem="")
+
+    def pending_instance_ids(self):
+        return {instance_id for _, instance_ids in self.pending for instance_id in instance_ids}
+
+    def addresses(self):
+        """ yields (instance_id, name, ip_address) for each instance as it gets its public ip address """
+        for batch in self.address_batches():
+            yield from batch
+
+    def address_batches(self):
+        """ yields a list of (instance_id, name, ip_address) for the instances that got their address since the last poll """
+        give_up_at = time.monotonic() + self.deadline
+        delay = self.first_delay
+        while True:
+            batch = [address for ec2_client, instance_ids in self.pending if instance_ids
+                     for address in self._poll(ec2_client, instance_ids)]
+            if batch:
+                yield batch
+            still_pending = self.pending_instance_ids()
+            if not still_pending:
+                return
+            if time.monotonic() + delay > give_up_at:
+                raise AddressWaitTimeout(still_pending)
+            self.log.debug(f"waiting {delay:.1f}s for {len(still_pending)} instances to get an ip address")
+            time.sleep(delay)
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def _poll(self, ec2_client, instance_ids):
+        from botocore.exceptions import ClientError
+        try:
+            result = ec2_client.describe_instances(InstanceIds=sorted(instance_ids))
+        except ClientError as e:
+            # a brand new instance id is not always visible to describe_instances straight away
+            if e.response["Error"]["Code"] == "InvalidInstanceID.NotFound":
+                return
+            raise
+        for instance_id, name, ip_address in self.parser.machine_from_instance_description(result):
+            if instance_id in instance_ids:
+                instance_ids.discard(instance_id)
+                yield instance_id, name, ip_address
 
 
 class InstanceDataParser: